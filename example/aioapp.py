@@ -0,0 +1,316 @@
+"""The task runner of `app.py`, on asyncio instead of threads.
+
+The web server is aiohttp, the Socket.IO server is the `AsyncServer` of
+python-socketio, and the tasks run on the same event loop, see `AioTask`.
+The routes, the Socket.IO events and the page are the same as those of `app.py`,
+so `workflow.js` works unchanged.
+
+Run it as
+
+    python aioapp.py
+
+and navigate to [localhost:5050](http://localhost:5050).
+"""
+
+import os
+import re
+import asyncio
+
+import socketio
+from aiohttp import web
+from jinja2 import Environment, FileSystemLoader
+
+from aiotask import AioTask
+from reports import Reports
+from registry import SqliteRegistry
+from watch import Watcher
+from classify import DEFAULT_RULES
+from helpers import console, taskTable, subscriptions
+
+PORT = 5050
+CORPUS = "example"  # the corpus whose tasks are run; part of the room names
+TASKS = ("function", "script", "preview")
+BATCH_WINDOW = 0.25  # seconds that progress lines are collected before emitting
+BATCH_BUDGET = 65536  # characters in a batch that trigger immediate emitting
+LOG_DIR = "logs"  # where the logs of the task runs are stored
+LOG_LIMIT = 1000  # maximum number of log records in a response
+RING_SIZE = 10000  # recent events per task that are replayed to new clients
+CONCURRENCY = 4  # maximum number of tasks that run at the same time
+CLASS_LIMITS = dict(cpu=2, io=4)  # maximum number of running tasks per class
+RESOURCE_CLASSES = dict(function="io", script="cpu", preview="control")
+ASSET_MAX_AGE = 3600  # seconds that clients may cache static files
+REPORT_DIR = "reports"  # where the tasks write their reports
+REPORT_LIMIT = 1000  # maximum number of report lines in a response
+REGISTRY = None  # path of an SQLite registry shared by several workers, if any
+HISTORY_PATH = "state/history.db"  # where the history of the runs is kept
+HISTORY_LIMIT = 100  # maximum number of runs in a response
+RULES = DEFAULT_RULES  # how the output lines of the corpus are classified
+KILL_GRACE = 5.0  # seconds between terminating and killing a stopped task
+WATCH_DIR = None  # directory of the corpus sources whose changes trigger a preview
+WATCH_DEBOUNCE = 2.0  # quiet seconds that end a burst of changes
+CACHE_DIR = "state/cache"  # where the outputs of workflow steps are cached
+CACHE_BUDGET = 1 << 30  # maximum number of bytes in the step cache
+STATIC_ROOT = os.path.realpath(".")
+
+
+sio = socketio.AsyncServer(async_mode="aiohttp")
+app = web.Application()
+sio.attach(app)
+TT = AioTask(
+    sio,
+    batchWindow=BATCH_WINDOW,
+    batchBudget=BATCH_BUDGET,
+    logDir=LOG_DIR,
+    ringSize=RING_SIZE,
+    concurrency=CONCURRENCY,
+    classLimits=CLASS_LIMITS,
+    resourceClasses=RESOURCE_CLASSES,
+    corpus=CORPUS,
+    registry=None if REGISTRY is None else SqliteRegistry(REGISTRY),
+    historyPath=HISTORY_PATH,
+    rules=RULES,
+    killGrace=KILL_GRACE,
+    cacheDir=CACHE_DIR,
+    cacheBudget=CACHE_BUDGET,
+)
+REPORTS = Reports(REPORT_DIR)
+TEMPLATES = Environment(loader=FileSystemLoader("templates"), autoescape=False)
+routes = web.RouteTableDef()
+
+
+def intArg(request, name):
+    """Get a request argument as integer, None if it is absent or not a number."""
+    value = request.query.get(name, None)
+    return None if value is None or not value.isdecimal() else int(value)
+
+
+@routes.get("/")
+async def index(request):
+    """Create the HTML for a task runner, see `app.index()`."""
+    html = TEMPLATES.get_template("index.html").render(effects=taskTable(TASKS))
+    return web.Response(text=html, content_type="text/html")
+
+
+@routes.route("*", "/run/{task}/")
+async def run(request):
+    """Reponds to clicking the run button of a specific task."""
+    task = request.match_info["task"]
+
+    if task not in TASKS:
+        stat = "start-prevented"
+        msg = "no such task"
+
+    elif (stat := TT.requestRun(task)) == "start-issued":
+        console(f"start {task}")
+        msg = "about to start"
+
+    elif stat == "start-coalesced":
+        console(f"follow-up {task}")
+        msg = "will run again after the current run"
+
+    else:
+        console("suppress workflow")
+        stat = "start-prevented"
+        msg = "already running"
+
+    return web.json_response(dict(task=task, stat=stat, msg=msg))
+
+
+@routes.route("*", "/kill/{task}/")
+async def kill(request):
+    """Reponds to clicking the kill button of a specific task"""
+    task = request.match_info["task"]
+
+    if TT.isIdle(task):
+        stat = "kill-prevented"
+        msg = "not running"
+    else:
+        TT.stop(task)
+        await TT.write(TT.emitter.status, task, stat="kill", msg="kill signalled")
+        stat = "kill-issued"
+        msg = "about to kill"
+
+    return web.json_response(dict(task=task, stat=stat, msg=msg))
+
+
+@routes.get("/log/{task}/")
+async def log(request):
+    """Responds to a request for the log of a run of a task, see `app.log()`."""
+    task = request.match_info["task"]
+
+    if task not in TASKS:
+        return web.json_response(
+            dict(task=task, stat="log-prevented", msg="no such task")
+        )
+
+    args = request.query
+    severity = args.get("severity", None)
+    limit = intArg(request, "limit")
+    (run, records) = await asyncio.to_thread(
+        TT.runLog.read,
+        task,
+        run=args.get("run", None),
+        start=intArg(request, "start"),
+        end=intArg(request, "end"),
+        tail=intArg(request, "tail"),
+        kinds=None if severity is None else set(severity.split(",")),
+        limit=LOG_LIMIT if limit is None else min(limit, LOG_LIMIT),
+    )
+    runs = TT.runLog.listRuns(task)
+
+    return web.json_response(dict(task=task, run=run, runs=runs, records=records))
+
+
+@routes.get("/report/{task}/")
+@routes.get("/report/{task}/{name:.+}")
+async def report(request):
+    """Responds to a request for (a part of) a report, see `app.report()`."""
+    task = request.match_info["task"]
+    name = request.match_info.get("name", None)
+
+    if task not in TASKS:
+        return web.json_response(
+            dict(task=task, stat="report-prevented", msg="no such task")
+        )
+
+    if name is None:
+        return web.json_response(dict(task=task, reports=REPORTS.listReports(task)))
+
+    args = request.query
+    count = intArg(request, "count")
+    count = REPORT_LIMIT if count is None else min(count, REPORT_LIMIT)
+    pattern = args.get("grep", None)
+
+    # the reports are read from disk, which should not hold up the loop
+    if args.get("summary", None) == "1":
+        result = await asyncio.to_thread(REPORTS.summary, task, name)
+    elif pattern is not None:
+        try:
+            result = await asyncio.to_thread(
+                REPORTS.grep,
+                task,
+                name,
+                pattern,
+                start=intArg(request, "start") or 0,
+                limit=count,
+                ignoreCase=args.get("icase", None) == "1",
+            )
+        except re.error as e:
+            return web.json_response(
+                dict(task=task, stat="report-prevented", msg=f"bad pattern: {e}")
+            )
+    else:
+        tail = intArg(request, "tail")
+        result = await asyncio.to_thread(
+            REPORTS.page,
+            task,
+            name,
+            start=intArg(request, "start") or 0,
+            count=count,
+            tail=None if tail is None else min(tail, REPORT_LIMIT),
+        )
+
+    if result is None:
+        return web.json_response(
+            dict(task=task, stat="report-prevented", msg="no such report")
+        )
+
+    return web.json_response(dict(task=task, name=name, **result))
+
+
+@routes.get("/history/")
+@routes.get("/history/{task}/")
+async def history(request):
+    """Responds to a request for the history of runs, see `app.history()`."""
+    task = request.match_info.get("task", None)
+
+    if TT.history is None:
+        return web.json_response(
+            dict(task=task, stat="history-prevented", msg="no history kept")
+        )
+
+    if task is None:
+        runs = await asyncio.to_thread(TT.history.latest)
+        return web.json_response(dict(runs=runs))
+
+    if task not in TASKS:
+        return web.json_response(
+            dict(task=task, stat="history-prevented", msg="no such task")
+        )
+
+    limit = intArg(request, "limit")
+    limit = HISTORY_LIMIT if limit is None else min(limit, HISTORY_LIMIT)
+    runs = await asyncio.to_thread(TT.history.runs, CORPUS, task, limit=limit)
+    return web.json_response(dict(task=task, runs=runs))
+
+
+@routes.get("/{path:.+}")
+async def staticFile(request):
+    """Serve a static file.
+
+    aiohttp handles the validators and byte ranges; files outside the
+    directory of the app are refused.
+    """
+    path = os.path.realpath(f"{STATIC_ROOT}/{request.match_info['path']}")
+
+    if os.path.commonpath((STATIC_ROOT, path)) == STATIC_ROOT and os.path.isfile(
+        path
+    ):
+        return web.FileResponse(
+            path, headers={"Cache-Control": f"public, max-age={ASSET_MAX_AGE}"}
+        )
+
+    console(f"File not found: {request.match_info['path']}")
+    return web.Response(text="xxx", status=404)
+
+
+@sio.event
+async def connect(sid, environ, auth=None):
+    """Verify the websocket connection, subscribe it, and replay missed events.
+
+    See `app.test_connect()`.
+    """
+    await sio.emit("after connect", {"data": "Ready to run"}, to=sid)
+
+    seen = (auth or {}).get("seen", None) or {}
+    wire = TT.wire
+    compact = wire.wants(auth)
+
+    if compact:
+        await sio.enter_room(sid, wire.dictRoom)
+        wire.join(sid)
+
+    for task in subscriptions(auth, TASKS):
+        room = TT.emitter.room(task)
+        await sio.enter_room(sid, wire.enter(sid, room, compact))
+        # the replay may have to read the run log from disk
+        await asyncio.to_thread(TT.emitter.replay, task, seen.get(task, None), sid)
+
+
+@sio.event
+async def disconnect(sid, reason=None):
+    """Forget the encoding of a client that has gone."""
+    TT.wire.leave(sid)
+
+
+def onCorpusChange(paths):
+    """Run the preview after a burst of changes in the corpus sources."""
+    console(f"{len(paths)} changed file(s) in {WATCH_DIR}")
+    TT.requestRun("preview", trigger="watch")
+
+
+async def onStartup(app):
+    await TT.setup()
+
+    if WATCH_DIR is not None:
+        Watcher(
+            TT.socketio, WATCH_DIR, onCorpusChange, debounce=WATCH_DEBOUNCE
+        ).start()
+
+
+app.router.add_routes(routes)
+app.on_startup.append(onStartup)
+
+
+if __name__ == "__main__":
+    web.run_app(app, port=PORT)
@@ -0,0 +1,565 @@
+import os
+import sys
+import signal
+import asyncio
+import inspect
+from queue import SimpleQueue
+from functools import partial
+from threading import Thread, Event
+from concurrent.futures import ThreadPoolExecutor
+
+from helpers import Timestamp, console
+from capture import Capture
+from task import Task
+from dag import Dag
+from preview import previewSteps
+
+
+class Bridge:
+    """Give an asyncio Socket.IO server the interface of a flask-socketio object.
+
+    The parts of the task runner that are shared with the threaded server,
+    the `Emitter`, `RunLog` and `Usage`, expect a socketio object with `emit()`,
+    `start_background_task()` and `sleep()`, callable from any thread.
+
+    Emits are put in a queue, in the order in which they are made, from whatever
+    thread; a single coroutine on the event loop takes them out and sends them.
+    Emits that are made before the loop is attached, wait in the queue.
+    Background tasks run in daemon threads.
+    """
+
+    def __init__(self, sio):
+        """Wrap an asyncio Socket.IO server.
+
+        Parameters
+        ----------
+        sio: object
+            The `socketio.AsyncServer`.
+        """
+        self.sio = sio
+        self.loop = None
+        self.pending = SimpleQueue()
+        self.queue = None
+
+    def attach(self, loop):
+        """Start sending the emits, from the event loop.
+
+        Call this on the loop.
+
+        Parameters
+        ----------
+        loop: object
+            The running event loop.
+        """
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+        while not self.pending.empty():
+            self.queue.put_nowait(self.pending.get())
+
+        loop.create_task(self.pump())
+
+    async def pump(self):
+        """Send the queued emits, one by one, forever."""
+        sio = self.sio
+        queue = self.queue
+
+        while True:
+            (event, data, to) = await queue.get()
+
+            try:
+                await sio.emit(event, data, to=to)
+            except Exception as e:
+                sys.stderr.write(f"emit {event} failed: {e}\n")
+
+    def emit(self, event, data, to=None):
+        """Emit an event, to all clients or to a single one.
+
+        Parameters
+        ----------
+        event: string
+            The name of the event.
+        data: any
+            The payload.
+        to: string, optional None
+            The session id of the client, or None for all clients.
+        """
+        item = (event, data, to)
+
+        if self.loop is None:
+            self.pending.put(item)
+        else:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+    def start_background_task(self, target, *args, **kwargs):
+        """Run a function in a daemon thread."""
+        thread = Thread(target=target, args=args, kwargs=kwargs, daemon=True)
+        thread.start()
+        return thread
+
+    def sleep(self, seconds):
+        """Sleep in the current thread."""
+        Event().wait(seconds)
+
+
+class ExitProtocol(asyncio.subprocess.SubprocessStreamProtocol):
+    """The protocol of a subprocess, which also reports the exit of the process.
+
+    Asyncio reports it as soon as it has reaped the process, also if the pipes
+    of the process are still open elsewhere, see `AioTask`.
+    """
+
+    def __init__(self, limit, loop):
+        """Create the protocol.
+
+        Parameters
+        ----------
+        limit: integer
+            The buffer limit of the pipes, see `asyncio.StreamReader`.
+        loop: object
+            The event loop.
+        """
+        super().__init__(limit=limit, loop=loop)
+        self.exited = loop.create_future()
+
+    def process_exited(self):
+        """Resolve `exited`, when the process has exited."""
+        super().process_exited()
+
+        if not self.exited.done():
+            self.exited.set_result(None)
+
+
+class AioTask(Task):
+    """Run tasks on an asyncio event loop.
+
+    The API and the events that clients receive are the same as those of `Task`,
+    but instead of a thread per task and a reactor thread for the subprocesses:
+
+    *   a task function that is a coroutine function runs as an asyncio task on
+        the loop; other task functions, such as the steps of a workflow, still
+        run in a thread of their own;
+    *   the function task is a coroutine; it sleeps on an asyncio event that is
+        set by `stop()`, so it ends as soon as it is stopped;
+    *   the subprocess of a script task is started with
+        `asyncio.create_subprocess_exec()`; its pipes are read by coroutines on
+        the loop, and delivered as lines by a `Capture`;
+    *   the kill signal for the process group of a stopped subprocess is a timer
+        on the loop, see `terminate()`;
+    *   what writes to the run log or the history, such as progress lines and
+        status messages, is handed to a writer thread, so that the disk does not
+        hold up the loop, see `write()`.
+
+    The methods of this class may be called from any thread; what has to happen
+    on the loop is handed over to it.
+
+    Call `setup()` on the running loop before starting tasks.
+
+    !!! note "exit and pipes"
+        A process that exits may leave its output pipes open in processes that it
+        has spawned, such as `clock.py` in the script task.
+        Awaiting `proc.wait()` would then wait until those have gone as well,
+        so we await the exit of the process itself, as its `ExitProtocol`
+        reports it, and give the pipes `drainTime` seconds to deliver the last
+        output after that.
+
+    !!! note "resource usage"
+        Asyncio reaps the subprocesses itself, so their `wait4()` resource usage
+        is not available; the usage of script tasks comes from sampling only.
+        See `Usage`.
+    """
+
+    def __init__(self, sio, chunkSize=65536, drainTime=0.2, **kwargs):
+        """Create a task object.
+
+        Parameters
+        ----------
+        sio: object
+            The `socketio.AsyncServer`.
+        chunkSize: integer, optional 65536
+            The maximum number of bytes read from a pipe at a time.
+        drainTime: float, optional 0.2
+            The number of seconds that the pipes of an exited subprocess may
+            still deliver output.
+        **kwargs: any
+            The other parameters of `Task`.
+        """
+        super().__init__(Bridge(sio), **kwargs)
+        self.sio = sio
+        self.chunkSize = chunkSize
+        self.drainTime = drainTime
+        self.loop = None
+        self.wakers = {}
+        self.procs = {}
+        self.killers = {}
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="writer")
+
+    def makeReactor(self, socketio, killGrace):
+        """There is no reactor: subprocesses run on the event loop, see `script()`."""
+        return None
+
+    async def setup(self):
+        """Bind this object to the running event loop."""
+        self.loop = asyncio.get_running_loop()
+        self.socketio.attach(self.loop)
+
+    def onLoop(self):
+        """Whether we are running in the thread of the event loop."""
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def call(self, function, *args):
+        """Call a function on the event loop, right away if we are on it."""
+        if self.onLoop():
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    async def write(self, function, *args, **kwargs):
+        """Call a function that writes to the run log or the history, off the loop.
+
+        All such calls are made in the same thread, one after the other, so that
+        the events of a task keep their order.
+
+        Parameters
+        ----------
+        function: function
+            The function, e.g. `emitter.progressLines`.
+        *args, **kwargs: any
+            The arguments for the function.
+
+        Returns
+        -------
+        any
+            The result of the function.
+        """
+        return await self.loop.run_in_executor(
+            self.writer, partial(function, *args, **kwargs)
+        )
+
+    def spawn(self, task, *args, **kwargs):
+        """Run a task function in the background.
+
+        Coroutine functions run as asyncio tasks, other functions in a thread.
+
+        Parameters
+        ----------
+        task: function
+            The task function.
+        *args, **kwargs: any
+            The arguments for the task function.
+
+        Returns
+        -------
+        object
+            The asyncio task, a future for it, or the thread.
+        """
+        if not inspect.iscoroutinefunction(task):
+            return self.socketio.start_background_task(task, *args, **kwargs)
+
+        coro = task(*args, **kwargs)
+
+        if self.onLoop():
+            return self.loop.create_task(coro)
+
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def start(self, key, task, *args, **kwargs):
+        """Start a task, see `Task.start()`."""
+        if self.isLocal(key):
+            return False
+
+        self.wakers[key] = asyncio.Event()
+        return super().start(key, task, *args, **kwargs)
+
+    def stop(self, key):
+        """Stop a task, see `Task.stop()`, and wake it up if it is sleeping."""
+        waker = self.wakers.get(key, None)
+        super().stop(key)
+
+        if waker is not None:
+            self.call(waker.set)
+
+    def terminate(self, key):
+        """Terminate the process group of the subprocess of a task, if any.
+
+        If the group has not gone after `killGrace` seconds, it is killed.
+        """
+        proc = self.procs.get(key, None)
+
+        if proc is not None and proc.returncode is None:
+            # the subprocess leads its own process group
+            pgid = proc.pid
+
+            try:
+                os.killpg(pgid, signal.SIGTERM)
+            except ProcessLookupError:
+                return
+
+            self.call(self.escalate, key, pgid)
+
+    def escalate(self, key, pgid):
+        """Set the timer for the kill signal of a terminated process group.
+
+        Call this on the loop.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task.
+        pgid: integer
+            The id of the process group.
+        """
+        if key not in self.killers:
+            self.killers[key] = self.loop.call_later(
+                self.killGrace, self.kill, key, pgid
+            )
+
+    def kill(self, key, pgid):
+        """Send the kill signal to a process group that has outlived its grace."""
+        self.killers.pop(key, None)
+        console(f"kill process group {pgid} of {key}")
+
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def clear(self, key):
+        """Clear a task, see `Task.clear()`."""
+        self.wakers.pop(key, None)
+        super().clear(key)
+
+    async def sleep(self, key, seconds):
+        """Sleep, but wake up as soon as the task is stopped.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task.
+        seconds: float
+            The number of seconds to sleep.
+        """
+        waker = self.wakers.get(key, None)
+
+        if waker is None:
+            await asyncio.sleep(seconds)
+            return
+
+        try:
+            await asyncio.wait_for(waker.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def doTask(self, task, trigger="user"):
+        """Run a task on the loop, see `Task.doTask()`.
+
+        Parameters
+        ----------
+        task: string
+            Either `function`, `script` or `preview`.
+        trigger: string, optional "user"
+            What has started the task.
+        """
+        TM = Timestamp()
+        data = {}
+
+        try:
+            # inside the try: if the log or the history fail, the task must end
+            await self.write(self.begin, task, TM, trigger=trigger)
+
+            if task == "function":
+                (stat, msg) = await self.doFunction(task, TM)
+
+            elif task == "script":
+                self.doScript(task, TM)
+                # the final status is emitted when the subprocess has ended
+                return
+
+            elif task == "preview":
+                dag = Dag(self, task, previewSteps())
+                (stat, msg) = await asyncio.to_thread(dag.run)
+                data = dag.cacheStats()
+
+        except Exception as e:
+            stat = "failure"
+            msg = f"exception script {str(e)}"
+
+        await self.write(self.finish, task, TM, stat, msg, **data)
+
+    async def doFunction(self, task, TM):
+        """Run the function task, see `Task.doFunction()`."""
+        emitter = self.emitter
+
+        errorSteps = {2, 4}
+        longSteps = {8: 5, 9: 8}
+
+        for i in range(1, 11):
+            if self.isStopped(task):
+                # here is the check on the kill signal
+                return ("interrupt", "interrupted by user")
+
+            kind = "error" if i in errorSteps else "info"
+            interval = longSteps.get(i, 1)
+            await self.write(
+                emitter.progress, task, kind, TM.offset(), f"function step {i}"
+            )
+            await self.sleep(task, interval)
+
+        return ("success", "ok")
+
+    def runScript(self, key, command, onLines, onDone):
+        """Start a subprocess for a task on the loop, see `Task.runScript()`."""
+        self.spawn(self.script, key, command, onLines, onDone)
+
+    async def script(self, key, command, onLines, onDone):
+        """Run a subprocess for a task and deliver its output and exit.
+
+        See `runScript()` for the parameters.
+        `onLines` and `onDone` are called in the writer thread, see `write()`.
+        `onDone` is called in all cases, also if something fails after the
+        subprocess has been started.
+        """
+        loop = self.loop
+
+        try:
+            (transport, protocol) = await loop.subprocess_exec(
+                lambda: ExitProtocol(self.chunkSize, loop),
+                *command,
+                start_new_session=True,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            proc = asyncio.subprocess.Process(transport, protocol, loop)
+        except Exception as e:
+            await self.write(onDone, "failure", f"exception script {str(e)}")
+            return
+
+        self.procs[key] = proc
+        self.usage.watch(key, proc.pid)
+
+        if self.isStopped(key):
+            # the kill signal came in while we were starting the process
+            self.terminate(key)
+
+        pumps = [
+            asyncio.create_task(self.pipe(stream, kind, onLines))
+            for (stream, kind) in ((proc.stdout, "info"), (proc.stderr, "error"))
+        ]
+
+        error = None
+
+        try:
+            await self.exited(protocol)
+            (done, pending) = await asyncio.wait(pumps, timeout=self.drainTime)
+
+            for pump in pending:
+                pump.cancel()
+
+            # the last lines of the pipes are delivered before the exit
+            await asyncio.wait(pumps)
+
+            if self.isStopped(key):
+                # the task is only over when all its processes have gone
+                await self.groupGone(proc.pid)
+        except Exception as e:
+            error = f"exception script {str(e)}"
+
+            # do not leave the processes behind
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        finally:
+            self.procs.pop(key, None)
+            killer = self.killers.pop(key, None)
+
+            if killer is not None:
+                killer.cancel()
+
+            try:
+                self.usage.end(key)
+            except Exception as e:
+                # the task must end, even if its usage cannot be measured
+                console(f"usage: error at the end of {key}: {str(e)}")
+
+        returnCode = proc.returncode
+
+        if error is not None:
+            stat = "failure"
+            msg = error
+        elif self.isStopped(key):
+            sys.stdout.write(f"TERMINATED PROCESS: {proc.pid=} {returnCode=}\n")
+            sys.stdout.flush()
+            stat = "interrupt"
+            msg = "interrupted by user"
+        else:
+            stat = "success" if returnCode == 0 else "failure"
+            msg = f"exit with {returnCode}" if returnCode else ""
+
+        await self.write(onDone, stat, msg)
+
+    async def pipe(self, stream, kind, onLines):
+        """Read a pipe of a subprocess until its end, and deliver its lines.
+
+        Parameters
+        ----------
+        stream: object
+            The `asyncio.StreamReader` of the pipe.
+        kind: string
+            The kind of the lines: `info` or `error`.
+        onLines: function
+            Called as `onLines(kind, lines)`, in the writer thread.
+            The next chunk is only read when the lines of the previous one have
+            been delivered, so that a slow disk slows down the reading, instead of
+            filling the memory.
+        """
+        ready = []
+        capture = Capture(None, ready.extend, chunkSize=self.chunkSize)
+
+        async def deliver():
+            if ready:
+                lines = list(ready)
+                ready.clear()
+                await self.write(onLines, kind, lines)
+
+        try:
+            while True:
+                data = await stream.read(self.chunkSize)
+
+                if not data:
+                    break
+
+                capture.feed(data)
+                await deliver()
+        finally:
+            capture.finish()
+            await deliver()
+
+    async def groupGone(self, pgid):
+        """Wait until all processes of a process group have gone.
+
+        Parameters
+        ----------
+        pgid: integer
+            The id of the process group.
+        """
+        while True:
+            try:
+                os.killpg(pgid, 0)
+            except ProcessLookupError:
+                return
+
+            await asyncio.sleep(0.05)
+
+    async def exited(self, protocol):
+        """Wait until a subprocess has exited and has been reaped.
+
+        Parameters
+        ----------
+        protocol: object
+            The `ExitProtocol` of the subprocess.
+        """
+        await protocol.exited
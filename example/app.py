@@ -1,78 +1,107 @@
-import os
-from flask import Flask, render_template, send_file
-from flask_socketio import SocketIO, emit
+import re
+from flask import Flask, render_template, request
+from flask_socketio import SocketIO, emit, join_room
 
+from assets import Assets
+from reports import Reports
 from task import Task
-from helpers import console
+from registry import SqliteRegistry
+from watch import Watcher
+from classify import DEFAULT_RULES
+from helpers import console, taskTable, subscriptions
 
 PORT = 5050
 ASYNC_MODE = "threading"  # N.B. eventlet will not work fully with script tasks
-TASKS = ("function", "script")
+CORPUS = "example"  # the corpus whose tasks are run; part of the room names
+TASKS = ("function", "script", "preview")
+BATCH_WINDOW = 0.25  # seconds that progress lines are collected before emitting
+BATCH_BUDGET = 65536  # characters in a batch that trigger immediate emitting
+LOG_DIR = "logs"  # where the logs of the task runs are stored
+LOG_LIMIT = 1000  # maximum number of log records in a response
+RING_SIZE = 10000  # recent events per task that are replayed to new clients
+CONCURRENCY = 4  # maximum number of tasks that run at the same time
+CLASS_LIMITS = dict(cpu=2, io=4)  # maximum number of running tasks per class
+RESOURCE_CLASSES = dict(function="io", script="cpu", preview="control")
+ASSET_MAX_AGE = 3600  # seconds that clients may cache static files
+ASSET_EXCLUDE = ("logs", "reports", "state", "corpus", "work")  # not precompressed
+REPORT_DIR = "reports"  # where the tasks write their reports
+REPORT_LIMIT = 1000  # maximum number of report lines in a response
+REGISTRY = None  # path of an SQLite registry shared by several workers, if any
+HISTORY_PATH = "state/history.db"  # where the history of the runs is kept
+HISTORY_LIMIT = 100  # maximum number of runs in a response
+RULES = DEFAULT_RULES  # how the output lines of the corpus are classified
+KILL_GRACE = 5.0  # seconds between terminating and killing a stopped task
+WATCH_DIR = None  # directory of the corpus sources whose changes trigger a preview
+WATCH_DEBOUNCE = 2.0  # quiet seconds that end a burst of changes
+CACHE_DIR = "state/cache"  # where the outputs of workflow steps are cached
+CACHE_BUDGET = 1 << 30  # maximum number of bytes in the step cache
 
 
 # Creating a flask app and using it to instantiate a socket object
 app = Flask(__name__)
 socketio = SocketIO(app, logger=True, engineio_logger=True, async_mode=ASYNC_MODE)
-TT = Task(socketio)
+TT = Task(
+    socketio,
+    batchWindow=BATCH_WINDOW,
+    batchBudget=BATCH_BUDGET,
+    logDir=LOG_DIR,
+    ringSize=RING_SIZE,
+    concurrency=CONCURRENCY,
+    classLimits=CLASS_LIMITS,
+    resourceClasses=RESOURCE_CLASSES,
+    corpus=CORPUS,
+    registry=None if REGISTRY is None else SqliteRegistry(REGISTRY),
+    historyPath=HISTORY_PATH,
+    rules=RULES,
+    killGrace=KILL_GRACE,
+    cacheDir=CACHE_DIR,
+    cacheBudget=CACHE_BUDGET,
+)
+ASSETS = Assets(".", maxAge=ASSET_MAX_AGE, exclude=ASSET_EXCLUDE)
+
+
+def onCorpusChange(paths):
+    """Run the preview after a burst of changes in the corpus sources."""
+    console(f"{len(paths)} changed file(s) in {WATCH_DIR}")
+    TT.requestRun("preview", trigger="watch")
+
+
+if WATCH_DIR is not None:
+    Watcher(socketio, WATCH_DIR, onCorpusChange, debounce=WATCH_DEBOUNCE).start()
+
+REPORTS = Reports(REPORT_DIR)
+
+
+def intArg(name):
+    """Get a request argument as integer, None if it is absent or not a number."""
+    value = request.args.get(name, None)
+    return None if value is None or not value.isdecimal() else int(value)
 
 
 @app.route("/")
 def index():
     """Create the HTML for a task runner.
 
-    We create buttons to run and kill two tasks,
+    We create buttons to run and kill each task,
     plus areas where the progress and status of each task are collected.
     """
-    buttons = ["", ""]
-    status = ["", ""]
-    progress = ["", ""]
-
-    for i, task in enumerate(TASKS):
-        buttons[i] = (
-            f"""
-            <button id="run{task}" type="button">Run {task}</button>
-            <button id="kill{task}" type="button">kill {task}</button>
-            """
-        )
-        progress[i] = (
-            f"""
-            <div id="progress{task}" class="msg"></div>
-            """
-        )
-        status[i] = (
-            f"""
-            <div id="status{task}" class="msg">not yet done</div>
-            """
-        )
-
-    effects = f"""
-        <table border=1>
-            <tr>
-                <th>{buttons[0]}</th>
-                <th>{buttons[1]}</th>
-            <tr>
-                <td class="progress">{progress[0]}</td>
-                <td>{progress[1]}</td>
-            </tr>
-            <tr>
-                <td>{status[0]}</td>
-                <td>{status[1]}</td>
-            </tr>
-        </table>
-        """
-
-    return render_template("index.html", buttons=buttons, effects=effects)
+    return render_template("index.html", effects=taskTable(TASKS))
 
 
 @app.route("/run/<string:task>/", methods=["GET", "POST"])
 def run(task):
     """Reponds to clicking the run button of a specific task."""
-    if TT.isIdle(task):
+    if task not in TASKS:
+        stat = "start-prevented"
+        msg = "no such task"
+
+    elif (stat := TT.requestRun(task)) == "start-issued":
         console(f"start {task}")
-        stat = "start-issued"
         msg = "about to start"
 
-        TT.startTask(task)
+    elif stat == "start-coalesced":
+        console(f"follow-up {task}")
+        msg = "will run again after the current run"
 
     else:
         console("suppress workflow")
@@ -90,29 +119,169 @@ def kill(task):
         msg = "not running"
     else:
         TT.stop(task)
-        socketio.emit("status", dict(stat="kill", task=task, msg="kill signalled"))
+        TT.emitter.status(task, stat="kill", msg="kill signalled")
         stat = "kill-issued"
         msg = "about to kill"
 
     return dict(task=task, stat=stat, msg=msg)
 
 
+@app.route("/log/<string:task>/", methods=["GET"])
+def log(task):
+    """Responds to a request for the log of the current or a past run of a task.
+
+    The request arguments select which part of the log is returned:
+
+    *   `run`: the id of the run; default: the latest run;
+    *   `start`, `end`: a range of sequence numbers;
+    *   `tail`: the number of records at the end of the log;
+    *   `severity`: a comma-separated list of kinds: `info`, `error`, `special`;
+    *   `limit`: the maximum number of records.
+    """
+    if task not in TASKS:
+        return dict(task=task, stat="log-prevented", msg="no such task")
+
+    args = request.args
+    severity = args.get("severity", None)
+    limit = intArg("limit")
+    (run, records) = TT.runLog.read(
+        task,
+        run=args.get("run", None),
+        start=intArg("start"),
+        end=intArg("end"),
+        tail=intArg("tail"),
+        kinds=None if severity is None else set(severity.split(",")),
+        limit=LOG_LIMIT if limit is None else min(limit, LOG_LIMIT),
+    )
+
+    return dict(task=task, run=run, runs=TT.runLog.listRuns(task), records=records)
+
+
+@app.route("/report/<string:task>/", methods=["GET"])
+@app.route("/report/<string:task>/<path:name>", methods=["GET"])
+def report(task, name=None):
+    """Responds to a request for (a part of) a report of a task.
+
+    Without a report name, the list of reports of the task is returned.
+    Otherwise the request arguments select which part of the report is returned:
+
+    *   `start`, `count`: a page of lines, by default the first lines;
+    *   `tail`: the number of lines at the end of the report;
+    *   `grep`: a regular expression; only matching lines from `start` on are
+        returned, and `next` tells where to continue;
+    *   `icase`: if `1`, `grep` ignores case;
+    *   `summary`: if `1`, a summary of each column of a CSV or TSV report.
+    """
+    if task not in TASKS:
+        return dict(task=task, stat="report-prevented", msg="no such task")
+
+    if name is None:
+        return dict(task=task, reports=REPORTS.listReports(task))
+
+    args = request.args
+    count = intArg("count")
+    count = REPORT_LIMIT if count is None else min(count, REPORT_LIMIT)
+    pattern = args.get("grep", None)
+
+    if args.get("summary", None) == "1":
+        result = REPORTS.summary(task, name)
+    elif pattern is not None:
+        try:
+            result = REPORTS.grep(
+                task,
+                name,
+                pattern,
+                start=intArg("start") or 0,
+                limit=count,
+                ignoreCase=args.get("icase", None) == "1",
+            )
+        except re.error as e:
+            return dict(task=task, stat="report-prevented", msg=f"bad pattern: {e}")
+    else:
+        tail = intArg("tail")
+        result = REPORTS.page(
+            task,
+            name,
+            start=intArg("start") or 0,
+            count=count,
+            tail=None if tail is None else min(tail, REPORT_LIMIT),
+        )
+
+    if result is None:
+        return dict(task=task, stat="report-prevented", msg="no such report")
+
+    return dict(task=task, name=name, **result)
+
+
+@app.route("/history/", methods=["GET"])
+@app.route("/history/<string:task>/", methods=["GET"])
+def history(task=None):
+    """Responds to a request for the history of runs.
+
+    Without a task, the latest run of every corpus and task is returned.
+    Otherwise the most recent runs of the task, at most `limit`, with their steps.
+    """
+    if TT.history is None:
+        return dict(task=task, stat="history-prevented", msg="no history kept")
+
+    if task is None:
+        return dict(runs=TT.history.latest())
+
+    if task not in TASKS:
+        return dict(task=task, stat="history-prevented", msg="no such task")
+
+    limit = intArg("limit")
+    limit = HISTORY_LIMIT if limit is None else min(limit, HISTORY_LIMIT)
+    return dict(task=task, runs=TT.history.runs(CORPUS, task, limit=limit))
+
+
 @app.route("/<path:path>")
 def staticFile(path):
-    """Serve a static file."""
-    if os.path.exists(path):
-        return send_file(path)
+    """Serve a static file, see `Assets`."""
+    response = ASSETS.serve(path)
+
+    if response is not None:
+        return response
 
     console(f"File not found: {path}")
-    return "xxx"
+    return "xxx", 404
 
 
 @socketio.on("connect")
-def test_connect():
-    """Verify the websocket connection.
+def test_connect(auth=None):
+    """Verify the websocket connection, subscribe it, and replay missed events.
+
+    A client passes in its `auth` data under `tasks` the tasks whose events it
+    wants to receive; it joins the room of each of them, see `Emitter.room()`.
+
+    Under `seen` it passes for each task the run id and sequence number of the
+    last event it has seen.
+    It will be sent the events of the latest run of each of its tasks after that.
+
+    Under `wire` it may ask for the compact encoding of events, see `Wire`;
+    it then joins the compact rooms of its tasks instead.
     """
     emit("after connect", {"data": "Ready to run"})
 
+    seen = (auth or {}).get("seen", None) or {}
+    wire = TT.wire
+    compact = wire.wants(auth)
+
+    if compact:
+        join_room(wire.dictRoom)
+        wire.join(request.sid)
+
+    for task in subscriptions(auth, TASKS):
+        room = TT.emitter.room(task)
+        join_room(wire.enter(request.sid, room, compact))
+        TT.emitter.replay(task, seen.get(task, None), request.sid)
+
+
+@socketio.on("disconnect")
+def test_disconnect(reason=None):
+    """Forget the encoding of a client that has gone."""
+    TT.wire.leave(request.sid)
+
 
 if __name__ == "__main__":
     # start the websocket-enabled flask app
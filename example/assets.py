@@ -0,0 +1,554 @@
+"""Serve static files with validators, caching and byte ranges.
+
+Files such as `jquery.js`, `socket.io.min.js` and style sheets are requested on
+every page load, by every client. Report files may be large.
+Instead of sending all of them in full every time, the `Assets` object
+
+*   keeps the stat results of files in memory for a short while;
+*   gives every file an ETag based on a hash of its content, and answers
+    with `304 Not Modified` if the client already has that content;
+*   lets clients cache files for a while, without asking at all;
+*   sends gzip or, if the `brotli` module is installed, brotli compressed
+    variants of text files to clients that accept them; a variant is made
+    when it is first asked for, with a fast compression level, and kept in
+    memory, within a budget, from which the least recently used variants are
+    evicted; only the small static files that are present at startup are
+    compressed thoroughly, at startup;
+*   supports requests for a byte range of a file, so that clients can fetch
+    parts of a large report; ranges are always taken from the file itself, not
+    from a compressed variant;
+*   refuses to serve files outside its root directory.
+"""
+
+import os
+import gzip
+import time
+import stat
+import hashlib
+import mimetypes
+from threading import Lock
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+
+from flask import Response, request
+from werkzeug.security import safe_join
+from werkzeug.wsgi import wrap_file
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = (".js", ".css", ".map", ".html", ".json", ".txt", ".svg", ".csv", ".tsv")
+EXCLUDE = (".git", "__pycache__")
+ENCODINGS = ("gzip",) if brotli is None else ("br", "gzip")
+CHUNK_SIZE = 65536
+
+
+def parseTags(header):
+    """Parse the value of an `If-None-Match` or `If-Range` header into etags.
+
+    Weak etags are reduced to their strong form, because we only use the
+    result for weak comparison.
+    """
+    return {
+        tag.strip().removeprefix("W/") for tag in header.split(",") if tag.strip()
+    }
+
+
+def parseEncodings(header):
+    """The encodings that a client accepts, according to `Accept-Encoding`."""
+    encodings = set()
+
+    for part in header.split(","):
+        (name, *params) = part.strip().split(";")
+        q = 1.0
+
+        for param in params:
+            (key, eq, value) = param.strip().partition("=")
+
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+
+        if name and q > 0:
+            encodings.add(name.strip().lower())
+
+    return encodings
+
+
+def parseRange(header, size):
+    """Parse a `Range` header for a single byte range.
+
+    Parameters
+    ----------
+    header: string
+        The value of the header.
+    size: integer
+        The size of the file.
+
+    Returns
+    -------
+    tuple or boolean or None
+        The first and last byte of the range, both inclusive;
+        False if the range cannot be satisfied;
+        None if the header asks for something else than a single byte range,
+        in which case the whole file should be sent.
+    """
+    (unit, eq, spec) = header.partition("=")
+
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+
+    (first, dash, last) = spec.strip().partition("-")
+
+    try:
+        if first == "":
+            length = int(last)
+            (first, last) = (max(size - length, 0), size - 1)
+        else:
+            first = int(first)
+            last = size - 1 if last == "" else min(int(last), size - 1)
+    except ValueError:
+        return None
+
+    if first > last or first >= size:
+        return False
+
+    return (first, last)
+
+
+def readRange(path, first, length):
+    """Read a part of a file, in chunks."""
+    with open(path, "rb") as fh:
+        fh.seek(first)
+
+        while length > 0:
+            data = fh.read(min(CHUNK_SIZE, length))
+
+            if not data:
+                break
+
+            length -= len(data)
+            yield data
+
+
+class Assets:
+    """Serve the files below a directory."""
+
+    def __init__(
+        self,
+        root,
+        maxAge=3600,
+        statTtl=1.0,
+        minCompress=1024,
+        maxCompress=8388608,
+        maxPrecompress=1048576,
+        maxHash=67108864,
+        variantBudget=67108864,
+        exclude=(),
+    ):
+        """Create an asset server and precompress the small files that are present.
+
+        Parameters
+        ----------
+        root: string
+            The directory whose files are served.
+        maxAge: integer, optional 3600
+            The number of seconds that clients may use a file without
+            asking again.
+        statTtl: float, optional 1.0
+            The number of seconds that the stat result of a file is used before
+            the file is looked at again.
+        minCompress: integer, optional 1024
+            Files smaller than this are not compressed.
+        maxCompress: integer, optional 8388608
+            Files larger than this are not compressed.
+        maxPrecompress: integer, optional 1048576
+            Files larger than this are not compressed at startup, but when they
+            are first asked for.
+        maxHash: integer, optional 67108864
+            Files larger than this do not get a content hash as ETag, but a weak
+            ETag based on their size and modification time.
+        variantBudget: integer, optional 67108864
+            The maximum number of bytes of compressed variants that are kept in
+            memory.
+        exclude: iterable of string, optional ()
+            The names of directories whose files are not precompressed, such as
+            the directories where the tasks write their logs and reports, next
+            to `EXCLUDE`. Their files are still served.
+        """
+        self.root = os.path.realpath(root)
+        self.maxAge = maxAge
+        self.statTtl = statTtl
+        self.minCompress = minCompress
+        self.maxCompress = maxCompress
+        self.maxPrecompress = maxPrecompress
+        self.maxHash = maxHash
+        self.exclude = set(EXCLUDE) | set(exclude)
+        self.variantBudget = variantBudget
+        self.cache = {}
+        self.variants = OrderedDict()
+        self.variantSize = 0
+        self.cacheLock = Lock()
+        self.build()
+
+    def build(self):
+        """Make the compressed variants of the small files that are present now.
+
+        These are the static files that every client asks for, so they are
+        compressed with the best compression levels.
+        """
+        root = self.root
+        exclude = self.exclude
+
+        for path, dirs, files in os.walk(root):
+            dirs[:] = [d for d in dirs if d not in exclude]
+
+            for name in files:
+                if not name.endswith(COMPRESSIBLE):
+                    continue
+
+                entry = self.entry(os.path.relpath(f"{path}/{name}", root))
+
+                if entry is None or entry["size"] > self.maxPrecompress:
+                    continue
+
+                for encoding in ENCODINGS:
+                    self.variant(entry, encoding, best=True)
+
+    def resolve(self, relPath):
+        """The full path of a file, or None if it is not below the root."""
+        path = safe_join(self.root, relPath)
+
+        if path is None:
+            return None
+
+        realPath = os.path.realpath(path)
+
+        if os.path.commonpath((self.root, realPath)) != self.root:
+            return None
+
+        return realPath
+
+    def entry(self, relPath):
+        """Get the cached information about a file, refreshing it if needed.
+
+        Parameters
+        ----------
+        relPath: string
+            The path of the file relative to the root.
+
+        Returns
+        -------
+        dict or None
+            With keys `path`, `size`, `mtime`, `checked`, `etag`, `strong`,
+            `mimetype`, `compressible`. None if there is no such file.
+        """
+        now = time.monotonic()
+
+        with self.cacheLock:
+            entry = self.cache.get(relPath, None)
+
+        if entry is not None and now - entry["checked"] < self.statTtl:
+            return entry
+
+        path = self.resolve(relPath)
+
+        try:
+            st = None if path is None else os.stat(path)
+        except OSError:
+            st = None
+
+        if st is None or not stat.S_ISREG(st.st_mode):
+            with self.cacheLock:
+                self.cache.pop(relPath, None)
+
+            return None
+
+        if (
+            entry is not None
+            and entry["size"] == st.st_size
+            and entry["mtime"] == st.st_mtime_ns
+        ):
+            entry["checked"] = now
+            return entry
+
+        entry = self.make(path, st)
+        entry["checked"] = now
+
+        with self.cacheLock:
+            self.cache[relPath] = entry
+
+        return entry
+
+    def make(self, path, st):
+        """Hash a file.
+
+        Its compressed variants are made when they are asked for,
+        see `variant()`.
+
+        Parameters
+        ----------
+        path: string
+            The full path of the file.
+        st: object
+            The stat result of the file.
+
+        Returns
+        -------
+        dict
+            See `entry()`.
+        """
+        size = st.st_size
+        compressible = path.endswith(COMPRESSIBLE) and (
+            self.minCompress <= size <= self.maxCompress
+        )
+
+        if size <= self.maxHash:
+            with open(path, "rb") as fh:
+                digest = hashlib.file_digest(
+                    fh, lambda: hashlib.blake2b(digest_size=16)
+                ).hexdigest()
+        else:
+            digest = None
+
+        strong = digest is not None
+        etag = digest if strong else f"{size:x}-{st.st_mtime_ns:x}"
+        (mimetype, encoding) = mimetypes.guess_type(path)
+
+        return dict(
+            path=path,
+            size=size,
+            mtime=st.st_mtime_ns,
+            etag=etag,
+            strong=strong,
+            mimetype=mimetype or "application/octet-stream",
+            compressible=compressible,
+        )
+
+    def variantKey(self, entry, encoding):
+        """The key of a compressed variant of a file in the memory cache."""
+        return (entry["path"], entry["etag"], encoding)
+
+    def variant(self, entry, encoding, best=False):
+        """Get a compressed variant of a file, making it if needed.
+
+        Parameters
+        ----------
+        entry: dict
+            The information about the file, see `entry()`.
+        encoding: string
+            The encoding: `br` or `gzip`.
+        best: boolean, optional False
+            Whether the variant is made with the best compression level instead
+            of a fast one.
+
+        Returns
+        -------
+        bytes or None
+            None if the file is not compressed in this encoding, or if that
+            does not make it smaller.
+        """
+        if not entry["compressible"] or encoding not in ENCODINGS:
+            return None
+
+        key = self.variantKey(entry, encoding)
+        variants = self.variants
+
+        with self.cacheLock:
+            if key in variants:
+                variants.move_to_end(key)
+                return variants[key]
+
+        with open(entry["path"], "rb") as fh:
+            data = fh.read()
+
+        if len(data) != entry["size"]:
+            # the file has changed since it has been hashed
+            return None
+
+        if encoding == "gzip":
+            packed = gzip.compress(data, compresslevel=9 if best else 6, mtime=0)
+        else:
+            packed = brotli.compress(data, quality=11 if best else 5)
+
+        packed = packed if len(packed) < len(data) else None
+        self.keep(key, packed)
+        return packed
+
+    def keep(self, key, packed):
+        """Keep a compressed variant in memory, within the budget.
+
+        The least recently used variants are evicted to make room.
+        A variant that is larger than the whole budget is not kept.
+
+        Parameters
+        ----------
+        key: tuple
+            The key of the variant, see `variantKey()`.
+        packed: bytes or None
+            The variant; None if compression does not make the file smaller,
+            which is remembered as well.
+        """
+        size = 0 if packed is None else len(packed)
+
+        if size > self.variantBudget:
+            return
+
+        variants = self.variants
+
+        with self.cacheLock:
+            old = variants.pop(key, None)
+            self.variantSize += size - (0 if old is None else len(old))
+            variants[key] = packed
+
+            while self.variantSize > self.variantBudget:
+                (evicted, old) = variants.popitem(last=False)
+                self.variantSize -= 0 if old is None else len(old)
+
+    def serve(self, relPath):
+        """Make the response for a request for a file.
+
+        Parameters
+        ----------
+        relPath: string
+            The path of the file relative to the root.
+
+        Returns
+        -------
+        object or None
+            The response, or None if there is no such file below the root.
+        """
+        entry = self.entry(relPath)
+
+        if entry is None:
+            return None
+
+        headers = request.headers
+        variants = self.variants
+        accepted = parseEncodings(headers.get("Accept-Encoding", ""))
+        encoding = None
+
+        if entry["compressible"] and "Range" not in headers:
+            # skip the encodings that are known not to make the file smaller;
+            # ranges are served from the file itself
+            encoding = next(
+                (
+                    enc
+                    for enc in ENCODINGS
+                    if enc in accepted
+                    and variants.get(self.variantKey(entry, enc), True) is not None
+                ),
+                None,
+            )
+
+        response = Response(mimetype=entry["mimetype"])
+        self.setTag(response, entry, encoding)
+        response.headers["Last-Modified"] = formatdate(
+            entry["mtime"] / 1e9, usegmt=True
+        )
+        response.headers["Cache-Control"] = f"public, max-age={self.maxAge}"
+
+        if entry["compressible"]:
+            response.headers["Vary"] = "Accept-Encoding"
+
+        if self.isFresh(entry, self.tag(entry, encoding)):
+            response.status_code = 304
+            return response
+
+        if encoding is not None:
+            packed = self.variant(entry, encoding)
+
+            if packed is not None:
+                response.headers["Content-Encoding"] = encoding
+                response.set_data(packed)
+                return response
+
+            # compression does not help: send the file itself
+            self.setTag(response, entry, None)
+
+        response.headers["Accept-Ranges"] = "bytes"
+        path = entry["path"]
+        size = entry["size"]
+        byteRange = self.wantedRange(entry)
+
+        if byteRange is False:
+            response.status_code = 416
+            response.headers["Content-Range"] = f"bytes */{size}"
+            return response
+
+        if byteRange is None:
+            response.response = wrap_file(request.environ, open(path, "rb"))
+            response.headers["Content-Length"] = str(size)
+        else:
+            (first, last) = byteRange
+            length = last - first + 1
+            response.status_code = 206
+            response.response = readRange(path, first, length)
+            response.headers["Content-Range"] = f"bytes {first}-{last}/{size}"
+            response.headers["Content-Length"] = str(length)
+
+        response.direct_passthrough = True
+        return response
+
+    def tag(self, entry, encoding):
+        """The ETag of a file in an encoding, without quotes."""
+        etag = entry["etag"]
+        return etag if encoding is None else f"{etag}-{encoding}"
+
+    def setTag(self, response, entry, encoding):
+        """Set the ETag header of a response for a file in an encoding."""
+        tag = self.tag(entry, encoding)
+        response.headers["ETag"] = f'"{tag}"' if entry["strong"] else f'W/"{tag}"'
+
+    def isFresh(self, entry, tag):
+        """Whether the client already has the current content of a file."""
+        headers = request.headers
+        ifNoneMatch = headers.get("If-None-Match", None)
+
+        if ifNoneMatch is not None:
+            tags = parseTags(ifNoneMatch)
+            return "*" in tags or f'"{tag}"' in tags
+
+        ifModifiedSince = headers.get("If-Modified-Since", None)
+
+        if ifModifiedSince is None:
+            return False
+
+        try:
+            since = parsedate_to_datetime(ifModifiedSince).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+        return entry["mtime"] // 1000000000 <= since
+
+    def wantedRange(self, entry):
+        """The byte range that the client asks for, see `parseRange()`.
+
+        A range is only honoured if the `If-Range` condition, if any, holds.
+        """
+        headers = request.headers
+        rangeHeader = headers.get("Range", None)
+
+        if rangeHeader is None:
+            return None
+
+        ifRange = headers.get("If-Range", None)
+
+        if ifRange is not None:
+            if ifRange.startswith(('"', "W/")):
+                if not entry["strong"] or ifRange.strip() != f'"{entry["etag"]}"':
+                    return None
+            else:
+                try:
+                    since = parsedate_to_datetime(ifRange).timestamp()
+                except (TypeError, ValueError):
+                    return None
+
+                if entry["mtime"] // 1000000000 != int(since):
+                    return None
+
+        return parseRange(rangeHeader, entry["size"])
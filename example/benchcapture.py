@@ -0,0 +1,175 @@
+"""Measure the throughput of capturing the output of a subprocess.
+
+We run `noisy.py` and capture its stdout and stderr in two ways:
+
+*   `legacy`: the way the script task used to do it: text mode pipes, a
+    `select` with a timeout of 0.5 seconds, and one `readline()` per ready stream
+    per iteration, followed by a `read()` of the complete remainder;
+*   `chunked`: the way the reactor does it: binary pipes, a selector, and a
+    `Capture` per stream that reads large chunks and decodes them incrementally.
+
+For each method we report lines per second and megabytes per second, as JSON.
+
+Usage:
+
+    python benchcapture.py [--lines N] [--size S] [--errors F] [--repeat R]
+"""
+
+import os
+import sys
+import json
+import time
+import select
+import argparse
+import selectors
+from subprocess import Popen, PIPE
+
+from capture import Capture
+from noisy import makeLine
+
+
+def startNoisy(args, text):
+    """Start the noisy script with the parameters of the benchmark."""
+    return Popen(
+        [
+            sys.executable,
+            "noisy.py",
+            "--lines",
+            str(args.lines),
+            "--size",
+            str(args.size),
+            "--errors",
+            str(args.errors),
+        ],
+        shell=False,
+        text=text,
+        bufsize=None if text else 0,
+        stdout=PIPE,
+        stderr=PIPE,
+    )
+
+
+def captureLegacy(args):
+    """Capture the output as the script task did before the reactor.
+
+    Returns
+    -------
+    integer
+        The number of lines captured.
+    """
+    proc = startNoisy(args, True)
+    nLines = 0
+
+    def flush(toEnd=False):
+        nonlocal nLines
+
+        readyStreams = select.select([proc.stdout, proc.stderr], [], [], 0.5)[0]
+
+        for stream in readyStreams:
+            text = stream.read() if toEnd else stream.readline()
+
+            if not text:
+                continue
+
+            nLines += text.count("\n")
+
+    while True:
+        flush()
+
+        if proc.poll() is not None:
+            break
+
+    flush(toEnd=True)
+    proc.stdout.close()
+    proc.stderr.close()
+    return nLines
+
+
+def captureChunked(args):
+    """Capture the output with a selector and chunked captures.
+
+    Returns
+    -------
+    integer
+        The number of lines captured.
+    """
+    proc = startNoisy(args, False)
+    selector = selectors.DefaultSelector()
+    nLines = 0
+
+    def onLines(lines):
+        nonlocal nLines
+        nLines += len(lines)
+
+    for stream in (proc.stdout, proc.stderr):
+        fd = stream.fileno()
+        os.set_blocking(fd, False)
+        capture = Capture(fd, onLines)
+        selector.register(fd, selectors.EVENT_READ, capture)
+
+    while selector.get_map():
+        for key, mask in selector.select():
+            capture = key.data
+
+            if capture.read() is None:
+                selector.unregister(capture.fd)
+                capture.finish()
+
+    proc.wait()
+    proc.stdout.close()
+    proc.stderr.close()
+    return nLines
+
+
+METHODS = dict(legacy=captureLegacy, chunked=captureChunked)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark output capture")
+    parser.add_argument("--lines", type=int, default=100000)
+    parser.add_argument("--size", type=int, default=80)
+    parser.add_argument("--errors", type=float, default=0.1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--methods", default="legacy,chunked")
+    args = parser.parse_args()
+
+    # both methods capture the same output, so we compute its size in bytes once
+    nBytes = sum(
+        len(makeLine(i, args.size).encode("utf8")) for i in range(1, args.lines + 1)
+    )
+    results = []
+
+    for method in args.methods.split(","):
+        capture = METHODS[method]
+        best = None
+
+        for r in range(args.repeat):
+            start = time.perf_counter()
+            nLines = capture(args)
+            seconds = time.perf_counter() - start
+
+            if best is None or seconds < best[0]:
+                best = (seconds, nLines)
+
+        (seconds, nLines) = best
+        results.append(
+            dict(
+                method=method,
+                lines=nLines,
+                expected=args.lines,
+                seconds=round(seconds, 4),
+                linesPerSec=round(nLines / seconds),
+                mbPerSec=round(nBytes / seconds / 1e6, 2),
+            )
+        )
+
+    json.dump(
+        dict(lines=args.lines, size=args.size, errors=args.errors, results=results),
+        sys.stdout,
+        indent=2,
+    )
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+"""Measure how fast the output of a script task reaches a client, per async mode.
+
+For every combination of async mode (`threading`, `eventlet`, `gevent`) and
+message queue use (`queue`: emit via the queue, `direct`: `ignore_queue=True`),
+we start a server in a separate process, connect to it with a Socket.IO client,
+and let it run a script task with `noisy.py --stamp`.
+Every line of that script starts with the time at which it was written, so the
+client can compute for every line how long it took to arrive.
+
+We report, as JSON:
+
+*   the percentiles of that latency;
+*   the throughput in lines and megabytes per second;
+*   the CPU time used by the server process during the task.
+
+Note that `ignore_queue` only makes a difference if the server has a message
+queue, see `--message-queue`. Modes whose package is not installed are reported
+with an error.
+
+Usage:
+
+    python benchemit.py [--modes M,...] [--queue both|queue|direct]
+                        [--lines N] [--size S] [--rate R] [--errors F]
+                        [--window W] [--message-queue URL] [--timeout T]
+                        [--out FILE]
+
+The server side is run as:
+
+    python benchemit.py serve --mode M --port P [--direct] [--window W]
+                              [--message-queue URL]
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+from subprocess import Popen, DEVNULL
+from urllib.request import Request, urlopen
+
+MODES = ("threading", "eventlet", "gevent")
+PERCENTILES = (50, 90, 99)
+TASK = "bench"
+
+
+def serve(args):
+    """Run the server side of the benchmark.
+
+    The async mode packages need to patch the standard library before anything
+    else is imported, so all imports happen in here.
+    """
+    if args.mode == "eventlet":
+        import eventlet
+
+        eventlet.monkey_patch()
+    elif args.mode == "gevent":
+        from gevent import monkey
+
+        monkey.patch_all()
+
+    import resource
+    import tempfile
+    from flask import Flask, request
+    from flask_socketio import SocketIO, join_room
+
+    from helpers import Timestamp
+    from task import Task
+
+    class Direct:
+        """Pass `ignore_queue=True` to every emit of a socketio object."""
+
+        def __init__(self, socketio):
+            self.socketio = socketio
+
+        def emit(self, *args, **kwargs):
+            self.socketio.emit(*args, ignore_queue=True, **kwargs)
+
+        def __getattr__(self, name):
+            return getattr(self.socketio, name)
+
+    app = Flask(__name__)
+    socketio = SocketIO(
+        app, async_mode=args.mode, message_queue=args.message_queue or None
+    )
+    TT = Task(
+        Direct(socketio) if args.direct else socketio,
+        batchWindow=args.window,
+        logDir=tempfile.mkdtemp(prefix="benchemit-"),
+        historyPath=None,
+        cacheDir=None,
+    )
+
+    def runBench(key, command):
+        TM = Timestamp()
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        TT.emitter.begin(key)
+        TT.emitter.status(key, tm=TM.offset(), stat="start")
+
+        def onLines(kind, lines):
+            TT.emitter.progressLines(key, kind, TM.offset(), lines)
+
+        def onDone(stat, msg):
+            after = resource.getrusage(resource.RUSAGE_SELF)
+            server = dict(
+                cpuUser=round(after.ru_utime - before.ru_utime, 3),
+                cpuSys=round(after.ru_stime - before.ru_stime, 3),
+            )
+            TT.finish(key, TM, stat, msg, server=server)
+
+        TT.runScript(key, command, onLines, onDone)
+
+    @socketio.on("connect")
+    def connect(auth=None):
+        join_room(TT.emitter.room(TASK))
+
+    @app.route("/bench/run", methods=["POST"])
+    def run():
+        params = request.get_json()
+        command = [sys.executable, "noisy.py", "--stamp"]
+
+        for name in ("lines", "size", "rate", "errors"):
+            command.extend([f"--{name}", str(params[name])])
+
+        if not TT.isIdle(TASK):
+            return dict(stat="start-prevented")
+
+        TT.start(TASK, runBench, TASK, command)
+        return dict(stat="start-issued")
+
+    socketio.run(app, port=args.port, allow_unsafe_werkzeug=True)
+
+
+def freePort():
+    """Find a free TCP port on localhost."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def waitForPort(port, proc, timeout):
+    """Wait until a server accepts connections, or has died, or time is up."""
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline and proc.poll() is None:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+
+    return False
+
+
+def percentile(values, p):
+    """The p-th percentile of sorted values, by the nearest rank method."""
+    if not values:
+        return None
+
+    return values[max(0, min(len(values) - 1, -(-len(values) * p // 100) - 1))]
+
+
+def runOne(args, mode, direct):
+    """Benchmark one combination of async mode and queue use.
+
+    Returns
+    -------
+    dict
+        The measurements, or the error that prevented them.
+    """
+    import socketio
+
+    result = dict(mode=mode, queue="direct" if direct else "queue")
+    port = freePort()
+    command = [
+        sys.executable,
+        "benchemit.py",
+        "serve",
+        "--mode",
+        mode,
+        "--port",
+        str(port),
+        "--window",
+        str(args.window),
+    ]
+
+    if direct:
+        command.append("--direct")
+
+    if args.message_queue:
+        command.extend(["--message-queue", args.message_queue])
+
+    server = Popen(command, stdout=DEVNULL, stderr=DEVNULL)
+    latencies = []
+    nBytes = 0
+    final = {}
+    done = None
+
+    try:
+        if not waitForPort(port, server, args.timeout):
+            result["error"] = f"server did not start (exit {server.poll()})"
+            return result
+
+        client = socketio.Client()
+
+        @client.on("progress")
+        def progress(msg):
+            nonlocal nBytes
+            received = time.time()
+
+            if msg["task"] != TASK:
+                return
+
+            for n, tm, text in msg["lines"]:
+                latencies.append(received - float(text.split(" ", 1)[0]))
+                nBytes += len(text.encode("utf-8")) + 1
+
+        @client.on("status")
+        def status(msg):
+            nonlocal done
+
+            stat = msg["stat"]
+
+            # a run with warnings or errors ends as success-warnings
+            if msg["task"] == TASK and (
+                stat.startswith("success") or stat in {"failure", "interrupt"}
+            ):
+                final.update(msg)
+                done = time.time()
+
+        client.connect(f"http://127.0.0.1:{port}", transports=["websocket"])
+        body = dict(
+            lines=args.lines, size=args.size, rate=args.rate, errors=args.errors
+        )
+        request = Request(
+            f"http://127.0.0.1:{port}/bench/run",
+            data=json.dumps(body).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        start = time.time()
+
+        with urlopen(request, timeout=args.timeout) as response:
+            json.load(response)
+
+        deadline = time.monotonic() + args.timeout
+
+        while done is None and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        client.disconnect()
+
+        if done is None:
+            result["error"] = f"no final status within {args.timeout} seconds"
+
+        seconds = (done or time.time()) - start
+        latencies.sort()
+        result.update(
+            lines=len(latencies),
+            expected=args.lines,
+            seconds=round(seconds, 3),
+            linesPerSec=round(len(latencies) / seconds),
+            mbPerSec=round(nBytes / seconds / 1e6, 3),
+            latency={
+                f"p{p}": None if not latencies else round(percentile(latencies, p), 4)
+                for p in PERCENTILES
+            }
+            | dict(max=round(latencies[-1], 4) if latencies else None),
+            server=final.get("server", None),
+            script=final.get("usage", None),
+        )
+    except Exception as e:
+        result["error"] = str(e)
+    finally:
+        server.terminate()
+        server.wait()
+
+    return result
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        parser = argparse.ArgumentParser(description="benchmark server")
+        parser.add_argument("serve")
+        parser.add_argument("--mode", choices=MODES, default="threading")
+        parser.add_argument("--port", type=int, required=True)
+        parser.add_argument("--direct", action="store_true")
+        parser.add_argument("--window", type=float, default=0.25)
+        parser.add_argument("--message-queue", default=None)
+        serve(parser.parse_args())
+        return
+
+    parser = argparse.ArgumentParser(description="benchmark emitting script output")
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--queue", choices=("both", "queue", "direct"), default="both")
+    parser.add_argument("--lines", type=int, default=20000)
+    parser.add_argument("--size", type=int, default=80)
+    parser.add_argument("--rate", type=float, default=5000)
+    parser.add_argument("--errors", type=float, default=0.1)
+    parser.add_argument("--window", type=float, default=0.25)
+    parser.add_argument("--message-queue", default=None)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--out", default=None)
+    args = parser.parse_args()
+
+    directs = dict(both=(False, True), queue=(False,), direct=(True,))[args.queue]
+    results = [
+        runOne(args, mode, direct)
+        for mode in args.modes.split(",")
+        for direct in directs
+    ]
+    report = dict(
+        time=time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        python=platform.python_version(),
+        host=platform.node(),
+        cpus=os.cpu_count(),
+        params=dict(
+            lines=args.lines,
+            size=args.size,
+            rate=args.rate,
+            errors=args.errors,
+            window=args.window,
+            messageQueue=args.message_queue,
+        ),
+        results=results,
+    )
+
+    if args.out is None:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.out, "w") as fh:
+            json.dump(report, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,435 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import sqlite3
+import hashlib
+import importlib.util
+from contextlib import closing
+
+FICLONE = 0x40049409  # the Linux ioctl that makes a copy-on-write clone of a file
+CHUNK = 1 << 20  # bytes read at a time when hashing files
+
+
+def place(src, dst):
+    """Make a file available under a new path, without copying it if possible.
+
+    We try, in this order, a hard link, a copy-on-write clone (reflink), and an
+    ordinary copy.
+
+    Parameters
+    ----------
+    src: string
+        The existing file.
+    dst: string
+        The new path.
+    """
+    try:
+        os.link(src, dst)
+        return dst
+    except OSError:
+        pass
+
+    try:
+        with open(src, "rb") as fi, open(dst, "wb") as fo:
+            fcntl.ioctl(fo.fileno(), FICLONE, fi.fileno())
+
+        shutil.copystat(src, dst)
+        return dst
+    except OSError:
+        pass
+
+    return shutil.copy2(src, dst)
+
+
+def remove(path):
+    """Remove a file or directory tree, if it exists."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def treeSize(path):
+    """The number of bytes in the files of a file or directory tree."""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+
+    return sum(
+        os.path.getsize(f"{root}/{name}")
+        for (root, dirs, files) in os.walk(path)
+        for name in files
+    )
+
+
+def codeFiles(step):
+    """The files whose contents make up the code version of a step.
+
+    If the step does not declare them, they are the source file of its function,
+    or the arguments of its command that are existing files; for a converter
+    argument `module:function`, the source file of the module is added.
+
+    Parameters
+    ----------
+    step: object
+        The `Step`.
+
+    Returns
+    -------
+    list of string
+    """
+    if step.code:
+        return list(step.code)
+
+    if step.function is not None:
+        module = importlib.util.find_spec(step.function.__module__)
+        return [] if module is None or module.origin is None else [module.origin]
+
+    files = []
+
+    for arg in step.command[1:]:
+        if os.path.isfile(arg):
+            files.append(arg)
+        elif ":" in arg:
+            spec = importlib.util.find_spec(arg.split(":", 1)[0])
+
+            if spec is not None and spec.origin is not None:
+                files.append(spec.origin)
+
+    return files
+
+
+class StepCache:
+    """A content-addressed store of the outputs of workflow steps.
+
+    A step that declares its outputs, see `Step`, can be cached. Its cache key is
+    a hash of
+
+    *   the contents of its inputs, with their paths relative to the input
+        directories, so that corpora in different places with the same contents
+        have the same key;
+    *   the contents of its code, see `codeFiles()`;
+    *   its parameters.
+
+    If the key is in the store, the step is not run, but its outputs are
+    restored from the store. Otherwise the step runs, and its outputs are stored
+    under the key when it succeeds.
+
+    Files are put in the store and restored from it by hard links where
+    possible, see `place()`, so storing and restoring costs hardly any time or
+    space. That is why the outputs of a step are removed before it runs: the
+    step then writes new files, and never changes the files that the store
+    shares with a previous run.
+
+    The store has a budget in bytes. When it is exceeded, the entries that have
+    been used least recently are evicted.
+
+    The index of the store is an SQLite database, so that several workers can
+    share the store. The digests of input files are remembered there as well,
+    by path, size, modification time and inode, so that unchanged files are not
+    read again.
+    """
+
+    def __init__(self, root, budget=1 << 30, timeout=10.0):
+        """Open or create a store.
+
+        Parameters
+        ----------
+        root: string
+            The directory of the store.
+        budget: integer, optional 1 GiB
+            The maximum number of bytes in the store.
+        timeout: float, optional 10.0
+            The number of seconds to wait for a lock on the index.
+        """
+        self.root = root
+        self.budget = budget
+        self.timeout = timeout
+        self.path = f"{root}/index.db"
+        os.makedirs(f"{root}/objects", exist_ok=True)
+
+        with self.connect() as db:
+            db.execute("pragma journal_mode=wal")
+            db.execute(
+                """
+                create table if not exists entries (
+                    key text primary key,
+                    size integer not null,
+                    created real not null,
+                    used real not null,
+                    hits integer not null default 0
+                )
+                """
+            )
+            db.execute("create index if not exists entriesByUse on entries (used)")
+            db.execute(
+                """
+                create table if not exists digests (
+                    path text primary key,
+                    size integer not null,
+                    mtime integer not null,
+                    inode integer not null,
+                    digest text not null
+                )
+                """
+            )
+
+    def connect(self):
+        """Open a connection to the index, to be used in a `with` statement."""
+        return closing(
+            sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        )
+
+    def entry(self, key):
+        """The directory of the entry of a key."""
+        return f"{self.root}/objects/{key[0:2]}/{key}"
+
+    def key(self, step):
+        """Compute the cache key of a step.
+
+        Parameters
+        ----------
+        step: object
+            The `Step`.
+
+        Returns
+        -------
+        string
+            The hexadecimal hash.
+        """
+        h = hashlib.sha256()
+        params = (
+            step.params
+            if step.params is not None
+            else step.command
+            if step.command is not None
+            else f"{step.function.__module__}.{step.function.__qualname__}"
+        )
+        h.update(json.dumps(params, sort_keys=True).encode())
+
+        with self.connect() as db:
+            for path in codeFiles(step):
+                h.update(b"code\0")
+                h.update(self.digest(db, path).encode())
+
+            for i, top in enumerate(step.inputs):
+                h.update(f"input {i}\0".encode())
+
+                if not os.path.isdir(top):
+                    h.update(self.digest(db, top).encode())
+                    continue
+
+                for root, dirs, files in os.walk(top):
+                    dirs.sort()
+
+                    for name in sorted(files):
+                        path = f"{root}/{name}"
+                        h.update(os.path.relpath(path, top).encode() + b"\0")
+                        h.update(self.digest(db, path).encode())
+
+        return h.hexdigest()
+
+    def digest(self, db, path):
+        """The digest of the contents of a file, remembered while it is unchanged.
+
+        Parameters
+        ----------
+        db: object
+            An open connection to the index.
+        path: string
+            The path of the file.
+
+        Returns
+        -------
+        string
+        """
+        path = os.path.realpath(path)
+        info = os.stat(path)
+        row = db.execute(
+            "select digest from digests"
+            " where path = ? and size = ? and mtime = ? and inode = ?",
+            (path, info.st_size, info.st_mtime_ns, info.st_ino),
+        ).fetchone()
+
+        if row is not None:
+            return row[0]
+
+        h = hashlib.sha256()
+
+        with open(path, "rb") as fh:
+            while chunk := fh.read(CHUNK):
+                h.update(chunk)
+
+        digest = h.hexdigest()
+        db.execute(
+            "insert or replace into digests (path, size, mtime, inode, digest)"
+            " values (?, ?, ?, ?, ?)",
+            (path, info.st_size, info.st_mtime_ns, info.st_ino, digest),
+        )
+        return digest
+
+    def restore(self, key, outputs):
+        """Restore the outputs of a step from the store, if they are there.
+
+        Parameters
+        ----------
+        key: string
+            The cache key of the step.
+        outputs: iterable of string
+            The paths of the outputs of the step, files or directories.
+
+        Returns
+        -------
+        integer or None
+            The number of bytes restored, None if the key is not in the store.
+        """
+        entry = self.entry(key)
+
+        with self.connect() as db:
+            row = db.execute(
+                "select size from entries where key = ?", (key,)
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            db.execute(
+                "update entries set used = ?, hits = hits + 1 where key = ?",
+                (time.time(), key),
+            )
+
+        try:
+            for i, path in enumerate(outputs):
+                src = f"{entry}/{i}"
+                remove(path)
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+                if os.path.isdir(src):
+                    shutil.copytree(src, path, copy_function=place)
+                else:
+                    place(src, path)
+        except OSError:
+            # the entry has gone, e.g. evicted by another worker
+            self.clean(outputs)
+            return None
+
+        return row[0]
+
+    def clean(self, outputs):
+        """Remove the outputs of a step, before it runs.
+
+        Parameters
+        ----------
+        outputs: iterable of string
+            The paths of the outputs.
+        """
+        for path in outputs:
+            remove(path)
+
+    def store(self, key, outputs):
+        """Store the outputs of a step that has succeeded.
+
+        The entry is assembled in a temporary directory, and then renamed into
+        place, so that other workers never see a partial entry.
+        Entries that do not fit in the budget at all, are not stored.
+        Afterwards, entries are evicted until the store fits in its budget.
+
+        Parameters
+        ----------
+        key: string
+            The cache key of the step.
+        outputs: iterable of string
+            The paths of the outputs of the step.
+
+        Returns
+        -------
+        integer or None
+            The number of bytes stored, None if nothing has been stored.
+        """
+        outputs = [path for path in outputs if os.path.exists(path)]
+        size = sum(treeSize(path) for path in outputs)
+
+        if size > self.budget:
+            return None
+
+        entry = self.entry(key)
+        tmp = f"{self.root}/objects/tmp-{uuid.uuid4().hex}"
+        os.makedirs(tmp)
+
+        try:
+            for i, path in enumerate(outputs):
+                if os.path.isdir(path):
+                    shutil.copytree(path, f"{tmp}/{i}", copy_function=place)
+                else:
+                    place(path, f"{tmp}/{i}")
+
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            os.rename(tmp, entry)
+        except OSError:
+            # another worker has stored the same key in the meantime
+            remove(tmp)
+            return None
+
+        now = time.time()
+
+        with self.connect() as db:
+            db.execute(
+                "insert or replace into entries (key, size, created, used)"
+                " values (?, ?, ?, ?)",
+                (key, size, now, now),
+            )
+
+        self.evict()
+        return size
+
+    def evict(self):
+        """Remove the least recently used entries until the store fits its budget."""
+        with self.connect() as db:
+            db.execute("begin immediate")
+
+            try:
+                total = db.execute("select sum(size) from entries").fetchone()[0] or 0
+                victims = []
+
+                for key, size in db.execute(
+                    "select key, size from entries order by used"
+                ).fetchall():
+                    if total <= self.budget:
+                        break
+
+                    victims.append(key)
+                    total -= size
+
+                db.executemany(
+                    "delete from entries where key = ?", [(key,) for key in victims]
+                )
+                db.execute("commit")
+            except Exception:
+                db.execute("rollback")
+                raise
+
+        for key in victims:
+            entry = self.entry(key)
+            remove(entry)
+
+            try:
+                os.rmdir(os.path.dirname(entry))
+            except OSError:
+                # other entries share the directory
+                pass
+
+    def stats(self):
+        """The size of the store.
+
+        Returns
+        -------
+        dict
+            With `entries`, the number of entries, `size`, their total size in
+            bytes, and `budget`.
+        """
+        with self.connect() as db:
+            (n, size) = db.execute("select count(*), sum(size) from entries").fetchone()
+
+        return dict(entries=n, size=size or 0, budget=self.budget)
@@ -0,0 +1,161 @@
+import os
+import codecs
+
+
+class Capture:
+    """Capture the output of a pipe in large chunks and deliver it as lines.
+
+    The pipe is read with `os.readv` into a buffer that is allocated once and
+    reused for every read.
+    The bytes are decoded incrementally, so that a multibyte UTF-8 character that
+    is split over two chunks is decoded correctly.
+
+    A chunk is decoded as a whole, and split into lines in one go, so that the
+    cost per line is a single string slice.
+    The incomplete last line of a chunk is kept until the rest of it arrives.
+
+    Lines are delivered without their trailing newline, all lines of a chunk
+    in one call.
+    """
+
+    def __init__(self, fd, onLines, chunkSize=65536, maxLine=1048576):
+        """Create a capture for a pipe.
+
+        Parameters
+        ----------
+        fd: integer
+            The file descriptor of the pipe, in non-blocking mode.
+            None if the pipe is read elsewhere, and its data is passed to
+            `feed()`.
+        onLines: function
+            Called as `onLines(lines)` with the list of complete lines read from a
+            chunk.
+        chunkSize: integer, optional 65536
+            The size of the read buffer.
+        maxLine: integer, optional 1048576
+            If an incomplete line grows beyond this number of characters, it is
+            delivered anyway, so that a process that does not write newlines
+            cannot make us hold on to an unbounded amount of data.
+        """
+        self.fd = fd
+        self.onLines = onLines
+        self.maxLine = maxLine
+        self.buffer = bytearray(chunkSize)
+        self.view = memoryview(self.buffer)
+        self.decoder = codecs.getincrementaldecoder("utf8")(errors="replace")
+        self.pending = ""
+        self.split = False
+        self.nBytes = 0
+        self.nLines = 0
+
+    def read(self):
+        """Read one chunk from the pipe and deliver the complete lines in it.
+
+        Returns
+        -------
+        boolean or None
+            True if a chunk has been read, False if no data is available now,
+            None if the end of the pipe has been reached.
+        """
+        try:
+            n = os.readv(self.fd, [self.buffer])
+        except BlockingIOError:
+            return False
+
+        if n == 0:
+            return None
+
+        self.feed(self.view[0:n])
+        return True
+
+    def feed(self, data):
+        """Deliver the complete lines in a chunk of bytes from the pipe.
+
+        Parameters
+        ----------
+        data: bytes-like
+            The chunk.
+        """
+        self.nBytes += len(data)
+        self.deliver(self.decoder.decode(data))
+
+    def drain(self, limit):
+        """Read what is available in the pipe, in chunks, up to a limit.
+
+        Every chunk is delivered before the next one is read, so the remainder of
+        the output is never held in memory as a whole.
+
+        Parameters
+        ----------
+        limit: integer
+            The maximum number of bytes to read.
+            Needed because a process that keeps writing would otherwise keep
+            us draining forever.
+
+        Returns
+        -------
+        boolean
+            Whether the end of the pipe has been reached.
+        """
+        start = self.nBytes
+
+        while self.nBytes - start < limit:
+            result = self.read()
+
+            if result is None:
+                return True
+
+            if not result:
+                break
+
+        return False
+
+    def deliver(self, text):
+        """Split decoded text into lines and deliver the complete ones.
+
+        Parameters
+        ----------
+        text: string
+            Decoded text from the pipe.
+        """
+        pos = text.rfind("\n")
+
+        if pos == -1:
+            self.pending += text
+
+            if len(self.pending) >= self.maxLine:
+                # deliver the line so far, but do not flush the decoder: it may
+                # hold the first bytes of a character that the next chunk completes
+                line = self.pending
+                self.pending = ""
+                self.split = True
+                self.nLines += 1
+                self.onLines([line])
+            return
+
+        block = self.pending + text[0:pos] if self.pending else text[0:pos]
+        self.pending = text[pos + 1:]
+        lines = block.split("\n")
+
+        if self.split:
+            self.split = False
+
+            if not lines[0]:
+                # the newline only ends a line whose parts have been delivered
+                lines = lines[1:]
+
+                if not lines:
+                    return
+
+        self.nLines += len(lines)
+        self.onLines(lines)
+
+    def finish(self):
+        """Deliver the incomplete last line, if any."""
+        rest = self.pending + self.decoder.decode(b"", final=True)
+        self.pending = ""
+        self.split = False
+
+        if rest:
+            self.nLines += 1
+            self.onLines([rest])
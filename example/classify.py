@@ -0,0 +1,117 @@
+import re
+from collections import Counter
+
+SEVERITIES = ("info", "warning", "error", "special")
+
+DEFAULT_RULES = (
+    ("traceback", "error", r"^Traceback \(most recent call last\)"),
+    ("error", "error", r"\b(?:ERROR|FATAL|CRITICAL)\b|^(?i:error)\b"),
+    ("warning", "warning", r"\bWARN(?:ING)?\b|\w+Warning\b|^(?i:warning)\b"),
+    ("info", "info", r"^(?:INFO|DEBUG)\b"),
+)
+TAGS = re.compile(r"(?:\[[^\]\n]*\] )+")  # leading tags such as `[convert] `
+
+
+class Classifier:
+    """Classify output lines by severity, as they stream in.
+
+    A line gets a severity: `info`, `warning`, `error` or `special`.
+    Without rules, lines from stdout are `info`, and lines from stderr `error`.
+    Rules can change that: a rule has a name, a severity, and a regular
+    expression; a line that matches it gets its severity, whatever stream it
+    comes from. So a tool that writes its progress to stderr, or its warnings to
+    stdout, can still be reported correctly.
+
+    All rules are combined into a single regular expression, with a named group
+    per rule, so that a line is searched only once, however many rules there are.
+    The first match in a line decides; if several rules match at the same
+    position, the rule that comes first wins.
+
+    Lines may start with tags, such as `[convert] ` for the lines of a workflow
+    step, or `[shard 03/16] ` for the lines of a worker of `shard.py`.
+    The rules see a line without its leading tags, so that a pattern anchored
+    with `^` matches at the start of what the tool itself has written.
+
+    The classifier only says what the severity of a line is; the counting per
+    severity and per rule happens per run, in the `Emitter`.
+    """
+
+    def __init__(self, rules=DEFAULT_RULES):
+        """Compile a set of rules.
+
+        Parameters
+        ----------
+        rules: iterable of tuple, optional DEFAULT_RULES
+            Every rule is a tuple of name, severity and pattern.
+            The patterns may contain inline flags that apply to a part of them,
+            such as `(?i:...)`, but no flags for the whole pattern, and no named
+            groups.
+
+        Raises
+        ------
+        ValueError
+            If a rule has an unknown severity.
+        re.error
+            If a pattern is not a valid regular expression.
+        """
+        self.rules = tuple(rules)
+        self.names = {}
+        self.severities = {}
+        alternatives = []
+
+        for i, (name, severity, pattern) in enumerate(self.rules):
+            if severity not in SEVERITIES:
+                raise ValueError(f"rule {name}: unknown severity {severity}")
+
+            group = f"r{i}"
+            self.names[group] = name
+            self.severities[group] = severity
+            alternatives.append(f"(?P<{group}>{pattern})")
+
+        self.regex = re.compile("|".join(alternatives)) if alternatives else None
+
+    def classify(self, kind, lines):
+        """Classify lines from the same stream.
+
+        Parameters
+        ----------
+        kind: string
+            The kind of the stream: `info` for stdout, `error` for stderr.
+        lines: list of string
+            The lines.
+
+        Returns
+        -------
+        tuple
+            A dict with the lines per severity, in their original order, and a
+            counter with the number of lines per rule that has matched.
+        """
+        regex = self.regex
+
+        if regex is None:
+            return ({kind: lines}, Counter())
+
+        names = self.names
+        severities = self.severities
+        search = regex.search
+        tags = TAGS.match
+        groups = {}
+        hits = Counter()
+
+        for line in lines:
+            tagged = tags(line) if line.startswith("[") else None
+            match = search(line if tagged is None else line[tagged.end():])
+
+            if match is None:
+                severity = kind
+            else:
+                group = match.lastgroup
+                severity = severities[group]
+                hits[names[group]] += 1
+
+            if severity in groups:
+                groups[severity].append(line)
+            else:
+                groups[severity] = [line]
+
+        return (groups, hits)
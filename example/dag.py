@@ -0,0 +1,475 @@
+import sqlite3
+from queue import SimpleQueue
+
+from helpers import Timestamp
+
+
+class Step:
+    """A step in a workflow.
+
+    A step is either a python function or a script, and it may depend on other
+    steps: it will only start after those steps have ended successfully.
+
+    A step that declares its outputs, can be cached, see `StepCache`.
+    """
+
+    def __init__(
+        self,
+        name,
+        function=None,
+        command=None,
+        deps=(),
+        resourceClass=None,
+        inputs=(),
+        outputs=(),
+        code=(),
+        params=None,
+    ):
+        """Define a step.
+
+        Exactly one of `function` and `command` should be given.
+
+        Parameters
+        ----------
+        name: string
+            The name of the step, unique within its workflow.
+        function: function, optional None
+            Called as `function(dag, step)`. It may emit progress with
+            `dag.progress(step, kind, text)` and should regularly check
+            `dag.isStopped(step)`.
+            It returns a tuple with status and message.
+        command: list, optional None
+            A command with arguments, to be run as subprocess.
+            Its stdout and stderr are emitted as progress of the step.
+        deps: iterable, optional ()
+            The names of the steps that must have succeeded before this step
+            can start.
+        resourceClass: string, optional None
+            The resource class of the step, used by the scheduler.
+            By default, function steps are `io` and script steps `cpu`.
+        inputs: iterable, optional ()
+            The files and directories that the step reads.
+        outputs: iterable, optional ()
+            The files and directories that the step writes, and only this step.
+            If there are none, the step is not cached.
+        code: iterable, optional ()
+            The files that implement the step; by default the file of the
+            function, or the files in the arguments of the command.
+        params: any, optional None
+            The parameters of the step, as far as they determine its outputs,
+            as JSON-serializable value; by default the command, or the name of
+            the function. Leave out paths that differ between corpora, so that
+            corpora with the same contents can share cached outputs.
+        """
+        self.name = name
+        self.function = function
+        self.command = command
+        self.deps = tuple(deps)
+        self.resourceClass = resourceClass or ("io" if command is None else "cpu")
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.code = tuple(code)
+        self.params = params
+
+
+class Dag:
+    """Run the steps of a workflow, in parallel where their dependencies allow it.
+
+    The workflow runs as a task, and its steps run as tasks of their own, with
+    keys *task* `/` *step*.
+    So they are subject to the scheduler, with the resource class of the step,
+    and they can be stopped individually.
+
+    A step starts as soon as all its dependencies have succeeded.
+    When a step fails, the steps that depend on it, directly or indirectly, are
+    skipped, but independent branches carry on.
+    When the workflow is stopped, the stop is propagated to all running steps,
+    and no new steps are started.
+
+    The progress lines of a step are emitted as progress of the workflow task,
+    prefixed with the step name.
+    The life cycle of a step is emitted as status messages of the workflow task,
+    with `stat` one of `step-start`, `step-success`, `step-failure`,
+    `step-interrupt`, `step-skipped`, and the name of the step in `step`.
+    When a step has ended, its status message contains the resources it has used
+    in `usage`; they are added up into the usage of the workflow task.
+
+    If the task manager has a `StepCache`, steps whose outputs are in the cache
+    are not run, but restored; the status message of such a step has `cache`
+    `hit`, that of a cacheable step that has run `miss`. See `cacheStats()`.
+    """
+
+    def __init__(self, tasks, task, steps):
+        """Define a workflow.
+
+        Parameters
+        ----------
+        tasks: object
+            The `Task` object that manages the tasks.
+        task: string
+            The key of the task that runs the workflow.
+        steps: iterable of Step
+            The steps of the workflow.
+        """
+        self.tasks = tasks
+        self.task = task
+        self.steps = {step.name: step for step in steps}
+        self.TM = None
+        self.events = SimpleQueue()
+        self.started = set()
+        self.cacheKeys = {}
+        self.cached = {}
+
+        for step in self.steps.values():
+            for dep in step.deps:
+                if dep not in self.steps:
+                    raise ValueError(f"step {step.name} depends on unknown {dep}")
+
+        self.check()
+
+    def check(self):
+        """Check that the dependencies do not contain cycles."""
+        steps = self.steps
+        state = {}
+
+        def visit(name):
+            if state.get(name, None) == "done":
+                return
+
+            if state.get(name, None) == "busy":
+                raise ValueError(f"dependency cycle through step {name}")
+
+            state[name] = "busy"
+
+            for dep in steps[name].deps:
+                visit(dep)
+
+            state[name] = "done"
+
+        for name in steps:
+            visit(name)
+
+    def key(self, step):
+        """The task key of a step."""
+        return f"{self.task}/{step.name}"
+
+    def run(self):
+        """Run the workflow until all steps have ended or have been skipped.
+
+        This function blocks; it should run in the thread of the workflow task.
+
+        Returns
+        -------
+        tuple
+            The status and message with which the workflow ended.
+        """
+        tasks = self.tasks
+        task = self.task
+        steps = self.steps
+        events = self.events
+        self.TM = Timestamp()
+
+        result = {}
+        running = set()
+        stopped = False
+
+        def stop():
+            for name in list(running):
+                key = self.key(steps[name])
+                tasks.stop(key)
+
+                if tasks.isIdle(key) and name not in self.started:
+                    # the step was still in the queue and will never report back
+                    self.status(steps[name], "step-interrupt", "removed from queue")
+                    events.put((name, "interrupt"))
+
+            events.put(None)
+
+        tasks.onStop(task, stop)
+
+        while True:
+            stopped = stopped or tasks.isStopped(task)
+
+            if not stopped:
+                for name, step in steps.items():
+                    if name in result or name in running:
+                        continue
+
+                    depStats = [result.get(dep, None) for dep in step.deps]
+
+                    if any(stat not in {None, "success"} for stat in depStats):
+                        result[name] = "skipped"
+                        self.status(step, "step-skipped", "a dependency failed")
+                    elif all(stat == "success" for stat in depStats):
+                        running.add(name)
+                        self.startStep(step)
+
+            if not running:
+                break
+
+            event = events.get()
+
+            if event is not None:
+                (name, stat) = event
+                running.discard(name)
+                result[name] = stat
+
+        for name, step in steps.items():
+            if name not in result:
+                result[name] = "skipped"
+                self.status(step, "step-skipped", "workflow interrupted")
+
+        if stopped:
+            return ("interrupt", "interrupted by user")
+
+        if set(result.values()) == {"success"}:
+            return ("success", "ok")
+
+        nBad = sum(1 for stat in result.values() if stat != "success")
+        return ("failure", f"{nBad} of {len(result)} steps did not succeed")
+
+    def startStep(self, step):
+        """Start a step as a task of its own.
+
+        Parameters
+        ----------
+        step: object
+            The step.
+        """
+        started = self.tasks.start(
+            self.key(step), self.doStep, step, resourceClass=step.resourceClass
+        )
+
+        if not started:
+            # the key belongs to the task that runs the step already
+            self.done(
+                step, Timestamp(), "failure", "step already running", release=False
+            )
+
+    def doStep(self, step):
+        """Run a step. This runs in the thread of the step task.
+
+        The thread of a command step waits for its subprocess, and wraps the step
+        up when it has ended.
+
+        Parameters
+        ----------
+        step: object
+            The step.
+        """
+        self.started.add(step.name)
+        history = self.tasks.history
+
+        if history is not None:
+            history.stepStart(self.task, step.name)
+
+        self.status(step, "step-start", "")
+        TM = Timestamp()
+
+        try:
+            if self.fromCache(step, TM):
+                return
+
+            if step.function is not None:
+                usage = self.tasks.usage
+                usage.beginThread(self.key(step))
+
+                try:
+                    (stat, msg) = step.function(self, step)
+                finally:
+                    usage.endThread(self.key(step))
+
+                self.done(step, TM, stat, msg)
+            else:
+
+                ended = SimpleQueue()
+
+                def onLines(kind, lines):
+                    self.progressLines(step, kind, lines)
+
+                def onDone(stat, msg):
+                    # wrapping up may take a while, e.g. storing the outputs in the
+                    # cache, so it is done in this thread, not in the one of the
+                    # subprocess runner
+                    ended.put((stat, msg))
+
+                self.tasks.runScript(self.key(step), step.command, onLines, onDone)
+                (stat, msg) = ended.get()
+                self.done(step, TM, stat, msg)
+
+        except Exception as e:
+            self.done(step, TM, "failure", f"exception {str(e)}")
+
+    def fromCache(self, step, TM):
+        """Restore the outputs of a step from the cache, if they are there.
+
+        If they are not, the outputs are removed, so that the step writes them
+        anew, and its cache key is kept, so that its outputs can be stored when
+        it has succeeded.
+
+        Parameters
+        ----------
+        step: object
+            The step.
+        TM: object
+            The `Timestamp` that records the start of the step.
+
+        Returns
+        -------
+        boolean
+            Whether the step has been restored, and has ended.
+        """
+        cache = self.tasks.cache
+
+        if cache is None or not step.outputs:
+            return False
+
+        try:
+            cacheKey = cache.key(step)
+            size = cache.restore(cacheKey, step.outputs)
+        except (OSError, sqlite3.Error) as e:
+            self.progress(step, "warning", f"not cached: {str(e)}")
+            return False
+
+        if size is not None:
+            self.cached[step.name] = "hit"
+            self.done(step, TM, "success", f"restored {size} bytes from cache")
+            return True
+
+        self.cached[step.name] = "miss"
+        self.cacheKeys[step.name] = cacheKey
+        cache.clean(step.outputs)
+        return False
+
+    def cacheStats(self):
+        """The use of the cache by the steps of the workflow.
+
+        Returns
+        -------
+        dict
+            Empty if there is no cache, otherwise with key `cache` and a dict with
+            the number of steps restored from the cache (`hits`), the number of
+            cacheable steps that have run (`misses`), and the size of the cache.
+        """
+        cache = self.tasks.cache
+
+        if cache is None:
+            return {}
+
+        results = list(self.cached.values())
+        return dict(
+            cache=dict(
+                hits=results.count("hit"),
+                misses=results.count("miss"),
+                **cache.stats(),
+            )
+        )
+
+    def done(self, step, TM, stat, msg, release=True):
+        """Wrap up a step that has ended.
+
+        The outputs of a cacheable step that has succeeded, are stored in the
+        cache.
+
+        Parameters
+        ----------
+        step: object
+            The step.
+        TM: object
+            The `Timestamp` that records the start of the step.
+        stat: string
+            The status with which the step ended.
+        msg: string
+            An additional message.
+        release: boolean, optional True
+            Whether the usage and the slot of the step task are released; False if
+            the step has not started as a task of its own.
+        """
+        tasks = self.tasks
+        key = self.key(step)
+        usage = tasks.usage.pop(key) if release else None
+        data = {} if usage is None else dict(usage=usage)
+        tasks.usage.add(self.task, usage)
+        cacheKey = self.cacheKeys.pop(step.name, None)
+
+        if cacheKey is not None and stat == "success":
+            try:
+                tasks.cache.store(cacheKey, step.outputs)
+            except (OSError, sqlite3.Error) as e:
+                self.progress(step, "warning", f"not stored in cache: {str(e)}")
+
+        if step.name in self.cached:
+            data["cache"] = self.cached[step.name]
+
+        if tasks.history is not None:
+            tasks.history.stepEnd(self.task, step.name, stat)
+
+        self.status(step, f"step-{stat}", msg, took=TM.elapsed(), **data)
+
+        if release:
+            tasks.clear(key)
+
+        self.events.put((step.name, stat))
+
+    def isStopped(self, step):
+        """Whether a step has been asked to stop.
+
+        Parameters
+        ----------
+        step: object
+            The step.
+        """
+        return self.tasks.isStopped(self.key(step))
+
+    def progress(self, step, kind, text):
+        """Emit a progress line of a step.
+
+        Parameters
+        ----------
+        step: object
+            The step.
+        kind: string
+            The kind of the line: `info` or `error`.
+        text: string
+            The line.
+        """
+        self.progressLines(step, kind, [text])
+
+    def progressLines(self, step, kind, lines):
+        """Emit progress lines of a step.
+
+        Parameters
+        ----------
+        step: object
+            The step.
+        kind: string
+            The kind of the lines: `info` or `error`.
+        lines: list of string
+            The lines.
+        """
+        name = step.name
+        lines = [f"[{name}] {text}" for text in lines]
+        self.tasks.emitter.progressLines(self.task, kind, self.TM.offset(), lines)
+
+    def status(self, step, stat, msg, **data):
+        """Emit a status message about a step.
+
+        Parameters
+        ----------
+        step: object
+            The step.
+        stat: string
+            The status.
+        msg: string
+            An additional message.
+        **data: any
+            Additional fields for the status message.
+
+        The message also carries the estimated progress of the workflow, see
+        `Task.estimate()`.
+        """
+        tm = self.TM.offset()
+        estimate = self.tasks.estimate(self.task)
+        self.tasks.emitter.status(
+            self.task, tm=tm, stat=stat, step=step.name, msg=msg, **data, **estimate
+        )
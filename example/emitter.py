@@ -0,0 +1,593 @@
+import time
+from threading import Lock
+from collections import Counter
+
+from ring import Ring
+
+
+class Emitter:
+    """Emit progress messages in batches over the websocket.
+
+    Tasks may produce many thousands of output lines.
+    Emitting every line as a separate websocket message costs a frame and a JSON
+    encoding per line, on the server and in every connected client.
+
+    Instead, progress lines are collected per task and kind, and sent as a single
+    `progress` event when the batch has been open for longer than a time window
+    or when it exceeds a byte budget, whichever comes first.
+
+    Status messages are never delayed: before a status message goes out, all
+    pending progress lines of its task are flushed, so that clients see
+    the progress and status messages in the right order.
+
+    Every event of a run, progress line or status message, gets a sequence number
+    `n`, counting from 0 within the run.
+    The payloads of the events are
+
+        dict(task=task, run=run, kind=kind, lines=[[n, tm, text], ...])
+        dict(task=task, run=run, n=n, tm=tm, stat=stat, msg=msg)
+
+    where `tm` is the elapsed time in seconds, see `Timestamp.offset()`, which
+    the clients format themselves.
+
+    The most recent events of a run are kept in a `Ring`, so that clients that
+    (re)connect can be sent the events they have missed, see `replay()`.
+
+    If the emitter has a run log, every progress line and status message is
+    also written to the log of the current run of its task, at the moment it is
+    handed to the emitter.
+
+    Events are not broadcast to all clients, but sent to the room of their task,
+    see `room()`. Clients join the rooms of the tasks they show when they
+    connect, so that the cost of sending an event grows with the number of
+    clients that are interested in it, not with the number of all clients.
+
+    Progress lines come from stdout (`info`) or stderr (`error`), but if the
+    emitter has a `Classifier`, every line gets the severity that its rules give
+    it: `info`, `warning`, `error` or `special`. The lines are counted per
+    severity and per rule in every run, see `tally()`, so that the outcome of a
+    run can be told without reading its log again.
+
+    If the server runs in several worker processes, the events that a worker
+    emits are published to the other workers, which emit them to their own
+    clients, see `mirror()`.
+
+    Clients that have asked for it, get the progress and status events in a
+    compact binary encoding, see `Wire`.
+    """
+
+    def __init__(
+        self,
+        socketio,
+        window=0.25,
+        budget=65536,
+        log=None,
+        ringSize=10000,
+        replayLimit=100000,
+        corpus=None,
+        publish=None,
+        classifier=None,
+        wire=None,
+    ):
+        """Create an emitter.
+
+        Parameters
+        ----------
+        socketio: object
+            The socketio object corresponding to the Flask app.
+        window: float, optional 0.25
+            The maximum time in seconds that a progress line is held back.
+            If 0, progress lines are emitted immediately, one batch per line.
+        budget: integer, optional 65536
+            The number of characters in a batch that causes it to be emitted
+            immediately, irrespective of the time window.
+        log: object, optional None
+            A `RunLog` to which all events are written.
+        ringSize: integer, optional 10000
+            The number of recent events per task that are kept in memory
+            for replay.
+        replayLimit: integer, optional 100000
+            The maximum number of events that are replayed to a client.
+            Events that are older than the ones in the ring, are read from the
+            run log.
+        corpus: string, optional None
+            The corpus whose tasks are run, e.g. `org/repo`; it is part of the
+            names of the rooms, so that servers for several corpora can share a
+            message queue.
+        publish: function, optional None
+            If given, it is called as `publish(event, data, room)` for every event
+            that is emitted to the room of a task, so that it can be passed on to
+            other workers.
+        classifier: object, optional None
+            A `Classifier` that gives progress lines their severity.
+            If None, lines keep the kind of the stream they come from.
+        wire: object, optional None
+            A `Wire` that encodes events for clients that want the compact
+            encoding. If None, all clients get JSON.
+        """
+        self.socketio = socketio
+        self.window = window
+        self.budget = budget
+        self.log = log
+        self.ringSize = ringSize
+        self.replayLimit = replayLimit
+        self.corpus = corpus
+        self.publish = publish
+        self.classifier = classifier
+        self.wire = wire
+        self.rings = {}
+        self.mirrored = set()
+        self.tallies = {}
+        self.ruleTallies = {}
+        self.seqLock = Lock()
+        self.batches = {}
+        self.batchLock = Lock()
+        self.flusher = None
+
+    def room(self, task):
+        """The room to which the events of a task are sent.
+
+        The steps of a workflow, with keys `workflow/step`, share the room of
+        their workflow.
+
+        Parameters
+        ----------
+        task: string
+            The key of the task.
+
+        Returns
+        -------
+        string
+        """
+        task = task.partition("/")[0]
+        return task if self.corpus is None else f"{self.corpus}:{task}"
+
+    def begin(self, task):
+        """Start a new run of a task.
+
+        The sequence numbers of the events start again at 0, in a new ring,
+        and a new log is started.
+
+        Parameters
+        ----------
+        task: string
+            The key of the task.
+
+        Returns
+        -------
+        string
+            The id of the run.
+        """
+        log = self.log
+
+        with self.seqLock:
+            if log is None:
+                run = time.strftime("%Y%m%d-%H%M%S")
+            else:
+                run = log.begin(task)
+
+            self.rings[task] = Ring(run, self.ringSize)
+            self.mirrored.discard(task)
+            self.tallies[task] = Counter()
+            self.ruleTallies[task] = Counter()
+
+        return run
+
+    def end(self, task):
+        """End the run of a task.
+
+        The ring of the run is kept, for clients that connect later.
+
+        Parameters
+        ----------
+        task: string
+            The key of the task.
+        """
+        log = self.log
+
+        if log is not None:
+            log.end(task)
+
+    def tally(self, task):
+        """The number of progress lines in the current run of a task.
+
+        Parameters
+        ----------
+        task: string
+            The key of the task.
+
+        Returns
+        -------
+        tuple
+            A dict with the number of lines per severity, and a dict with the
+            number of lines per classification rule.
+        """
+        with self.seqLock:
+            return (
+                dict(self.tallies.get(task, {})),
+                dict(self.ruleTallies.get(task, {})),
+            )
+
+    def record(self, task, records):
+        """Give events a sequence number, keep them in the ring and log them.
+
+        Parameters
+        ----------
+        task: string
+            The key of the task.
+        records: list of dict
+            The events.
+
+        Returns
+        -------
+        string
+            The id of the run to which the events belong,
+            None if the task has not run yet, or runs in another worker.
+        """
+        log = self.log
+
+        with self.seqLock:
+            ring = self.rings.get(task, None)
+
+            if ring is None or task in self.mirrored:
+                return None
+
+            ring.add(records)
+            tally = self.tallies[task]
+
+            for record in records:
+                if record["ev"] == "progress":
+                    tally[record["kind"]] += 1
+
+            if log is not None:
+                log.write(task, records)
+
+        return ring.run
+
+    def progress(self, task, kind, tm, text):
+        """Add a progress line to the batch of its task and kind.
+
+        Parameters
+        ----------
+        task: string
+            The key of the task that produced the line.
+        kind: string
+            The kind of the line: `info` or `error`.
+        tm: float
+            The elapsed time in seconds at which the line has been produced.
+        text: string
+            The line itself.
+        """
+        self.progressLines(task, kind, tm, [text])
+
+    def progressLines(self, task, kind, tm, lines):
+        """Add several progress lines at once to the batches of their task.
+
+        If there is a classifier, the lines are classified first, and added
+        to the batch of their severity.
+
+        Parameters
+        ----------
+        task: string
+            The key of the task that produced the lines.
+        kind: string
+            The kind of the lines: `info` or `error`.
+        tm: float
+            The elapsed time in seconds at which the lines have been produced.
+        lines: list of string
+            The lines themselves.
+        """
+        classifier = self.classifier
+
+        if classifier is None:
+            self.batchLines(task, kind, tm, lines)
+            return
+
+        (groups, hits) = classifier.classify(kind, lines)
+
+        if hits:
+            with self.seqLock:
+                ruleTally = self.ruleTallies.get(task, None)
+
+                if ruleTally is not None:
+                    ruleTally.update(hits)
+
+        for severity, group in groups.items():
+            self.batchLines(task, severity, tm, group)
+
+    def batchLines(self, task, kind, tm, lines):
+        """Add progress lines of one kind to the batch of their task and kind.
+
+        See `progressLines()` for the parameters.
+        """
+        records = [dict(tm=tm, ev="progress", kind=kind, text=text) for text in lines]
+        run = self.record(task, records)
+        key = (task, kind)
+        ready = None
+
+        with self.batchLock:
+            batch = self.batches.get(key, None)
+
+            if batch is not None and batch["run"] != run:
+                # the batch belongs to a previous run
+                ready = self.batches.pop(key)
+                batch = None
+
+            if batch is None:
+                batch = dict(run=run, since=time.monotonic(), size=0, lines=[])
+                self.batches[key] = batch
+
+            batch["lines"].extend(
+                [record.get("n", None), tm, record["text"]] for record in records
+            )
+            batch["size"] += sum(len(text) for text in lines)
+            full = self.window <= 0 or batch["size"] >= self.budget
+
+        if ready is not None:
+            self.emitBatch(key, ready)
+
+        if full:
+            self.flush(task, kind=kind)
+        else:
+            self.startFlusher()
+
+    def status(self, task, **data):
+        """Emit a status message, after flushing the progress lines of its task.
+
+        Parameters
+        ----------
+        task: string
+            The key of the task whose status is emitted.
+        **data: any
+            The remaining fields of the status message, such as `tm`, `stat`, `msg`.
+        """
+        record = dict(ev="status", kind="special", **data)
+        run = self.record(task, [record])
+        self.flush(task)
+        self.send(
+            "status", task, dict(task=task, run=run, n=record.get("n", None), **data)
+        )
+
+    def notify(self, task, **data):
+        """Emit a status message that is not part of a run.
+
+        Such messages, e.g. about the position of a task in the queue,
+        are not numbered, not kept in the ring and not logged.
+
+        Parameters
+        ----------
+        task: string
+            The key of the task whose status is emitted.
+        **data: any
+            The remaining fields of the status message, such as `stat`, `msg`.
+        """
+        self.send("status", task, dict(task=task, run=None, n=None, **data))
+
+    def send(self, event, task, data):
+        """Emit an event to the room of a task, and publish it.
+
+        Parameters
+        ----------
+        event: string
+            The name of the event.
+        task: string
+            The key of the task.
+        data: dict
+            The payload.
+        """
+        room = self.room(task)
+        self.deliver(event, data, room)
+
+        if self.publish is not None:
+            self.publish(event, data, room)
+
+    def deliver(self, event, data, room):
+        """Emit an event to a room, in the encoding that its clients want.
+
+        Parameters
+        ----------
+        event: string
+            The name of the event.
+        data: dict
+            The payload.
+        room: string
+            The room of the task of the event.
+
+        If there are compact clients, an encoding is only used when the room has
+        clients that want it, see `Wire.audience()`.
+        """
+        socketio = self.socketio
+        wire = self.wire
+
+        if wire is None or not wire.active():
+            socketio.emit(event, data, to=room)
+            return
+
+        (json, compact) = wire.audience(room)
+
+        if json:
+            socketio.emit(event, data, to=room)
+
+        if compact:
+            message = wire.encode(event, data)
+
+            if message is None:
+                socketio.emit(event, data, to=wire.room(room))
+            else:
+                socketio.emit(event, message, to=wire.room(room))
+
+    def mirror(self, event, data):
+        """Keep an event that another worker has emitted, for replay.
+
+        The events of a run are kept in a ring, with the sequence numbers that
+        the worker that runs the task has given them, so that clients of this
+        worker can be sent the events they have missed, just as for the runs of
+        this worker itself.
+        They are not logged again: the run log is written by the worker that
+        runs the task.
+
+        Parameters
+        ----------
+        event: string
+            The name of the event: `status` or `progress`.
+        data: dict
+            The payload.
+        """
+        task = data.get("task", None)
+        run = data.get("run", None)
+
+        if task is None or run is None:
+            return
+
+        if event == "status":
+            n = data["n"]
+            fields = {k: v for (k, v) in data.items() if k not in {"task", "run", "n"}}
+            numbered = (
+                [] if n is None else [(n, dict(ev="status", kind="special", **fields))]
+            )
+        elif event == "progress":
+            kind = data["kind"]
+            numbered = [
+                (n, dict(tm=tm, ev="progress", kind=kind, text=text))
+                for (n, tm, text) in data["lines"]
+            ]
+        else:
+            return
+
+        with self.seqLock:
+            ring = self.rings.get(task, None)
+
+            if ring is None or ring.run != run:
+                ring = Ring(run, self.ringSize)
+                self.rings[task] = ring
+                self.mirrored.add(task)
+
+            for n, record in numbered:
+                if n is None or n < ring.n:
+                    continue
+
+                ring.n = n
+                ring.add([record])
+
+    def replay(self, task, seen, to):
+        """Send the events of the latest run of a task that a client has missed.
+
+        The events are taken from the ring, and if the ring does not reach back
+        far enough, from the run log.
+        The events are sent in a single `replay` event with payload
+
+            dict(task=task, run=run, skipped=skipped, records=[...])
+
+        where `skipped` is the number of missed events that have not been sent
+        because there are more of them than the replay limit.
+
+        Parameters
+        ----------
+        task: string
+            The key of the task.
+        seen: list or None
+            The run id and the sequence number of the last event of this task
+            that the client has seen, or None if it has seen nothing.
+            If the run id is not the one of the latest run, the client has seen
+            nothing of that run.
+        to: string
+            The session id of the client.
+        """
+        log = self.log
+        limit = self.ringSize if log is None else self.replayLimit
+
+        with self.seqLock:
+            ring = self.rings.get(task, None)
+
+            if ring is None:
+                return
+
+            run = ring.run
+            last = (
+                seen[1]
+                if seen and seen[0] == run and isinstance(seen[1], int)
+                else -1
+            )
+
+            if last >= ring.n - 1:
+                return
+
+            start = max(last + 1, ring.n - limit)
+            first = ring.first()
+            records = ring.since(start - 1)
+
+        if start < first and log is not None:
+            (logRun, older) = log.read(
+                task, run=run, start=start, end=first, limit=first - start
+            )
+            records = older + records
+
+        self.socketio.emit(
+            "replay",
+            dict(task=task, run=run, skipped=start - last - 1, records=records),
+            to=to,
+        )
+
+    def flush(self, task=None, kind=None, due=False):
+        """Emit pending batches.
+
+        Parameters
+        ----------
+        task: string, optional None
+            If given, only the batches of this task are emitted.
+        kind: string, optional None
+            If given, only the batches of this kind are emitted.
+        due: boolean, optional False
+            If True, only the batches that have been open longer than the time
+            window are emitted.
+        """
+        now = time.monotonic()
+
+        with self.batchLock:
+            keys = [
+                key
+                for (key, batch) in self.batches.items()
+                if (task is None or key[0] == task)
+                and (kind is None or key[1] == kind)
+                and (not due or now - batch["since"] >= self.window)
+            ]
+            ready = [(key, self.batches.pop(key)) for key in keys]
+
+        for key, batch in ready:
+            self.emitBatch(key, batch)
+
+    def emitBatch(self, key, batch):
+        """Emit a batch of progress lines.
+
+        Parameters
+        ----------
+        key: tuple
+            The task and kind of the batch.
+        batch: dict
+            The batch.
+        """
+        (task, kind) = key
+        run = batch["run"]
+        lines = batch["lines"]
+        self.send("progress", task, dict(task=task, run=run, kind=kind, lines=lines))
+
+    def startFlusher(self):
+        """Start the background task that emits batches whose time is up.
+
+        The flusher is started once, at the first progress line that is held
+        back.
+        """
+        if self.flusher is not None:
+            return
+
+        with self.batchLock:
+            if self.flusher is None:
+                self.flusher = self.socketio.start_background_task(self.runFlusher)
+
+    def runFlusher(self):
+        """Emit due batches, forever, once every time window."""
+        socketio = self.socketio
+
+        while True:
+            socketio.sleep(self.window)
+            self.flush(due=True)
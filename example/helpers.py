@@ -1,6 +1,10 @@
+import os
+import re
 import sys
 import time
 
+BACKENDS = ("github", "gitlab", "gitlab.huc.knaw.nl", "code.huc.knaw.nl")
+
 
 def console(msg):
     """Print something to stderr immediately (flush it).
@@ -9,13 +13,131 @@ def console(msg):
     sys.stderr.flush()
 
 
+def corpusDir(backend, org, repo):
+    """The directory where the files of a corpus reside.
+
+    See the conventions in the definition document: `~/backend/org/repo`.
+
+    Parameters
+    ----------
+    backend: string
+        One of the values in `BACKENDS`.
+    org, repo: string
+        The two parts of the corpus identifier.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown backend {backend}")
+
+    return os.path.expanduser(f"~/{backend}/{org}/{repo}")
+
+
+def camelToOption(name):
+    """The long command line option that goes with a keyword argument.
+
+    Workflow steps take the options of their scripts as keyword arguments in
+    camel case, e.g. `urlBase` for `--url-base`.
+
+    Parameters
+    ----------
+    name: string
+        The keyword argument, e.g. `urlBase`.
+
+    Returns
+    -------
+    string
+        The option without its leading dashes, e.g. `url-base`.
+    """
+    return re.sub(r"(?<!^)(?=[A-Z])", "-", name).lower()
+
+
+def taskTable(tasks):
+    """Create the HTML for the buttons, progress and status of tasks.
+
+    We create buttons to run and kill each task,
+    plus areas where the progress and status of each task are collected,
+    in a column per task.
+
+    Parameters
+    ----------
+    tasks: iterable of string
+        The keys of the tasks.
+    """
+    buttons = []
+    status = []
+    progress = []
+
+    for task in tasks:
+        buttons.append(
+            f"""
+            <button id="run{task}" type="button">Run {task}</button>
+            <button id="kill{task}" type="button">kill {task}</button>
+            """
+        )
+        progress.append(
+            f"""
+            <div id="progress{task}" class="msg"></div>
+            """
+        )
+        status.append(
+            f"""
+            <div id="status{task}" class="msg">not yet done</div>
+            """
+        )
+
+    def row(cells, tag, cls=""):
+        clsRep = f' class="{cls}"' if cls else ""
+        return "".join(f"<{tag}{clsRep}>{cell}</{tag}>" for cell in cells)
+
+    return f"""
+        <table border=1>
+            <tr>{row(buttons, "th")}</tr>
+            <tr>{row(progress, "td", cls="progress")}</tr>
+            <tr>{row(status, "td")}</tr>
+        </table>
+        """
+
+
+def subscriptions(auth, tasks):
+    """The tasks whose events a client wants, according to its `auth` data.
+
+    Parameters
+    ----------
+    auth: dict or None
+        The `auth` data that the client has passed when connecting.
+        Its key `tasks` holds the list of wanted tasks.
+    tasks: tuple of string
+        The tasks of the server.
+
+    Returns
+    -------
+    tuple of string
+        The wanted tasks; unknown tasks are ignored.
+        Clients that do not say which tasks they want, get all tasks.
+    """
+    wanted = (auth or {}).get("tasks", None)
+
+    if not isinstance(wanted, list):
+        return tasks
+
+    return tuple(task for task in tasks if task in wanted)
+
+
 class Timestamp:
     """Record elapsed time from a specific moment.
     """
     def __init__(self):
         """Upon creation, an instance records the current time.
         """
-        self.stamp = time.time()
+        self.stamp = time.monotonic()
+
+    def offset(self):
+        """Produce the number of seconds elapsed since the instance was created.
+
+        The number is rounded to hundredths of a second.
+        This is how elapsed times travel in events; clients format them as
+        `elapsed()` does.
+        """
+        return round(time.monotonic() - self.stamp, 2)
 
     def elapsed(self):
         """Produce the time that has elapsed since the instance was created.
@@ -25,7 +147,7 @@ class Timestamp:
 
         All times between 0 and 99 seconds take exactly 6 characters.
         """
-        interval = time.time() - self.stamp
+        interval = self.offset()
         if interval < 10:
             return f"{interval:5.2f}s"
         interval = int(round(interval))
@@ -0,0 +1,420 @@
+import os
+import time
+import sqlite3
+from statistics import median
+from contextlib import closing
+from threading import Lock
+
+SAMPLE = 10  # number of recent successful runs from which durations are estimated
+
+
+class History:
+    """Keep the history of task runs, and predict how long a run will take.
+
+    For every run we record the corpus, the task, the id of the run (see
+    `Emitter.begin()`), what triggered it, when it started and ended, how it
+    ended, and how many progress lines of each kind it produced.
+    For the steps of a workflow we record when they started and ended, and
+    how they ended.
+
+    The history is kept in an SQLite database, so that it survives restarts of
+    the server, and can be shared by several workers.
+    The latest run of every corpus and task is kept in a table of its own, so
+    that a dashboard can show them without going through all runs.
+
+    While a run is going on, we estimate how far it has got, from the durations
+    of the recent successful runs of the same task of the same corpus, see
+    `estimate()`.
+    """
+
+    def __init__(self, path, timeout=10.0):
+        """Open or create the history database.
+
+        Parameters
+        ----------
+        path: string
+            The path of the database file.
+        timeout: float, optional 10.0
+            The number of seconds to wait for a lock on the database.
+        """
+        self.path = path
+        self.timeout = timeout
+        self.current = {}
+        self.currentLock = Lock()
+
+        directory = os.path.dirname(path)
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with self.connect() as db:
+            db.execute("pragma journal_mode=wal")
+            db.execute(
+                """
+                create table if not exists runs (
+                    id integer primary key,
+                    corpus text not null,
+                    task text not null,
+                    run text,
+                    trigger text,
+                    start real not null,
+                    end real,
+                    stat text,
+                    msg text,
+                    nInfo integer,
+                    nWarning integer,
+                    nError integer
+                )
+                """
+            )
+            db.execute(
+                "create index if not exists runsByTask on runs (corpus, task, start)"
+            )
+            db.execute(
+                """
+                create table if not exists steps (
+                    runId integer not null,
+                    step text not null,
+                    start real not null,
+                    end real,
+                    stat text,
+                    primary key (runId, step)
+                )
+                """
+            )
+            db.execute(
+                """
+                create table if not exists latest (
+                    corpus text not null,
+                    task text not null,
+                    runId integer not null,
+                    primary key (corpus, task)
+                )
+                """
+            )
+
+    def connect(self):
+        """Open a connection to the database, to be used in a `with` statement."""
+        return closing(
+            sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        )
+
+    def begin(self, key, corpus, run, trigger):
+        """Record the start of a run.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task.
+        corpus: string or None
+            The corpus whose task is run.
+        run: string
+            The id of the run.
+        trigger: string
+            What has started the run, e.g. `user`.
+        """
+        corpus = corpus or ""
+        start = time.time()
+
+        with self.connect() as db:
+            db.execute("begin immediate")
+            cursor = db.execute(
+                "insert into runs (corpus, task, run, trigger, start)"
+                " values (?, ?, ?, ?, ?)",
+                (corpus, key, run, trigger, start),
+            )
+            runId = cursor.lastrowid
+            db.execute(
+                "insert or replace into latest (corpus, task, runId) values (?, ?, ?)",
+                (corpus, key, runId),
+            )
+            db.execute("commit")
+
+            (expected, stepExpected) = self.expected(db, corpus, key)
+
+        with self.currentLock:
+            self.current[key] = dict(
+                runId=runId,
+                start=start,
+                expected=expected,
+                stepExpected=stepExpected,
+                steps={},
+            )
+
+    def expected(self, db, corpus, key):
+        """The expected duration of a run, from its recent successful runs.
+
+        Parameters
+        ----------
+        db: object
+            An open connection to the database.
+        corpus: string
+            The corpus.
+        key: string
+            The key of the task.
+
+        Returns
+        -------
+        tuple
+            The median duration of the runs, None if there are no such runs,
+            and a dict with the median duration of each step in those runs.
+        """
+        rows = db.execute(
+            "select id, end - start from runs"
+            " where corpus = ? and task = ?"
+            " and stat in ('success', 'success-warnings')"
+            " order by start desc limit ?",
+            (corpus, key, SAMPLE),
+        ).fetchall()
+
+        if not rows:
+            return (None, {})
+
+        runIds = [row[0] for row in rows]
+        durations = {}
+
+        for step, duration in db.execute(
+            "select step, end - start from steps"
+            f" where runId in ({', '.join('?' for runId in runIds)})"
+            " and stat = 'success'",
+            runIds,
+        ):
+            durations.setdefault(step, []).append(duration)
+
+        return (
+            median(row[1] for row in rows),
+            {step: median(values) for (step, values) in durations.items()},
+        )
+
+    def stepStart(self, key, step):
+        """Record the start of a step of a run.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task that runs the workflow.
+        step: string
+            The name of the step.
+        """
+        start = time.time()
+
+        with self.currentLock:
+            current = self.current.get(key, None)
+
+            if current is None:
+                return
+
+            current["steps"][step] = [start, None]
+            runId = current["runId"]
+
+        with self.connect() as db:
+            db.execute(
+                "insert or replace into steps (runId, step, start) values (?, ?, ?)",
+                (runId, step, start),
+            )
+
+    def stepEnd(self, key, step, stat):
+        """Record the end of a step of a run.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task that runs the workflow.
+        step: string
+            The name of the step.
+        stat: string
+            The status with which the step ended.
+        """
+        end = time.time()
+
+        with self.currentLock:
+            current = self.current.get(key, None)
+
+            if current is None or step not in current["steps"]:
+                return
+
+            current["steps"][step][1] = end
+            runId = current["runId"]
+
+        with self.connect() as db:
+            db.execute(
+                "update steps set end = ?, stat = ? where runId = ? and step = ?",
+                (end, stat, runId, step),
+            )
+
+    def end(self, key, stat, msg, counts):
+        """Record the end of a run.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task.
+        stat: string
+            The status with which the run ended.
+        msg: string
+            An additional message.
+        counts: dict
+            The number of progress lines per severity: `info`, `warning`,
+            `error`.
+        """
+        with self.currentLock:
+            current = self.current.pop(key, None)
+
+        if current is None:
+            return
+
+        with self.connect() as db:
+            db.execute(
+                "update runs set end = ?, stat = ?, msg = ?,"
+                " nInfo = ?, nWarning = ?, nError = ? where id = ?",
+                (
+                    time.time(),
+                    stat,
+                    msg,
+                    counts.get("info", 0),
+                    counts.get("warning", 0),
+                    counts.get("error", 0),
+                    current["runId"],
+                ),
+            )
+
+    def running(self):
+        """The keys of the tasks whose runs are going on."""
+        with self.currentLock:
+            return list(self.current)
+
+    def estimate(self, key):
+        """Estimate how far a run has got, and how long it will take to finish.
+
+        If the task is a workflow and there are durations of its steps, the
+        progress is the part of the expected work of the steps that has been done:
+        steps that have ended count fully, running steps by the time they have
+        run so far, but never fully.
+        Otherwise the progress is the part of the expected duration that has
+        passed.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task.
+
+        Returns
+        -------
+        dict
+            With keys `pct`, the percentage done, and `eta`, the expected number
+            of seconds until the end. Empty if there is no run going on, or no
+            successful run to compare with.
+        """
+        now = time.time()
+
+        with self.currentLock:
+            current = self.current.get(key, None)
+
+            if current is None or current["expected"] is None:
+                return {}
+
+            expected = current["expected"]
+            stepExpected = current["stepExpected"]
+            steps = dict(current["steps"])
+            elapsed = now - current["start"]
+
+        total = sum(stepExpected.values())
+
+        if total > 0:
+            done = 0
+
+            for step, (start, end) in steps.items():
+                weight = stepExpected.get(step, 0)
+
+                if end is not None:
+                    done += weight
+                elif weight > 0:
+                    done += min((now - start) / weight, 0.9) * weight
+
+            fraction = min(done / total, 0.99)
+            eta = expected * (1 - fraction)
+        else:
+            fraction = min(elapsed / expected, 0.99) if expected > 0 else 0.99
+            eta = max(expected - elapsed, 0)
+
+        return dict(pct=round(fraction * 100), eta=round(eta))
+
+    def latest(self):
+        """The latest run of every corpus and task.
+
+        Returns
+        -------
+        list of dict
+            See `runs()`.
+        """
+        with self.connect() as db:
+            rows = db.execute(
+                "select runs.* from latest join runs on runs.id = latest.runId"
+                " order by latest.corpus, latest.task"
+            ).fetchall()
+            return self.asDicts(db, rows)
+
+    def runs(self, corpus, key, limit=20):
+        """The most recent runs of a task of a corpus, with their steps.
+
+        Parameters
+        ----------
+        corpus: string or None
+            The corpus.
+        key: string
+            The key of the task.
+        limit: integer, optional 20
+            The maximum number of runs.
+
+        Returns
+        -------
+        list of dict
+            Each with the fields of the run, and in `steps` the steps of the run,
+            each with the fields `step`, `start`, `end`, `stat`.
+            Times are in seconds since the epoch.
+        """
+        with self.connect() as db:
+            rows = db.execute(
+                "select * from runs where corpus = ? and task = ?"
+                " order by start desc limit ?",
+                (corpus or "", key, limit),
+            ).fetchall()
+            return self.asDicts(db, rows)
+
+    def asDicts(self, db, rows):
+        """Turn rows of the runs table into dicts, and add their steps."""
+        fields = (
+            "id",
+            "corpus",
+            "task",
+            "run",
+            "trigger",
+            "start",
+            "end",
+            "stat",
+            "msg",
+            "nInfo",
+            "nWarning",
+            "nError",
+        )
+        runs = [dict(zip(fields, row)) for row in rows]
+
+        if not runs:
+            return runs
+
+        byId = {run["id"]: run for run in runs}
+
+        for run in runs:
+            run["steps"] = []
+
+        for runId, step, start, end, stat in db.execute(
+            "select runId, step, start, end, stat from steps"
+            f" where runId in ({', '.join('?' for runId in byId)})"
+            " order by start",
+            list(byId),
+        ):
+            byId[runId]["steps"].append(
+                dict(step=step, start=start, end=end, stat=stat)
+            )
+
+        return runs
@@ -0,0 +1,713 @@
+"""Generate IIIF image derivatives and manifests in a pool of worker processes.
+
+Usage on the command line:
+
+    python iiif.py scanDir outDir [--base URL] [--sizes 150,600] [--tile 512]
+        [--quality 85] [--workers N] [--shards M]
+
+*   `scanDir`: the directory with the scans, JPEG, PNG, GIF or TIFF files;
+*   `outDir`: the directory where the images, the manifests and the state are
+    written;
+*   `--base`: the URL under which `outDir` is served (default: `/iiif`);
+*   `--sizes`: the widths of the scaled versions, such as thumbnails, that are
+    made of every scan, comma separated (default: `150,600`);
+*   `--tile`: the width and height of the tiles, 0 for no tiles (default: 512);
+*   `--quality`: the JPEG quality of the derivatives (default: 85);
+*   `--workers`: the number of worker processes (default: the number of cores
+    that this process may use);
+*   `--shards`: the number of shards (default: 4 per worker).
+
+The images are laid out as a static IIIF Image API 3 service at level 0, under
+`outDir/images`, with an `info.json` per scan, so that any web server can serve
+them. The manifests are IIIF Presentation 3 manifests, one per directory of
+scans, under `outDir/manifests`.
+
+The work is incremental. The state of every scan is kept in an SQLite database,
+`outDir/state.db`: the digest of its contents, the parameters of its
+derivatives, and its dimensions and format. A scan is only processed again if
+its file has changed and its digest is different, or if the parameters have
+changed. Scans that have gone, lose their derivatives. The manifests are made
+from the state alone, without opening any image, and are only written when they
+have changed.
+
+The derivatives are made with Pillow. Without Pillow, the dimensions and format
+are read from the headers of the files, and the only derivative of a scan is
+the scan itself, as its full size image, without scaled versions or tiles.
+
+Every scan that is processed is reported on a line of its own, tagged with its
+shard, see `shard.py`.
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import zlib
+import struct
+import random
+import sqlite3
+import hashlib
+import argparse
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from cache import place, remove
+from dag import Step
+from shard import findDocs, makeShards, say
+
+EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".tif", ".tiff")
+MIME_TYPES = dict(jpg="image/jpeg", png="image/png", gif="image/gif", tif="image/tiff")
+FORMATS = dict(JPEG="jpg", PNG="png", GIF="gif", TIFF="tif")
+CHUNK = 1 << 20  # bytes read at a time when hashing files
+CONTEXT = "http://iiif.io/api/presentation/3/context.json"
+IMAGE_CONTEXT = "http://iiif.io/api/image/3/context.json"
+
+
+def makeScans(outDir, n, pages=2, seed=1):
+    """Generate synthetic scans of the demo letters, if they are not there already.
+
+    The scans are grayscale PNG files, written without any imaging library.
+
+    Parameters
+    ----------
+    outDir: string
+        The directory where the scans are written.
+    n: integer
+        The number of letters that get scans, see `tei.makeLetters()`.
+    pages: integer, optional 2
+        The number of pages per letter.
+    seed: integer, optional 1
+        The seed of the random generator, so that the scans are always the same.
+
+    Returns
+    -------
+    integer
+        The number of scans that have been written.
+    """
+    R = random.Random(seed)
+    nWritten = 0
+
+    def chunk(kind, data):
+        return (
+            struct.pack(">I", len(data))
+            + kind
+            + data
+            + struct.pack(">I", zlib.crc32(kind + data))
+        )
+
+    for i in range(1, n + 1):
+        for p in range(1, pages + 1):
+            path = f"{outDir}/{i // 100:03d}/letter{i:05d}-{p}.png"
+            width = R.randint(300, 500)
+            height = width * 7 // 5
+            shade = R.randint(0, 255)
+
+            if os.path.exists(path):
+                continue
+
+            rows = [
+                b"\0" + bytes((x // 3 + k * 16 + shade) & 255 for x in range(width))
+                for k in range(16)
+            ]
+            raw = b"".join(rows[(y // 20 + i) % 16] for y in range(height))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            with open(path, "wb") as fh:
+                fh.write(b"\x89PNG\r\n\x1a\n")
+                fh.write(
+                    chunk(
+                        b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)
+                    )
+                )
+                fh.write(chunk(b"IDAT", zlib.compress(raw, 6)))
+                fh.write(chunk(b"IEND", b""))
+
+            nWritten += 1
+
+    return nWritten
+
+
+def headerInfo(path):
+    """Read the dimensions and format of an image from its header.
+
+    This is the fallback if there is no Pillow, for PNG, GIF and JPEG files.
+
+    Parameters
+    ----------
+    path: string
+        The image file.
+
+    Returns
+    -------
+    tuple
+        The width, height and format, such as `png`.
+
+    Raises
+    ------
+    ValueError
+        If the file is not an image of a known format.
+    """
+    with open(path, "rb") as fh:
+        head = fh.read(32)
+
+        if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR":
+            (width, height) = struct.unpack(">II", head[16:24])
+            return (width, height, "png")
+
+        if head[0:6] in {b"GIF87a", b"GIF89a"}:
+            (width, height) = struct.unpack("<HH", head[6:10])
+            return (width, height, "gif")
+
+        if head.startswith(b"\xff\xd8"):
+            fh.seek(2)
+
+            while True:
+                marker = fh.read(4)
+
+                if len(marker) < 4 or marker[0] != 0xFF:
+                    break
+
+                size = struct.unpack(">H", marker[2:4])[0]
+
+                # the start of frame markers, except DHT, JPG and DAC
+                if 0xC0 <= marker[1] <= 0xCF and marker[1] not in {0xC4, 0xC8, 0xCC}:
+                    (height, width) = struct.unpack(">xHH", fh.read(5))
+                    return (width, height, "jpg")
+
+                fh.seek(size - 2, 1)
+
+    raise ValueError("not an image in a known format")
+
+
+def fileDigest(path):
+    """The SHA-256 digest of the contents of a file."""
+    h = hashlib.sha256()
+
+    with open(path, "rb") as fh:
+        while chunk := fh.read(CHUNK):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def imageId(relPath):
+    """The identifier of the image of a scan: its path without extension."""
+    return os.path.splitext(relPath)[0]
+
+
+def makeDerivatives(src, dst, params):
+    """Make the derivatives of a scan.
+
+    Parameters
+    ----------
+    src: string
+        The scan.
+    dst: string
+        The directory of the image, which must not exist yet.
+    params: dict
+        The derivative parameters: `sizes`, `tile` and `quality`.
+
+    Returns
+    -------
+    tuple
+        The width, height and format of the scan, the format of its full
+        image, the scaled sizes, the scale factors of the tiles, and the number
+        of files written.
+    """
+    os.makedirs(f"{dst}/full/max/0")
+
+    if Image is None:
+        (width, height, fmt) = headerInfo(src)
+        place(src, f"{dst}/full/max/0/default.{fmt}")
+        return (width, height, fmt, fmt, [], [], 1)
+
+    quality = params["quality"]
+    tile = params["tile"]
+    sizes = []
+    factors = []
+    nFiles = 1
+
+    with Image.open(src) as im:
+        (width, height) = im.size
+        fmt = FORMATS.get(im.format, im.format.lower())
+        im = im.convert("L" if im.mode in {"1", "L", "I;16"} else "RGB")
+        im.save(f"{dst}/full/max/0/default.jpg", quality=quality)
+
+        for w in params["sizes"]:
+            if w >= width:
+                continue
+
+            h = max(1, round(height * w / width))
+            os.makedirs(f"{dst}/full/{w},/0")
+            im.resize((w, h), Image.LANCZOS).save(
+                f"{dst}/full/{w},/0/default.jpg", quality=quality
+            )
+            sizes.append((w, h))
+            nFiles += 1
+
+        factor = 1
+
+        while tile and (factor == 1 or tile * factor // 2 < max(width, height)):
+            factors.append(factor)
+            span = tile * factor
+
+            for y in range(0, height, span):
+                for x in range(0, width, span):
+                    rw = min(span, width - x)
+                    rh = min(span, height - y)
+                    tw = -(-rw // factor)
+                    th = -(-rh // factor)
+                    region = f"{dst}/{x},{y},{rw},{rh}/{tw},/0"
+                    os.makedirs(region)
+                    im.crop((x, y, x + rw, y + rh)).resize(
+                        (tw, th), Image.LANCZOS
+                    ).save(f"{region}/default.jpg", quality=quality)
+                    nFiles += 1
+
+            factor *= 2
+
+    return (width, height, fmt, "jpg", sizes, factors, nFiles)
+
+
+def infoJson(base, relPath, meta, tile):
+    """The IIIF Image API `info.json` of a scan.
+
+    Parameters
+    ----------
+    base: string
+        The URL under which the output directory is served.
+    relPath: string
+        The scan.
+    meta: dict
+        The metadata of the scan, as kept in the state.
+    tile: integer
+        The size of the tiles.
+
+    Returns
+    -------
+    dict
+    """
+    info = {
+        "@context": IMAGE_CONTEXT,
+        "id": f"{base}/images/{imageId(relPath)}",
+        "type": "ImageService3",
+        "protocol": "http://iiif.io/api/image",
+        "profile": "level0",
+        "width": meta["width"],
+        "height": meta["height"],
+        "sizes": [dict(width=w, height=h) for (w, h) in meta["sizes"]]
+        + [dict(width=meta["width"], height=meta["height"])],
+        "preferredFormats": [meta["full"]],
+    }
+
+    if meta["factors"]:
+        info["tiles"] = [dict(width=tile, scaleFactors=meta["factors"])]
+
+    return info
+
+
+def runShard(scanDir, outDir, base, params, tag, todo):
+    """Process the scans of one shard.
+
+    This runs in a worker process.
+    A scan whose file has changed, but whose contents are the same as when its
+    derivatives were made, keeps its derivatives.
+
+    Parameters
+    ----------
+    scanDir: string
+        The directory with the scans.
+    outDir: string
+        The output directory.
+    base: string
+        The URL under which the output directory is served.
+    params: dict
+        The derivative parameters.
+    tag: string
+        The tag of the shard, which is prefixed to every output line.
+    todo: list of tuple
+        The scans of the shard, as relative path, with the digest and parameters
+        with which its derivatives have been made, if any.
+
+    Returns
+    -------
+    tuple
+        The new states, keyed by scan, and the errors, keyed by scan.
+    """
+    paramsRep = json.dumps(params, sort_keys=True)
+    states = {}
+    errors = {}
+
+    def report(kind, text):
+        fd = 2 if kind == "error" else 1
+        os.write(fd, f"{tag} {text}\n".encode("utf-8"))
+
+    for relPath, oldDigest, oldParams in todo:
+        src = f"{scanDir}/{relPath}"
+        dst = f"{outDir}/images/{imageId(relPath)}"
+
+        try:
+            info = os.stat(src)
+            digest = fileDigest(src)
+
+            if digest == oldDigest and paramsRep == oldParams and os.path.isdir(dst):
+                states[relPath] = dict(
+                    stat=(info.st_size, info.st_mtime_ns, info.st_ino), meta=None
+                )
+                report("info", f"{relPath}: unchanged contents")
+                continue
+
+            start = time.perf_counter()
+            tmp = f"{outDir}/images/tmp-{uuid.uuid4().hex}"
+
+            try:
+                (width, height, fmt, full, sizes, factors, nFiles) = makeDerivatives(
+                    src, tmp, params
+                )
+                meta = dict(
+                    width=width,
+                    height=height,
+                    format=fmt,
+                    full=full,
+                    sizes=sizes,
+                    factors=factors,
+                )
+
+                with open(f"{tmp}/info.json", "w") as fh:
+                    json.dump(infoJson(base, relPath, meta, params["tile"]), fh)
+
+                remove(dst)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                os.rename(tmp, dst)
+            finally:
+                remove(tmp)
+
+            states[relPath] = dict(
+                stat=(info.st_size, info.st_mtime_ns, info.st_ino),
+                digest=digest,
+                params=paramsRep,
+                meta=meta,
+            )
+            report(
+                "info",
+                f"{relPath}: {width}x{height} {fmt}, {nFiles} files"
+                f" in {time.perf_counter() - start:.2f}s",
+            )
+        except Exception as e:
+            errors[relPath] = str(e)
+            report("error", f"{relPath}: {e}")
+
+    report("info", f"done: {len(states)} scans, {len(errors)} errors")
+    return (states, errors)
+
+
+def makeManifests(outDir, base, scans):
+    """Write the manifests, one per directory of scans, if they have changed.
+
+    Parameters
+    ----------
+    outDir: string
+        The output directory.
+    base: string
+        The URL under which the output directory is served.
+    scans: dict
+        The metadata of the scans, keyed by relative path.
+
+    Returns
+    -------
+    integer
+        The number of manifests that have been written.
+    """
+    groups = {}
+
+    for relPath in sorted(scans):
+        groups.setdefault(os.path.dirname(relPath), []).append(relPath)
+
+    manifestDir = f"{outDir}/manifests"
+    os.makedirs(manifestDir, exist_ok=True)
+    names = set()
+    nWritten = 0
+
+    for group, relPaths in groups.items():
+        name = group.replace("/", "-") or "scans"
+        names.add(f"{name}.json")
+        manifestId = f"{base}/manifests/{name}.json"
+        canvases = []
+
+        for relPath in relPaths:
+            meta = scans[relPath]
+            service = f"{base}/images/{imageId(relPath)}"
+            canvasId = f"{base}/canvas/{imageId(relPath)}"
+            body = {
+                "id": f"{service}/full/max/0/default.{meta['full']}",
+                "type": "Image",
+                "format": MIME_TYPES.get(meta["full"], None),
+                "width": meta["width"],
+                "height": meta["height"],
+                "service": [dict(id=service, type="ImageService3", profile="level0")],
+            }
+            painting = {
+                "id": f"{canvasId}/page/image",
+                "type": "Annotation",
+                "motivation": "painting",
+                "target": canvasId,
+                "body": body,
+            }
+            canvas = {
+                "id": canvasId,
+                "type": "Canvas",
+                "label": {"none": [os.path.basename(imageId(relPath))]},
+                "width": meta["width"],
+                "height": meta["height"],
+                "items": [
+                    {
+                        "id": f"{canvasId}/page",
+                        "type": "AnnotationPage",
+                        "items": [painting],
+                    }
+                ],
+            }
+
+            if meta["sizes"]:
+                (w, h) = meta["sizes"][0]
+                canvas["thumbnail"] = [
+                    {
+                        "id": f"{service}/full/{w},/0/default.jpg",
+                        "type": "Image",
+                        "format": "image/jpeg",
+                        "width": w,
+                        "height": h,
+                    }
+                ]
+
+            canvases.append(canvas)
+
+        manifest = {
+            "@context": CONTEXT,
+            "id": manifestId,
+            "type": "Manifest",
+            "label": {"none": [group or "scans"]},
+            "items": canvases,
+        }
+        text = json.dumps(manifest, ensure_ascii=False, indent=1)
+        path = f"{manifestDir}/{name}.json"
+
+        if os.path.exists(path):
+            with open(path) as fh:
+                if fh.read() == text:
+                    continue
+
+        with open(f"{path}.tmp", "w") as fh:
+            fh.write(text)
+
+        os.replace(f"{path}.tmp", path)
+        nWritten += 1
+
+    for name in os.listdir(manifestDir):
+        if name not in names:
+            remove(f"{manifestDir}/{name}")
+
+    return nWritten
+
+
+def connect(outDir):
+    """Open the state database, to be used in a `with` statement."""
+    return closing(
+        sqlite3.connect(f"{outDir}/state.db", timeout=10.0, isolation_level=None)
+    )
+
+
+def iiifStep(name, scanDir, outDir, base=None, workers=None, **kwargs):
+    """A workflow step that generates IIIF derivatives and manifests.
+
+    The step declares no outputs, so it is not cached by the step cache:
+    it is incremental by itself, and keeps its outputs between runs.
+
+    Parameters
+    ----------
+    name: string
+        The name of the step.
+    scanDir: string
+        The directory with the scans.
+    outDir: string
+        The output directory.
+    base: string, optional None
+        The URL under which the output directory is served.
+    workers: integer, optional None
+        The number of worker processes, by default the number of cores.
+    **kwargs: any
+        Further arguments for `Step`, such as `deps`.
+
+    Returns
+    -------
+    object
+        The `Step`.
+    """
+    command = [sys.executable, "iiif.py", scanDir, outDir]
+
+    if base is not None:
+        command.extend(["--base", base])
+
+    if workers is not None:
+        command.extend(["--workers", str(workers)])
+
+    return Step(name, command=command, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="make IIIF images and manifests")
+    parser.add_argument("scanDir")
+    parser.add_argument("outDir")
+    parser.add_argument("--base", default="/iiif")
+    parser.add_argument("--sizes", default="150,600")
+    parser.add_argument("--tile", type=int, default=512)
+    parser.add_argument("--quality", type=int, default=85)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--shards", type=int, default=None)
+    args = parser.parse_args()
+
+    base = args.base.rstrip("/")
+    params = dict(
+        sizes=sorted(int(w) for w in args.sizes.split(",") if w),
+        tile=args.tile,
+        quality=args.quality,
+        pillow=Image is not None,
+    )
+    paramsRep = json.dumps(params, sort_keys=True)
+    os.makedirs(f"{args.outDir}/images", exist_ok=True)
+
+    if Image is None:
+        say("warning: no Pillow: only full size images, no scaled versions or tiles")
+
+    with connect(args.outDir) as db:
+        db.execute("pragma journal_mode=wal")
+        db.execute("""
+            create table if not exists scans (
+                path text primary key,
+                size integer not null,
+                mtime integer not null,
+                inode integer not null,
+                digest text not null,
+                params text not null,
+                meta text not null
+            )
+            """)
+        known = {
+            row[0]: row[1:]
+            for row in db.execute(
+                "select path, size, mtime, inode, digest, params, meta from scans"
+            )
+        }
+
+    scans = findDocs(args.scanDir, EXTENSIONS)
+    todo = {}
+
+    for relPath in scans:
+        row = known.get(relPath, None)
+
+        if row is not None:
+            (size, mtime, inode, digest, oldParams, meta) = row
+            info = os.stat(f"{args.scanDir}/{relPath}")
+
+            if (
+                (size, mtime, inode) == (info.st_size, info.st_mtime_ns, info.st_ino)
+                and oldParams == paramsRep
+                and os.path.isdir(f"{args.outDir}/images/{imageId(relPath)}")
+            ):
+                continue
+
+            todo[relPath] = (relPath, digest, oldParams)
+        else:
+            todo[relPath] = (relPath, None, None)
+
+    gone = sorted(set(known) - set(scans))
+    workers = args.workers or len(os.sched_getaffinity(0))
+    nShards = max(1, min(args.shards or 4 * workers, len(todo)))
+    shards = makeShards({relPath: scans[relPath] for relPath in todo}, nShards)
+    nShards = len(shards)
+    width = len(str(nShards))
+    tags = [f"[shard {i + 1:0{width}}/{nShards}]" for i in range(nShards)]
+    say(
+        f"{len(scans)} scans: {len(scans) - len(todo)} unchanged, {len(todo)} to do"
+        f" in {nShards} shards over {workers} workers, {len(gone)} gone"
+    )
+    states = {}
+    errors = {}
+
+    if shards:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(
+                    runShard,
+                    args.scanDir,
+                    args.outDir,
+                    base,
+                    params,
+                    tags[i],
+                    [todo[relPath] for relPath in shard],
+                )
+                for (i, shard) in enumerate(shards)
+            ]
+
+            for future in as_completed(futures):
+                (shardStates, shardErrors) = future.result()
+                states.update(shardStates)
+                errors.update(shardErrors)
+
+    with connect(args.outDir) as db:
+        db.execute("begin immediate")
+
+        for relPath, state in states.items():
+            (size, mtime, inode) = state["stat"]
+
+            if state["meta"] is None:
+                db.execute(
+                    "update scans set size = ?, mtime = ?, inode = ? where path = ?",
+                    (size, mtime, inode, relPath),
+                )
+            else:
+                db.execute(
+                    "insert or replace into scans"
+                    " (path, size, mtime, inode, digest, params, meta)"
+                    " values (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        relPath,
+                        size,
+                        mtime,
+                        inode,
+                        state["digest"],
+                        state["params"],
+                        json.dumps(state["meta"]),
+                    ),
+                )
+
+        for relPath in gone + sorted(errors):
+            db.execute("delete from scans where path = ?", (relPath,))
+
+        db.execute("commit")
+        metas = {
+            row[0]: json.loads(row[1])
+            for row in db.execute("select path, meta from scans")
+        }
+
+    for relPath in gone + sorted(errors):
+        remove(f"{args.outDir}/images/{imageId(relPath)}")
+
+    nManifests = makeManifests(args.outDir, base, metas)
+    nMade = sum(1 for state in states.values() if state["meta"] is not None)
+    say(
+        f"{nMade} scans processed, {len(states) - nMade} with unchanged contents,"
+        f" {len(gone)} removed, {len(errors)} errors;"
+        f" {nManifests} manifests written"
+    )
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
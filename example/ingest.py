@@ -0,0 +1,602 @@
+"""Upload the segmented texts and annotations of a corpus to TextRepo or AnnoRepo.
+
+Usage on the command line:
+
+    python ingest.py target inPath stateDir --url URL [--container NAME]
+        [--type NAME] [--batch N] [--inflight N] [--retries N] [--backoff S]
+        [--api-key KEY] [--fresh]
+
+*   `target`: `textrepo` or `annorepo`;
+*   `inPath`: the result of the WATM step, see `tei.watm()` and `shard.py`;
+*   `stateDir`: the directory where the acknowledged batches are remembered;
+*   `--url`: the URL of the server, e.g. `http://localhost:8090` for the
+    stand-in server, see `standin.py`;
+*   `--container`: the AnnoRepo container of the annotations
+    (default: `preview`);
+*   `--type`: the TextRepo type of the texts (default: `segmented_text`);
+*   `--batch`: the number of items per batch: annotations in one request to
+    AnnoRepo, or documents that are uploaded in a row to TextRepo
+    (default: 100 for AnnoRepo, 10 for TextRepo);
+*   `--inflight`: the maximum number of batches that are being sent at the same
+    time (default: 4);
+*   `--retries`: the number of times a failed request is tried again
+    (default: 5);
+*   `--backoff`: the number of seconds before the first retry; every next retry
+    waits twice as long, with some jitter, unless the server says how long to
+    wait (default: 0.5);
+*   `--api-key`: sent as bearer token, if given;
+*   `--fresh`: forget the acknowledged batches and upload everything.
+
+Requests go over a pool of connections that are kept alive, one per batch in
+flight, so that there is no connection set-up per request.
+Requests that fail with a connection error, `429 Too Many Requests` or a
+server error are retried with exponential backoff. Other failures are not
+retried.
+
+Every batch that the server has acknowledged is recorded in the state file.
+When an ingest is stopped or fails, the next ingest of the same input skips the
+batches that have been acknowledged already. The batches that were in flight
+when it stopped are sent again, so an item may arrive twice. A different input,
+batch size or destination starts afresh.
+
+The throughput is reported about every second.
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import random
+import hashlib
+import argparse
+import http.client
+from threading import Lock
+from urllib.parse import quote, urlsplit
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from dag import Step
+from helpers import camelToOption
+from shard import say
+
+TARGETS = ("textrepo", "annorepo")
+BATCH_SIZES = dict(textrepo=10, annorepo=100)
+CONTAINER_CONTEXT = [
+    "http://www.w3.org/ns/anno.jsonld",
+    "http://www.w3.org/ns/ldp.jsonld",
+]
+ANNOTATION_TYPE = 'application/ld+json; profile="http://www.w3.org/ns/anno.jsonld"'
+REPORT_INTERVAL = 1.0  # seconds between throughput reports
+
+
+class Pool:
+    """A pool of HTTP connections to one server that are kept alive.
+
+    A connection is taken from the pool for a request, and put back when the
+    response has been read completely, unless the server closes it.
+    """
+
+    def __init__(self, url, timeout=60.0, headers={}):
+        """Create a pool.
+
+        Parameters
+        ----------
+        url: string
+            The URL of the server; its path is a prefix of the request paths.
+        timeout: float, optional 60.0
+            The number of seconds to wait for a connection or a response.
+        headers: dict, optional {}
+            Headers that are sent with every request.
+        """
+        parts = urlsplit(url)
+        self.connectionClass = (
+            http.client.HTTPSConnection
+            if parts.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip("/")
+        self.timeout = timeout
+        self.headers = headers
+        self.idle = queue.LifoQueue()
+        self.nConnections = 0
+        self.countLock = Lock()
+
+    def request(self, method, path, body=None, headers={}):
+        """Send a request and read the response.
+
+        Parameters
+        ----------
+        method: string
+            The HTTP method.
+        path: string
+            The path, after the prefix of the server URL.
+        body: bytes, optional None
+            The body of the request.
+        headers: dict, optional {}
+            Headers for this request.
+
+        Returns
+        -------
+        tuple
+            The status, the headers and the body of the response.
+
+        Raises
+        ------
+        OSError or http.client.HTTPException
+            If the connection fails. The connection is then discarded.
+        """
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = self.connectionClass(self.netloc, timeout=self.timeout)
+
+            with self.countLock:
+                self.nConnections += 1
+
+        try:
+            conn.request(
+                method, f"{self.prefix}{path}", body, {**self.headers, **headers}
+            )
+            response = conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self.idle.put(conn)
+
+        return (response.status, dict(response.getheaders()), data)
+
+    def close(self):
+        """Close the idle connections."""
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def multipart(name, filename, contents, contentType):
+    """Encode a file as multipart form data.
+
+    Returns
+    -------
+    tuple
+        The body and its content type.
+    """
+    boundary = uuid.uuid4().hex
+    head = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+        f"Content-Type: {contentType}\r\n\r\n"
+    )
+    body = head.encode("utf-8") + contents + f"\r\n--{boundary}--\r\n".encode()
+    return (body, f"multipart/form-data; boundary={boundary}")
+
+
+def getItems(target, inPath):
+    """Read the items to upload from the result of the WATM step.
+
+    Parameters
+    ----------
+    target: string
+        `textrepo`: the items are the segmented texts of the documents;
+        `annorepo`: the items are the annotations.
+    inPath: string
+        The result of the WATM step.
+
+    Returns
+    -------
+    list
+    """
+    with open(inPath) as fh:
+        results = json.load(fh)["results"]
+
+    if target == "textrepo":
+        return [
+            dict(externalId=doc["id"], segments=doc["segments"])
+            for doc in results.values()
+        ]
+
+    return [annotation for doc in results.values() for annotation in doc["annotations"]]
+
+
+class Ingest:
+    """Upload items to a server in batches, with bounded concurrency and retries.
+
+    See the description of this module.
+    """
+
+    def __init__(
+        self,
+        target,
+        url,
+        stateDir,
+        container="preview",
+        typeName="segmented_text",
+        inflight=4,
+        retries=5,
+        backoff=0.5,
+        apiKey=None,
+        report=say,
+    ):
+        """Prepare an ingest.
+
+        Parameters
+        ----------
+        target: string
+            `textrepo` or `annorepo`.
+        url: string
+            The URL of the server.
+        stateDir: string
+            The directory of the state file.
+        container: string, optional "preview"
+            The AnnoRepo container.
+        typeName: string, optional "segmented_text"
+            The TextRepo type.
+        inflight: integer, optional 4
+            The maximum number of batches that are sent at the same time.
+        retries: integer, optional 5
+            The number of retries of a failed request.
+        backoff: float, optional 0.5
+            The number of seconds before the first retry.
+        apiKey: string, optional None
+            Sent as bearer token.
+        report: function, optional say
+            Called with a line of text to report progress.
+        """
+        if target not in TARGETS:
+            raise ValueError(f"unknown target {target}")
+
+        self.target = target
+        self.url = url
+        self.container = container
+        self.typeName = typeName
+        self.inflight = max(1, inflight)
+        self.retries = retries
+        self.backoff = backoff
+        self.report = report
+        headers = {} if apiKey is None else dict(Authorization=f"Bearer {apiKey}")
+        self.pool = Pool(url, headers=headers)
+        self.statePath = f"{stateDir}/{target}.json"
+        self.lock = Lock()
+        self.stats = dict(items=0, bytes=0, requests=0, retries=0)
+        os.makedirs(stateDir, exist_ok=True)
+
+    def send(self, method, path, body=None, headers={}, ok=()):
+        """Send a request, and retry it if it fails in a way that may pass.
+
+        Parameters
+        ----------
+        method, path, body, headers:
+            See `Pool.request()`.
+        ok: iterable of integer, optional ()
+            Statuses, apart from the 2xx ones, that count as success.
+
+        Returns
+        -------
+        tuple
+            The status and the body of the response.
+
+        Raises
+        ------
+        RuntimeError
+            If the request fails for good.
+        """
+        for attempt in range(self.retries + 1):
+            delay = None
+
+            try:
+                (status, respHeaders, data) = self.pool.request(
+                    method, path, body, headers
+                )
+            except (OSError, http.client.HTTPException) as e:
+                problem = str(e) or type(e).__name__
+            else:
+                with self.lock:
+                    self.stats["requests"] += 1
+                    self.stats["bytes"] += len(body or b"")
+
+                if 200 <= status < 300 or status in ok:
+                    return (status, data)
+
+                problem = f"{status} {data[0:200].decode('utf-8', 'replace')}"
+
+                if status != 429 and status < 500:
+                    raise RuntimeError(f"{method} {path}: {problem}")
+
+                retryAfter = respHeaders.get("Retry-After", "")
+                delay = float(retryAfter) if retryAfter.isdigit() else None
+
+            if attempt == self.retries:
+                raise RuntimeError(f"{method} {path}: {problem}, {attempt} retries")
+
+            if delay is None:
+                delay = self.backoff * 2**attempt * (0.5 + random.random() / 2)
+
+            with self.lock:
+                self.stats["retries"] += 1
+
+            time.sleep(delay)
+
+    def prepare(self):
+        """Make sure that the destination exists: the AnnoRepo container."""
+        if self.target != "annorepo":
+            return
+
+        (status, data) = self.send("GET", f"/w3c/{self.container}/", ok=(404,))
+
+        if status == 404:
+            container = {
+                "@context": CONTAINER_CONTEXT,
+                "type": ["BasicContainer", "AnnotationCollection"],
+                "label": self.container,
+            }
+            self.send(
+                "POST",
+                "/w3c/",
+                json.dumps(container).encode("utf-8"),
+                {
+                    "Content-Type": ANNOTATION_TYPE,
+                    "Slug": self.container,
+                },
+                ok=(409,),
+            )
+
+    def sendBatch(self, batch):
+        """Upload one batch of items.
+
+        AnnoRepo receives the annotations of a batch in one request.
+        TextRepo has no bulk upload, so it receives the texts of a batch one
+        after the other, over the same kept-alive connection.
+        """
+        if self.target == "annorepo":
+            self.send(
+                "POST",
+                f"/w3c/{self.container}/annotations-batch",
+                json.dumps(batch).encode("utf-8"),
+                {"Content-Type": "application/json"},
+            )
+            return
+
+        for item in batch:
+            externalId = item["externalId"]
+            contents = json.dumps(dict(_ordered_segments=item["segments"]))
+            (body, contentType) = multipart(
+                "contents",
+                f"{externalId}.json",
+                contents.encode("utf-8"),
+                "application/json",
+            )
+            self.send(
+                "POST",
+                f"/task/import/documents/{quote(externalId, safe='')}"
+                f"/{quote(self.typeName, safe='')}?allowNewDocument=true",
+                body,
+                {"Content-Type": contentType},
+            )
+
+    def stateKey(self, inPath, batchSize):
+        """The key that an ingest can resume from: input, batch size, destination."""
+        h = hashlib.sha256()
+
+        with open(inPath, "rb") as fh:
+            while chunk := fh.read(1 << 20):
+                h.update(chunk)
+
+        destination = [self.target, self.url, self.container, self.typeName, batchSize]
+        h.update(json.dumps(destination).encode("utf-8"))
+        return h.hexdigest()
+
+    def loadState(self, key):
+        """The numbers of the batches that have been acknowledged before."""
+        if not os.path.exists(self.statePath):
+            return set()
+
+        with open(self.statePath) as fh:
+            state = json.load(fh)
+
+        return set(state["acked"]) if state.get("key", None) == key else set()
+
+    def saveState(self, key, acked):
+        """Remember the numbers of the batches that have been acknowledged."""
+        path = self.statePath
+
+        with open(f"{path}.tmp", "w") as fh:
+            json.dump(dict(key=key, acked=sorted(acked)), fh)
+
+        os.replace(f"{path}.tmp", path)
+
+    def run(self, inPath, batchSize=None, fresh=False):
+        """Upload all items that have not been acknowledged before.
+
+        Parameters
+        ----------
+        inPath: string
+            The result of the WATM step.
+        batchSize: integer, optional None
+            The number of items per batch, by default depending on the target.
+        fresh: boolean, optional False
+            Whether to forget the acknowledged batches.
+
+        Returns
+        -------
+        integer
+            The number of batches that have failed.
+        """
+        target = self.target
+        report = self.report
+        stats = self.stats
+        batchSize = batchSize or BATCH_SIZES[target]
+        items = getItems(target, inPath)
+        batches = [items[i : i + batchSize] for i in range(0, len(items), batchSize)]
+        key = self.stateKey(inPath, batchSize)
+        acked = set() if fresh else self.loadState(key)
+        todo = [i for i in range(len(batches)) if i not in acked]
+        total = sum(len(batches[i]) for i in todo)
+        report(
+            f"{target}: {len(items)} items in {len(batches)} batches of {batchSize},"
+            f" {len(acked)} batches acknowledged before, {len(todo)} to do,"
+            f" at most {self.inflight} in flight"
+        )
+
+        if not todo:
+            return 0
+
+        self.prepare()
+
+        start = time.monotonic()
+        lastReport = start
+        failed = {}
+
+        def progress(now):
+            elapsed = max(now - start, 1e-6)
+            report(
+                f"{target}: {stats['items']} of {total} items,"
+                f" {stats['items'] / elapsed:.0f} items/s,"
+                f" {stats['bytes'] / elapsed / 1e6:.2f} MB/s,"
+                f" {stats['requests']} requests, {stats['retries']} retries"
+                f" over {self.pool.nConnections} connections"
+            )
+
+        with ThreadPoolExecutor(max_workers=self.inflight) as executor:
+            pending = {}
+            remaining = iter(todo)
+
+            while True:
+                while not failed and len(pending) < self.inflight:
+                    i = next(remaining, None)
+
+                    if i is None:
+                        break
+
+                    pending[executor.submit(self.sendBatch, batches[i])] = i
+
+                if not pending:
+                    break
+
+                (done, notDone) = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    i = pending.pop(future)
+
+                    try:
+                        future.result()
+                    except Exception as e:
+                        failed[i] = str(e)
+                        report(f"{target}: batch {i} failed: {e}")
+                        continue
+
+                    acked.add(i)
+                    stats["items"] += len(batches[i])
+
+                self.saveState(key, acked)
+                now = time.monotonic()
+
+                if now - lastReport >= REPORT_INTERVAL:
+                    progress(now)
+                    lastReport = now
+
+        self.pool.close()
+        progress(time.monotonic())
+
+        if failed:
+            report(
+                f"{target}: stopped after {len(failed)} failed batches;"
+                f" {len(batches) - len(acked)} batches left for the next run"
+            )
+
+        return len(failed)
+
+
+def ingestStep(name, target, inPath, stateDir, url, **kwargs):
+    """A workflow step that uploads to TextRepo or AnnoRepo.
+
+    Parameters
+    ----------
+    name: string
+        The name of the step.
+    target: string
+        `textrepo` or `annorepo`.
+    inPath: string
+        The result of the WATM step.
+    stateDir: string
+        The directory where the acknowledged batches are remembered.
+    url: string
+        The URL of the server.
+    **kwargs: any
+        Further arguments for `Step`, such as `deps`, and the options of the
+        command line, such as `batch` and `inflight`, by their long names in
+        camel case, e.g. `apiKey` for `--api-key`.
+
+    Returns
+    -------
+    object
+        The `Step`.
+    """
+    command = [sys.executable, "ingest.py", target, inPath, stateDir, "--url", url]
+
+    for option in (
+        "container",
+        "type",
+        "batch",
+        "inflight",
+        "retries",
+        "backoff",
+        "apiKey",
+    ):
+        value = kwargs.pop(option, None)
+
+        if value is not None:
+            command.extend([f"--{camelToOption(option)}", str(value)])
+
+    if kwargs.pop("fresh", False):
+        command.append("--fresh")
+
+    return Step(name, command=command, resourceClass="io", **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="upload to TextRepo or AnnoRepo")
+    parser.add_argument("target", choices=TARGETS)
+    parser.add_argument("inPath")
+    parser.add_argument("stateDir")
+    parser.add_argument("--url", required=True)
+    parser.add_argument("--container", default="preview")
+    parser.add_argument("--type", default="segmented_text")
+    parser.add_argument("--batch", type=int, default=None)
+    parser.add_argument("--inflight", type=int, default=4)
+    parser.add_argument("--retries", type=int, default=5)
+    parser.add_argument("--backoff", type=float, default=0.5)
+    parser.add_argument("--api-key", default=None)
+    parser.add_argument("--fresh", action="store_true")
+    args = parser.parse_args()
+
+    ingest = Ingest(
+        args.target,
+        args.url,
+        args.stateDir,
+        container=args.container,
+        typeName=args.type,
+        inflight=args.inflight,
+        retries=args.retries,
+        backoff=args.backoff,
+        apiKey=args.api_key,
+    )
+
+    try:
+        nFailed = ingest.run(args.inPath, batchSize=args.batch, fresh=args.fresh)
+    except (OSError, RuntimeError) as e:
+        say(f"{args.target}: {e}")
+        return 1
+
+    return 1 if nFailed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,257 @@
+"""Keep track of the input files of a corpus, in order to process only changes.
+
+Usage on the command line:
+
+    python manifest.py backend org repo [--commit]
+
+Prints which files have been added, changed and removed since the last committed
+manifest. With `--commit` the current state becomes the committed manifest.
+"""
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from helpers import console, corpusDir
+
+
+def hashFile(path):
+    """Compute the content hash of a file.
+
+    Parameters
+    ----------
+    path: string
+        The path of the file.
+
+    Returns
+    -------
+    string
+        The hexadecimal BLAKE2b digest of the file.
+    """
+    with open(path, "rb") as fh:
+        return hashlib.file_digest(fh, hashlib.blake2b).hexdigest()
+
+
+class Manifest:
+    """A manifest of the input files of a corpus.
+
+    For every file below the corpus directory, the manifest records its size,
+    its modification time and the hash of its content.
+
+    After a successful preview run, the manifest is committed.
+    When the next run starts, the corpus directory is scanned again and compared
+    with the committed manifest, which yields the sets of added, changed and
+    removed files.
+    Downstream steps can then limit their work to these files.
+
+    Hashing is the costly part, so:
+
+    *   if the size and modification time of a file are the same as in the
+        committed manifest, the hash is taken from there;
+    *   the other files are hashed in parallel, by a pool of threads
+        (the hash functions release the GIL while they work on large buffers).
+
+    A file whose modification time has changed, but whose content has not, does
+    not count as changed.
+
+    The current state is saved next to the committed manifest, so that it can
+    be committed by another step, or another process, than the one that made
+    the diff.
+    """
+
+    def __init__(self, inDir, stateDir, exclude=(".git",), workers=None):
+        """Create a manifest for a corpus.
+
+        Parameters
+        ----------
+        inDir: string
+            The directory with the input files of the corpus.
+        stateDir: string
+            The directory where the committed manifest and the latest changes
+            are stored.
+        exclude: tuple, optional (".git",)
+            Names of files and directories that are skipped when scanning.
+        workers: integer, optional None
+            The number of hashing threads. By default, this depends on the number
+            of cores.
+        """
+        self.inDir = inDir
+        self.stateDir = stateDir
+        self.exclude = set(exclude)
+        self.workers = workers
+        self.committed = self.load()
+        self.current = None
+
+    def load(self):
+        """Load the committed manifest.
+
+        Returns
+        -------
+        dict
+            Keyed by relative path, valued by a list with size, modification time
+            and hash. Empty if there is no committed manifest.
+        """
+        path = f"{self.stateDir}/manifest.json"
+
+        if not os.path.exists(path):
+            return {}
+
+        with open(path) as fh:
+            return json.load(fh)
+
+    def scan(self):
+        """Find all files under the corpus directory, with their size and mtime.
+
+        Returns
+        -------
+        dict
+            Keyed by relative path, valued by a tuple with size and
+            modification time in nanoseconds.
+        """
+        inDir = self.inDir
+        exclude = self.exclude
+        found = {}
+        todo = [""]
+
+        while todo:
+            relDir = todo.pop()
+
+            with os.scandir(f"{inDir}/{relDir}" if relDir else inDir) as it:
+                for entry in it:
+                    if entry.name in exclude:
+                        continue
+
+                    relPath = f"{relDir}/{entry.name}" if relDir else entry.name
+
+                    if entry.is_dir(follow_symlinks=False):
+                        todo.append(relPath)
+                    elif entry.is_file(follow_symlinks=False):
+                        stat = entry.stat(follow_symlinks=False)
+                        found[relPath] = (stat.st_size, stat.st_mtime_ns)
+
+        return found
+
+    def diff(self):
+        """Compare the current state of the corpus with the committed manifest.
+
+        The current state is kept, so that it can be committed later.
+
+        Returns
+        -------
+        dict
+            With keys `added`, `changed`, `removed`, each a sorted list of relative
+            paths, and `hashed`, the number of files that had to be hashed.
+        """
+        inDir = self.inDir
+        committed = self.committed
+        found = self.scan()
+        current = {}
+        toHash = []
+
+        for relPath, (size, mtime) in found.items():
+            old = committed.get(relPath, None)
+
+            if old is not None and old[0] == size and old[1] == mtime:
+                current[relPath] = old
+            else:
+                toHash.append(relPath)
+
+        if toHash:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                digests = pool.map(
+                    hashFile, (f"{inDir}/{relPath}" for relPath in toHash)
+                )
+
+                for relPath, digest in zip(toHash, digests):
+                    (size, mtime) = found[relPath]
+                    current[relPath] = [size, mtime, digest]
+
+        self.current = current
+        self.save("current.json", current)
+
+        added = sorted(relPath for relPath in current if relPath not in committed)
+        removed = sorted(relPath for relPath in committed if relPath not in current)
+        changed = sorted(
+            relPath
+            for relPath in toHash
+            if relPath in committed and committed[relPath][2] != current[relPath][2]
+        )
+        changes = dict(
+            added=added, changed=changed, removed=removed, hashed=len(toHash)
+        )
+        self.save("changes.json", changes)
+        return changes
+
+    def commit(self):
+        """Make the current state the committed manifest.
+
+        Call this after the changes have been processed successfully,
+        so that a failed run will be followed by a run over the same changes.
+        If this object has not made the diff itself, the current state that the
+        latest diff has saved is committed.
+        """
+        if self.current is None:
+            path = f"{self.stateDir}/current.json"
+
+            if not os.path.exists(path):
+                return
+
+            with open(path) as fh:
+                self.current = json.load(fh)
+
+        self.save("manifest.json", self.current)
+        self.committed = self.current
+        self.current = None
+
+    def save(self, name, data):
+        """Write a JSON file to the state directory, atomically.
+
+        Parameters
+        ----------
+        name: string
+            The name of the file.
+        data: any
+            The data to write.
+        """
+        stateDir = self.stateDir
+        os.makedirs(stateDir, exist_ok=True)
+        path = f"{stateDir}/{name}"
+
+        with open(f"{path}.tmp", "w") as fh:
+            json.dump(data, fh)
+
+        os.replace(f"{path}.tmp", path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="detect changed corpus inputs")
+    parser.add_argument("backend")
+    parser.add_argument("org")
+    parser.add_argument("repo")
+    parser.add_argument("--state", default="state")
+    parser.add_argument("--commit", action="store_true")
+    args = parser.parse_args()
+
+    inDir = corpusDir(args.backend, args.org, args.repo)
+    stateDir = f"{args.state}/{args.backend}/{args.org}/{args.repo}"
+    manifest = Manifest(inDir, stateDir)
+    changes = manifest.diff()
+
+    for kind in ("added", "changed", "removed"):
+        paths = changes[kind]
+        console(f"{len(paths):>6} {kind}")
+
+        for path in paths:
+            sys.stdout.write(f"{kind[0]} {path}\n")
+
+    console(f"{changes['hashed']:>6} files hashed")
+
+    if args.commit:
+        manifest.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Write synthetic output to stdout and stderr at a controllable rate.
+
+This script stands in for a chatty conversion step, such as TEI => TF => WATM,
+when measuring how fast the task runner can capture and emit output.
+
+Usage:
+
+    python noisy.py [--lines N] [--size S] [--rate R] [--errors F] [--stamp]
+
+*   `--lines`: the number of lines to write (default 100000);
+*   `--size`: the number of characters per line, newline excluded (default 80);
+*   `--rate`: the number of lines per second, 0 means as fast as possible
+    (default 0);
+*   `--errors`: the fraction of lines that go to stderr instead of stdout
+    (default 0.1);
+*   `--stamp`: start every line with the time at which it is written,
+    in seconds since the epoch, so that the delay until it reaches a client
+    can be measured.
+
+The lines contain non-ASCII characters, so that they are multibyte in UTF-8.
+"""
+
+import sys
+import time
+import argparse
+
+PATTERN = "abcdefghij éèë ñ øå "
+
+
+def makeLine(i, size, stamp=None):
+    """Make a line of exactly `size` characters that starts with its number.
+
+    If a time stamp is given, the line starts with it, before the number.
+    """
+    head = f"{i:>8} " if stamp is None else f"{stamp:.6f} {i:>8} "
+    body = (PATTERN * (size // len(PATTERN) + 1))[0 : max(size - len(head), 0)]
+    return (head + body)[0:size] + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="write synthetic output")
+    parser.add_argument("--lines", type=int, default=100000)
+    parser.add_argument("--size", type=int, default=80)
+    parser.add_argument("--rate", type=float, default=0)
+    parser.add_argument("--errors", type=float, default=0.1)
+    parser.add_argument("--stamp", action="store_true")
+    args = parser.parse_args()
+
+    interval = 1 / args.rate if args.rate > 0 else 0
+    start = time.monotonic()
+    errorCredit = 0
+
+    for i in range(1, args.lines + 1):
+        errorCredit += args.errors
+
+        if errorCredit >= 1:
+            errorCredit -= 1
+            stream = sys.stderr
+        else:
+            stream = sys.stdout
+
+        stamp = time.time() if args.stamp else None
+        stream.write(makeLine(i, args.size, stamp=stamp))
+
+        if interval:
+            stream.flush()
+            delay = start + i * interval - time.monotonic()
+
+            if delay > 0:
+                time.sleep(delay)
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import os
+import sys
+import json
+
+from dag import Step
+from iiif import iiifStep, makeScans
+from ingest import ingestStep
+from manifest import Manifest
+from shard import shardedStep
+from tei import makeLetters
+from retrieve import corpusSpec, markBuilt, retrieveStep
+
+CORPUS_DIR = "corpus/preview"  # where the demo letters are generated
+SCAN_DIR = "corpus/preview-scans"  # where the demo scans are generated
+WORK_DIR = "work/preview"  # where the results of the steps are written
+REPORT_DIR = "reports/preview"  # where the reports of the workflow are written
+STATE_DIR = "state/preview"  # where the manifest of the letters is kept
+N_LETTERS = 2000
+N_SCANNED = 200  # the number of demo letters that have scans
+GIT_CORPUS = None  # e.g. "github/org/repo": retrieve the letters from there instead
+GIT_PATH = "tei"  # the directory with the letters in the git corpus
+GIT_SCAN_PATH = "scans"  # the directory with the scans in the git corpus
+GIT_URL_BASE = None  # the base of the remote of the git corpus, see `retrieve.py`
+GIT_ROOT = None  # the directory under which the git corpus is cloned
+INGEST_URL = None  # e.g. "http://localhost:8090": really ingest, see `standin.py`
+
+
+def noisy(lines, rate, errors=0.1):
+    """A command that stands in for a real conversion or ingest step.
+
+    See `noisy.py`.
+    """
+    return [
+        sys.executable,
+        "noisy.py",
+        "--lines",
+        str(lines),
+        "--rate",
+        str(rate),
+        "--errors",
+        str(errors),
+        "--size",
+        "60",
+    ]
+
+
+def retrieve(dag, step):
+    """Stand-in for retrieving the corpus: generate the demo letters and scans."""
+    dag.progress(step, "info", f"retrieving {N_LETTERS} letters")
+    nWritten = makeLetters(CORPUS_DIR, N_LETTERS)
+    dag.progress(step, "info", f"{nWritten} new letters")
+    nWritten = makeScans(SCAN_DIR, N_SCANNED)
+    dag.progress(step, "info", f"{nWritten} new scans")
+    return ("success", "")
+
+
+def report(dag, step):
+    """Write the statistics and errors of the conversion as reports."""
+    with open(f"{WORK_DIR}/convert/result.json") as fh:
+        result = json.load(fh)
+
+    os.makedirs(REPORT_DIR, exist_ok=True)
+
+    with open(f"{REPORT_DIR}/letters.tsv", "w") as fh:
+        fh.write("letter\telements\twords\tdistinct\n")
+
+        for letter, stats in result["results"].items():
+            fh.write(
+                f"{letter}\t{stats['elements']}\t{stats['words']}"
+                f"\t{stats['distinct']}\n"
+            )
+
+    with open(f"{REPORT_DIR}/errors.txt", "w") as fh:
+        for letter, error in result["errors"].items():
+            fh.write(f"{letter}: {error}\n")
+
+    dag.progress(step, "info", f"reported on {len(result['results'])} letters")
+    return ("success", "")
+
+
+def lettersDir():
+    """The directory with the letters: generated, or in the clone of the git corpus."""
+    if GIT_CORPUS is None:
+        return CORPUS_DIR
+
+    return f"{corpusSpec(GIT_CORPUS, root=GIT_ROOT)[1]}/{GIT_PATH}"
+
+
+def manifest(dag, step):
+    """Determine which letters have changed since the last successful run."""
+    changes = Manifest(lettersDir(), STATE_DIR).diff()
+    dag.progress(
+        step,
+        "info",
+        f"{len(changes['added'])} added, {len(changes['changed'])} changed,"
+        f" {len(changes['removed'])} removed, {changes['hashed']} files hashed",
+    )
+    return ("success", "")
+
+
+def commit(dag, step):
+    """Commit the manifest of the letters, after all steps have succeeded."""
+    Manifest(lettersDir(), STATE_DIR).commit()
+    dag.progress(step, "info", "committed the manifest of the letters")
+    return ("success", "")
+
+
+def built(dag, step):
+    """Record the retrieved commits as built, after all steps have succeeded."""
+    with open(f"{WORK_DIR}/retrieve/result.json") as fh:
+        result = json.load(fh)
+
+    for corpus, info in result.items():
+        markBuilt(info["dir"], info["commit"])
+        dag.progress(step, "info", f"{corpus}: built {info['commit'][0:10]}")
+
+    return ("success", "")
+
+
+def previewSteps():
+    """The steps of the preview workflow, see the definition document.
+
+    Most steps are stand-ins that produce output for a while.
+    The conversion runs for real over a corpus of generated letters, divided
+    over a pool of worker processes, see `shard.py`, and so do the IIIF images
+    and manifests of the scans, incrementally, see `iiif.py`.
+    Their dependencies are the real ones: the IIIF manifests only need the
+    retrieved input, and the two ingests are independent of each other.
+    The conversion only converts the letters that have been added or changed
+    since the last successful run, see `manifest.py`; the manifest is committed
+    by the last step. The report declares its inputs and outputs, so that it is
+    restored from the step cache when its inputs have not changed.
+
+    If `GIT_CORPUS` is set, the letters are retrieved from git instead of
+    generated, as a shallow and sparse clone of `GIT_PATH` and `GIT_SCAN_PATH`,
+    see `retrieve.py`.
+    A final step then records the retrieved commit as built.
+
+    If `INGEST_URL` is set, the letters are exported to WATM and really ingested
+    into TextRepo and AnnoRepo there, see `ingest.py`.
+
+    Returns
+    -------
+    list of Step
+    """
+    if GIT_CORPUS is None:
+        scanDir = SCAN_DIR
+        first = Step("retrieve", function=retrieve, resourceClass="io")
+        finalSteps = []
+    else:
+        scanDir = f"{corpusSpec(GIT_CORPUS, root=GIT_ROOT)[1]}/{GIT_SCAN_PATH}"
+        first = retrieveStep(
+            "retrieve",
+            (GIT_CORPUS,),
+            f"{WORK_DIR}/retrieve",
+            paths=(f"{GIT_PATH}/", f"{GIT_SCAN_PATH}/"),
+            urlBase=GIT_URL_BASE,
+            root=GIT_ROOT,
+        )
+        finalSteps = [Step("built", function=built, deps=("restart", "report"))]
+
+    if INGEST_URL is None:
+        ingestSteps = [
+            Step(
+                "textrepo", command=noisy(15, 5), deps=("convert",), resourceClass="io"
+            ),
+            Step(
+                "annorepo", command=noisy(20, 5), deps=("convert",), resourceClass="io"
+            ),
+        ]
+    else:
+        watmPath = f"{WORK_DIR}/watm/result.json"
+        ingestSteps = [
+            shardedStep(
+                "watm", "tei:watm", lettersDir(), f"{WORK_DIR}/watm", deps=("convert",)
+            ),
+            ingestStep(
+                "textrepo",
+                "textrepo",
+                watmPath,
+                f"{WORK_DIR}/ingest",
+                INGEST_URL,
+                deps=("watm",),
+            ),
+            ingestStep(
+                "annorepo",
+                "annorepo",
+                watmPath,
+                f"{WORK_DIR}/ingest",
+                INGEST_URL,
+                deps=("watm",),
+            ),
+        ]
+
+    return [
+        first,
+        Step("manifest", function=manifest, deps=("retrieve",), resourceClass="io"),
+        shardedStep(
+            "convert",
+            "tei:convert",
+            lettersDir(),
+            f"{WORK_DIR}/convert",
+            changes=f"{STATE_DIR}/changes.json",
+            deps=("manifest",),
+        ),
+        Step(
+            "report",
+            function=report,
+            deps=("convert",),
+            inputs=(f"{WORK_DIR}/convert/result.json",),
+            outputs=(REPORT_DIR,),
+        ),
+        iiifStep("iiif", scanDir, f"{WORK_DIR}/iiif", deps=("retrieve",)),
+        *ingestSteps,
+        Step("index", command=noisy(10, 5), deps=("textrepo", "annorepo")),
+        Step("restart", command=noisy(3, 2, errors=0), deps=("index", "iiif")),
+        Step("commit", function=commit, deps=("restart", "report")),
+        *finalSteps,
+    ]
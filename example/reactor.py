@@ -0,0 +1,428 @@
+import os
+import time
+import signal
+import selectors
+from threading import Lock
+
+from helpers import console
+from capture import Capture
+
+
+class Reactor:
+    """Multiplex the output and the exit of all running subprocesses in one thread.
+
+    Instead of a thread per script task that polls the pipes of its process,
+    there is a single reactor thread that waits with a selector (epoll on Linux)
+    on the pipes of all running subprocesses at the same time.
+
+    Readiness events are dispatched to the handlers of the task that owns the
+    pipe.
+
+    The exit of a process is detected by means of a process file descriptor
+    (`os.pidfd_open`), which becomes readable when the process terminates.
+    So the reactor sleeps until there is something to do.
+    Only on systems without process file descriptors, the reactor falls back to
+    polling the running processes every half second.
+
+    Other threads communicate with the reactor thread by queueing requests and
+    writing a byte to a wake-up pipe.
+
+    A subprocess that is terminated gets a termination signal for its whole
+    process group. Processes in the group that are still there after a grace
+    period, because they ignore or handle that signal, get a kill signal.
+    The exit of a terminated subprocess is only reported when its whole process
+    group has gone, so that its resources are really freed by then.
+    """
+
+    def __init__(self, socketio, chunkSize=65536, drainLimit=16777216, grace=5.0):
+        """Create a reactor.
+
+        The reactor thread is started upon the first subprocess that is watched.
+
+        Parameters
+        ----------
+        socketio: object
+            The socketio object corresponding to the Flask app.
+            Used to start the reactor thread as a background task.
+        chunkSize: integer, optional 65536
+            The maximum number of bytes read from a pipe in one go.
+        drainLimit: integer, optional 16777216
+            The maximum number of bytes read from a pipe after its process
+            has ended.
+        grace: float, optional 5.0
+            The number of seconds between the termination signal and the kill
+            signal for the process group of a terminated subprocess.
+        """
+        self.socketio = socketio
+        self.chunkSize = chunkSize
+        self.drainLimit = drainLimit
+        self.grace = grace
+        self.selector = selectors.DefaultSelector()
+        self.watched = {}
+        self.requests = []
+        self.terminations = {}
+        self.requestLock = Lock()
+        self.loop = None
+
+        (self.wakeRead, self.wakeWrite) = os.pipe()
+        os.set_blocking(self.wakeRead, False)
+        os.set_blocking(self.wakeWrite, False)
+        self.selector.register(
+            self.wakeRead, selectors.EVENT_READ, ("wake", None, None)
+        )
+
+    def watch(self, key, proc, onLines, onExit):
+        """Hand over the output and exit of a subprocess to the reactor.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task that runs the subprocess.
+        proc: object
+            The `Popen` object of the subprocess. Its stdout and stderr must be
+            pipes in binary mode.
+        onLines: function
+            Called as `onLines(kind, lines)` for the lines read from stdout
+            (`kind="info"`) or stderr (`kind="error"`) in one chunk.
+            The lines are without their trailing newline.
+        onExit: function
+            Called as `onExit(returnCode, rusage)` when the subprocess has ended,
+            after its remaining output has been read.
+            `rusage` is the resource usage of the subprocess and the descendants
+            it has waited for, as given by `os.wait4()`, or None if it is not
+            available.
+        """
+        with self.requestLock:
+            self.requests.append((key, proc, onLines, onExit))
+
+            if self.loop is None:
+                self.loop = self.socketio.start_background_task(self.run)
+
+        self.wake()
+
+    def terminate(self, key):
+        """Send a termination signal to the process group of a watched subprocess.
+
+        If the process group has not gone after the grace period, it gets a kill
+        signal. See `escalate()`.
+        Nothing happens if there is no subprocess watched under this key.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task that runs the subprocess.
+        """
+        with self.requestLock:
+            info = self.watched.get(key, None)
+
+            if info is None:
+                procs = [request[1] for request in self.requests if request[0] == key]
+
+                if not procs:
+                    return
+
+                proc = procs[0]
+            else:
+                proc = info["proc"]
+
+            # the subprocess has been started in a new session, so it leads its
+            # process group, and the id of the group stays valid after its exit
+            pgid = proc.pid
+
+            if key not in self.terminations:
+                self.terminations[key] = dict(
+                    pgid=pgid, deadline=time.monotonic() + self.grace, exit=None
+                )
+
+        try:
+            os.killpg(pgid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+        self.wake()
+
+    def wake(self):
+        """Interrupt the wait of the reactor thread."""
+        try:
+            os.write(self.wakeWrite, b"x")
+        except BlockingIOError:
+            pass
+
+    def run(self):
+        """The loop of the reactor thread."""
+        selector = self.selector
+        watched = self.watched
+
+        while True:
+            polling = any(info["pidfd"] is None for info in watched.values())
+
+            if self.terminations:
+                timeout = 0.05
+            elif polling:
+                timeout = 0.5
+            else:
+                timeout = None
+
+            events = selector.select(timeout)
+            exited = []
+
+            for selectorKey, mask in events:
+                (what, key, kind) = selectorKey.data
+
+                if what == "wake":
+                    self.admit()
+                elif what == "stream":
+                    self.read(key, kind)
+                elif what == "exit":
+                    exited.append(key)
+
+            if polling:
+                for key, info in watched.items():
+                    if info["pidfd"] is None and self.reap(info, block=False):
+                        exited.append(key)
+
+            for key in exited:
+                self.finish(key)
+
+            if self.terminations:
+                self.escalate()
+
+    def escalate(self):
+        """Follow up on the process groups that have been terminated.
+
+        Groups that have outlived their grace period get a kill signal.
+        Groups that have gone, and whose subprocess has been wrapped up by
+        `finish()`, are forgotten, and the exit handler of their subprocess is
+        called.
+        """
+        now = time.monotonic()
+
+        with self.requestLock:
+            terminations = list(self.terminations.items())
+
+        for key, termination in terminations:
+            pgid = termination["pgid"]
+            exit = termination["exit"]
+            deadline = termination["deadline"]
+
+            # as long as our subprocess is not reaped, its group exists
+            alive = exit is None
+
+            if not alive:
+                try:
+                    os.killpg(pgid, 0)
+                    alive = True
+                except ProcessLookupError:
+                    pass
+
+            if alive:
+                if deadline is not None and now >= deadline:
+                    termination["deadline"] = None
+                    console(f"reactor: kill process group {pgid} of {key}")
+
+                    try:
+                        os.killpg(pgid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+
+                continue
+
+            with self.requestLock:
+                self.terminations.pop(key, None)
+
+            self.dispatch(*exit)
+
+    def admit(self):
+        """Start watching the subprocesses that have been handed over."""
+        selector = self.selector
+
+        try:
+            while os.read(self.wakeRead, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        with self.requestLock:
+            requests = list(self.requests)
+
+        admitted = {}
+
+        for key, proc, onLines, onExit in requests:
+            captures = {}
+
+            for kind, stream in (("info", proc.stdout), ("error", proc.stderr)):
+                fd = stream.fileno()
+                os.set_blocking(fd, False)
+                captures[kind] = Capture(
+                    fd, self.deliverer(onLines, kind), chunkSize=self.chunkSize
+                )
+                selector.register(fd, selectors.EVENT_READ, ("stream", key, kind))
+
+            info = dict(
+                proc=proc, captures=captures, onExit=onExit, pidfd=None, rusage=None
+            )
+
+            try:
+                pidfd = os.pidfd_open(proc.pid)
+            except (AttributeError, OSError):
+                pidfd = None
+
+            if pidfd is not None:
+                selector.register(pidfd, selectors.EVENT_READ, ("exit", key, None))
+                info["pidfd"] = pidfd
+
+            admitted[key] = info
+
+        # the subprocesses are watched as soon as they leave the requests, so that
+        # `terminate()` always finds them in one of both
+        with self.requestLock:
+            self.watched.update(admitted)
+            self.requests = self.requests[len(requests) :]
+
+    def read(self, key, kind):
+        """Read a chunk of output of a stream and deliver the complete lines.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task that owns the stream.
+        kind: string
+            `info` for stdout, `error` for stderr.
+        """
+        captures = self.watched[key]["captures"]
+        capture = captures.get(kind, None)
+
+        if capture is None:
+            return
+
+        if capture.read() is None:
+            self.selector.unregister(capture.fd)
+            capture.finish()
+            del captures[kind]
+
+    def finish(self, key):
+        """Wrap up after a subprocess has ended.
+
+        The output that is still in the pipes is read, the file descriptors
+        are unregistered, and the exit handler is called.
+
+        Note that we do not wait for the end of the pipes: grandchildren of the
+        subprocess may have inherited them and keep them open.
+        So we only read what is available now, in bounded chunks, and up to a
+        limit.
+
+        If the subprocess has been terminated, the exit handler is called by
+        `escalate()`, as soon as its whole process group has gone.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task that owns the subprocess.
+        """
+        info = self.watched.get(key, None)
+
+        if info is None:
+            return
+
+        selector = self.selector
+
+        for capture in info["captures"].values():
+            capture.drain(self.drainLimit)
+            selector.unregister(capture.fd)
+            capture.finish()
+
+        pidfd = info["pidfd"]
+
+        if pidfd is not None:
+            selector.unregister(pidfd)
+            os.close(pidfd)
+
+        proc = info["proc"]
+
+        if proc.returncode is None:
+            self.reap(info)
+
+        proc.stdout.close()
+        proc.stderr.close()
+        exit = (info["onExit"], proc.returncode, info["rusage"])
+
+        with self.requestLock:
+            del self.watched[key]
+            termination = self.terminations.get(key, None)
+
+            if termination is not None:
+                termination["exit"] = exit
+
+        if termination is None:
+            self.dispatch(*exit)
+
+    def reap(self, info, block=True):
+        """Collect the exit status and resource usage of an ended subprocess.
+
+        We use `os.wait4()` instead of `Popen.wait()`, because it also yields the
+        resource usage. The return code is stored in the `Popen` object, as
+        `Popen.wait()` would do.
+
+        Parameters
+        ----------
+        info: dict
+            The information about a watched subprocess.
+        block: boolean, optional True
+            Whether to wait for the subprocess to end.
+
+        Returns
+        -------
+        boolean
+            Whether the subprocess has ended.
+        """
+        proc = info["proc"]
+
+        try:
+            (pid, status, rusage) = os.wait4(proc.pid, 0 if block else os.WNOHANG)
+        except ChildProcessError:
+            # somebody else has collected the exit status
+            proc.wait()
+            return True
+
+        if pid == 0:
+            return False
+
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        info["rusage"] = rusage
+        return True
+
+    def deliverer(self, onLines, kind):
+        """Make a line handler for a capture that calls the handler of a task.
+
+        Parameters
+        ----------
+        onLines: function
+            The line handler of the task.
+        kind: string
+            The kind of the stream.
+
+        Returns
+        -------
+        function
+            A function that takes a list of lines.
+        """
+
+        def deliver(lines):
+            self.dispatch(onLines, kind, lines)
+
+        return deliver
+
+    def dispatch(self, handler, *args):
+        """Call a handler, but do not let its errors stop the reactor.
+
+        Parameters
+        ----------
+        handler: function
+            The handler to call.
+        *args: any
+            The arguments for the handler.
+        """
+        try:
+            handler(*args)
+        except Exception as e:
+            console(f"reactor: error in handler {handler.__name__}: {str(e)}")
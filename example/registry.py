@@ -0,0 +1,379 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+from contextlib import closing
+from threading import Lock
+
+
+def workerId():
+    """An id for the current worker process, unique across machines."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class Registry:
+    """Keep track of which worker runs which task.
+
+    For every running task the registry holds
+
+    *   its owner: the worker process that runs it;
+    *   its lease: the time until which the ownership holds; the owner renews
+        the leases of its tasks regularly, so that the tasks of a worker that
+        has died become free again when their leases expire;
+    *   its stop flag: set by a worker that has been asked to stop a task that
+        it does not run itself; the owner looks at the flags of its tasks
+        regularly, and stops the flagged ones.
+
+    Next to that, the registry can act as a bus for Socket.IO messages between
+    workers: every worker publishes the messages that it emits to the rooms of
+    tasks, and fetches the messages of the other workers, in order to emit them
+    to its own clients.
+
+    This class keeps everything in memory, for a single worker process.
+    It has no bus, and lets `Task` work as it did before there was a registry.
+    See `SqliteRegistry` for a registry that is shared between processes.
+    """
+
+    shared = False
+
+    def __init__(self):
+        """Create an in-memory registry."""
+        self.runs = {}
+        self.runLock = Lock()
+
+    def claim(self, key, owner, lease):
+        """Become the owner of a task, if no one else owns it.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task.
+        owner: string
+            The id of the worker.
+        lease: float
+            The number of seconds that the ownership holds, unless renewed.
+
+        Returns
+        -------
+        boolean
+            Whether the worker has become the owner of the task.
+        """
+        now = time.time()
+
+        with self.runLock:
+            run = self.runs.get(key, None)
+
+            if run is not None and run["expires"] > now and run["owner"] != owner:
+                return False
+
+            self.runs[key] = dict(owner=owner, expires=now + lease, stop=False)
+
+        return True
+
+    def release(self, key, owner):
+        """Give up the ownership of a task.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task.
+        owner: string
+            The id of the worker; nothing happens if it is not the owner.
+        """
+        with self.runLock:
+            run = self.runs.get(key, None)
+
+            if run is not None and run["owner"] == owner:
+                del self.runs[key]
+
+    def renew(self, owner, lease):
+        """Extend the leases of all tasks of a worker.
+
+        Parameters
+        ----------
+        owner: string
+            The id of the worker.
+        lease: float
+            The number of seconds from now that the ownerships hold.
+        """
+        expires = time.time() + lease
+
+        with self.runLock:
+            for run in self.runs.values():
+                if run["owner"] == owner:
+                    run["expires"] = expires
+
+    def owner(self, key):
+        """The worker that runs a task.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task.
+
+        Returns
+        -------
+        string or None
+            The id of the owner, None if the task does not run, or if the lease of
+            its owner has expired.
+        """
+        with self.runLock:
+            run = self.runs.get(key, None)
+
+        return None if run is None or run["expires"] <= time.time() else run["owner"]
+
+    def requestStop(self, key):
+        """Ask the owner of a task to stop it.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task.
+
+        Returns
+        -------
+        boolean
+            Whether the task is running, so that the request can be honoured.
+        """
+        now = time.time()
+
+        with self.runLock:
+            run = self.runs.get(key, None)
+
+            if run is None or run["expires"] <= now:
+                return False
+
+            run["stop"] = True
+
+        return True
+
+    def stopRequests(self, owner):
+        """The tasks of a worker that it has been asked to stop.
+
+        Parameters
+        ----------
+        owner: string
+            The id of the worker.
+
+        Returns
+        -------
+        list of string
+        """
+        with self.runLock:
+            return [
+                key
+                for (key, run) in self.runs.items()
+                if run["owner"] == owner and run["stop"]
+            ]
+
+    def publish(self, origin, event, data, to):
+        """Pass a Socket.IO message on to the other workers.
+
+        Parameters
+        ----------
+        origin: string
+            The id of the worker that has emitted the message.
+        event: string
+            The name of the event.
+        data: dict
+            The payload.
+        to: string or None
+            The room to which the message has been emitted.
+        """
+
+    def fetch(self, origin, after):
+        """Get the messages that other workers have published.
+
+        Parameters
+        ----------
+        origin: string
+            The id of the fetching worker; its own messages are skipped.
+        after: integer or None
+            The id of the last message that has been fetched before.
+            If None, only the id of the last message is returned, so that a new
+            worker starts with the messages that come after it.
+
+        Returns
+        -------
+        tuple
+            The id of the last message, and the list of messages, as tuples of
+            event, payload and room.
+        """
+        return (after, [])
+
+    def prune(self, age):
+        """Remove published messages that are older than a number of seconds."""
+
+
+class SqliteRegistry(Registry):
+    """A registry in an SQLite database, shared by all workers that open it.
+
+    The workers may run on one machine, or on several machines that share the
+    file system where the database is.
+    No other services are needed.
+
+    Every operation opens its own short transaction, so the registry can be used
+    from any thread. Claiming a task happens in an immediate transaction, so that
+    two workers can never both become its owner.
+
+    Published messages are kept in a table, where each of them gets an increasing
+    id; workers fetch the messages after the last id that they have seen.
+    Old messages are pruned regularly.
+    """
+
+    shared = True
+
+    def __init__(self, path, wal=True, timeout=10.0):
+        """Open or create the registry database.
+
+        Parameters
+        ----------
+        path: string
+            The path of the database file.
+        wal: boolean, optional True
+            Whether to use the write-ahead log of SQLite, which lets readers and
+            the writer work at the same time.
+            Set it to False when the database is on a network file system,
+            where the write-ahead log does not work.
+        timeout: float, optional 10.0
+            The number of seconds to wait for a lock on the database.
+        """
+        super().__init__()
+        self.path = path
+        self.timeout = timeout
+
+        directory = os.path.dirname(path)
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with self.connect() as db:
+            db.execute(f"pragma journal_mode={'wal' if wal else 'delete'}")
+            db.execute(
+                """
+                create table if not exists runs (
+                    key text primary key,
+                    owner text not null,
+                    expires real not null,
+                    stop integer not null default 0
+                )
+                """
+            )
+            db.execute(
+                """
+                create table if not exists messages (
+                    id integer primary key autoincrement,
+                    origin text not null,
+                    event text not null,
+                    room text,
+                    data text not null,
+                    created real not null
+                )
+                """
+            )
+
+    def connect(self):
+        """Open a connection to the database, to be used in a `with` statement.
+
+        The connection is in autocommit mode: every statement is a transaction of
+        its own, unless a transaction is begun explicitly.
+        """
+        return closing(
+            sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        )
+
+    def claim(self, key, owner, lease):
+        now = time.time()
+
+        with self.connect() as db:
+            db.execute("begin immediate")
+
+            try:
+                row = db.execute(
+                    "select owner, expires from runs where key = ?", (key,)
+                ).fetchone()
+
+                if row is not None and row[1] > now and row[0] != owner:
+                    db.execute("rollback")
+                    return False
+
+                db.execute(
+                    "insert or replace into runs (key, owner, expires, stop)"
+                    " values (?, ?, ?, 0)",
+                    (key, owner, now + lease),
+                )
+                db.execute("commit")
+            except Exception:
+                db.execute("rollback")
+                raise
+
+        return True
+
+    def release(self, key, owner):
+        with self.connect() as db:
+            db.execute("delete from runs where key = ? and owner = ?", (key, owner))
+
+    def renew(self, owner, lease):
+        with self.connect() as db:
+            db.execute(
+                "update runs set expires = ? where owner = ?",
+                (time.time() + lease, owner),
+            )
+
+    def owner(self, key):
+        with self.connect() as db:
+            row = db.execute(
+                "select owner from runs where key = ? and expires > ?",
+                (key, time.time()),
+            ).fetchone()
+
+        return None if row is None else row[0]
+
+    def requestStop(self, key):
+        with self.connect() as db:
+            cursor = db.execute(
+                "update runs set stop = 1 where key = ? and expires > ?",
+                (key, time.time()),
+            )
+            return cursor.rowcount > 0
+
+    def stopRequests(self, owner):
+        with self.connect() as db:
+            rows = db.execute(
+                "select key from runs where owner = ? and stop = 1", (owner,)
+            ).fetchall()
+
+        return [row[0] for row in rows]
+
+    def publish(self, origin, event, data, to):
+        with self.connect() as db:
+            db.execute(
+                "insert into messages (origin, event, room, data, created)"
+                " values (?, ?, ?, ?, ?)",
+                (origin, event, to, json.dumps(data), time.time()),
+            )
+
+    def fetch(self, origin, after):
+        with self.connect() as db:
+            if after is None:
+                row = db.execute("select max(id) from messages").fetchone()
+                return (row[0] or 0, [])
+
+            rows = db.execute(
+                "select id, origin, event, room, data from messages"
+                " where id > ? order by id",
+                (after,),
+            ).fetchall()
+
+        messages = [
+            (event, json.loads(data), room)
+            for (n, source, event, room, data) in rows
+            if source != origin
+        ]
+        return (rows[-1][0] if rows else after, messages)
+
+    def prune(self, age):
+        with self.connect() as db:
+            db.execute("delete from messages where created < ?", (time.time() - age,))
+
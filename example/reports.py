@@ -0,0 +1,443 @@
+import os
+import re
+import csv
+import mmap
+from array import array
+from bisect import bisect_right
+from itertools import accumulate, islice, zip_longest
+from collections import Counter
+from threading import Lock
+
+CHUNK_SIZE = 1048576
+BATCH_SIZE = 10000
+DISTINCT_LIMIT = 1000
+TOP = 5
+
+
+class Reports:
+    """Serve large report files piece by piece.
+
+    Reports, such as validation errors, element statistics and link reports,
+    are text files, often CSV or TSV, in a directory per task:
+
+        *baseDir* `/` *task* `/` *name*
+
+    For a big corpus they may be hundreds of megabytes, too much to send to a
+    browser in one go. Instead, clients ask for pages of lines, for the tail,
+    or for the lines that match a regular expression.
+
+    The first time a report is asked for, we build a line index: the byte offset
+    of every `every`-th line, in one pass over the file.
+    With the index we can go to any line without reading the file from the start.
+    The index is kept in memory, and rebuilt when the modification time or size of
+    the report has changed.
+    Reading is done via a memory map, so reports are not loaded in memory.
+
+    For CSV and TSV reports we can also compute a summary per column, in a single
+    pass over the file; the summary is cached in the same way as the index.
+    """
+
+    def __init__(self, baseDir, every=1000):
+        """Create a report store.
+
+        Parameters
+        ----------
+        baseDir: string
+            The directory under which the reports are stored.
+        every: integer, optional 1000
+            The number of lines per index entry.
+        """
+        self.baseDir = baseDir
+        self.every = every
+        self.cache = {}
+        self.cacheLock = Lock()
+
+    def taskDir(self, task):
+        """The directory with the reports of a task."""
+        return f"{self.baseDir}/{task}"
+
+    def listReports(self, task):
+        """The reports of a task.
+
+        Parameters
+        ----------
+        task: string
+            The key of the task.
+
+        Returns
+        -------
+        list of dict
+            For each report its `name` (relative to the directory of the task)
+            and `size`, sorted by name.
+        """
+        taskDir = self.taskDir(task)
+        reports = []
+
+        for path, dirs, files in os.walk(taskDir):
+            for name in files:
+                fullPath = f"{path}/{name}"
+                reports.append(
+                    dict(
+                        name=os.path.relpath(fullPath, taskDir),
+                        size=os.path.getsize(fullPath),
+                    )
+                )
+
+        return sorted(reports, key=lambda report: report["name"])
+
+    def path(self, task, name):
+        """The path of a report, or None if the name points outside the task."""
+        taskDir = os.path.realpath(self.taskDir(task))
+        path = os.path.realpath(f"{taskDir}/{name}")
+
+        if os.path.commonpath((taskDir, path)) != taskDir:
+            return None
+
+        return path if os.path.isfile(path) else None
+
+    def entry(self, path):
+        """Get the cached index of a report, building it if needed.
+
+        Parameters
+        ----------
+        path: string
+            The path of the report.
+
+        Returns
+        -------
+        dict
+            With keys `mtime`, `size`, `index` (the offsets of every `every`-th
+            line), `nLines` and `summary` (None if it has not been computed).
+        """
+        st = os.stat(path)
+
+        with self.cacheLock:
+            entry = self.cache.get(path, None)
+
+        if (
+            entry is not None
+            and entry["mtime"] == st.st_mtime_ns
+            and entry["size"] == st.st_size
+        ):
+            return entry
+
+        (index, nLines) = self.makeIndex(path)
+        entry = dict(
+            mtime=st.st_mtime_ns,
+            size=st.st_size,
+            index=index,
+            nLines=nLines,
+            summary=None,
+        )
+
+        with self.cacheLock:
+            self.cache[path] = entry
+
+        return entry
+
+    def makeIndex(self, path):
+        """Find the offset of every `every`-th line of a file, in one pass.
+
+        The file is read in large chunks; for every chunk the lengths of its lines
+        are computed in one go, so that we do not have to look for newlines one by
+        one.
+
+        Parameters
+        ----------
+        path: string
+            The path of the file.
+
+        Returns
+        -------
+        tuple
+            The index, as an array of offsets, and the number of lines.
+        """
+        every = self.every
+        index = array("Q", [0])
+        nextLine = every
+        seen = 0
+        pos = 0
+        last = b"\n"
+
+        with open(path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(CHUNK_SIZE), b""):
+                pieces = chunk.split(b"\n")
+                ends = list(accumulate(map(len, pieces)))
+                nNew = len(pieces) - 1
+
+                # newline j of this chunk is at ends[j] + j, its next line starts
+                # right after it
+                while nextLine <= seen + nNew:
+                    j = nextLine - seen - 1
+                    index.append(pos + ends[j] + j + 1)
+                    nextLine += every
+
+                seen += nNew
+                pos += len(chunk)
+                last = chunk[-1:]
+
+        nLines = seen if last == b"\n" else seen + 1
+
+        while len(index) > 1 and index[-1] >= pos:
+            index.pop()
+
+        return (index, nLines)
+
+    def openReport(self, path, size):
+        """Open a report for reading lines, memory mapped if it is not empty."""
+        with open(path, "rb") as fh:
+            if size > 0:
+                return mmap.mmap(fh.fileno(), size, access=mmap.ACCESS_READ)
+
+        return open(path, "rb")
+
+    def seekLine(self, fh, entry, line):
+        """Position an opened report at the start of a line, using the index."""
+        every = self.every
+        fh.seek(entry["index"][min(line // every, len(entry["index"]) - 1)])
+
+        for i in range(line - line // every * every):
+            fh.readline()
+
+    def page(self, task, name, start=0, count=100, tail=None):
+        """Read a page of lines of a report.
+
+        Parameters
+        ----------
+        task: string
+            The key of the task.
+        name: string
+            The name of the report.
+        start: integer, optional 0
+            The number of the first line, counting from 0.
+        count: integer, optional 100
+            The maximum number of lines.
+        tail: integer, optional None
+            If given, the last `tail` lines are read, and `start` is ignored.
+
+        Returns
+        -------
+        dict or None
+            With keys `nLines`, `start`, and `lines`, a list of line number and
+            line. None if there is no such report.
+        """
+        path = self.path(task, name)
+
+        if path is None:
+            return None
+
+        entry = self.entry(path)
+        nLines = entry["nLines"]
+
+        if tail is not None:
+            count = tail
+            start = nLines - tail
+
+        start = min(max(start, 0), nLines)
+        count = max(min(count, nLines - start), 0)
+        lines = []
+
+        with self.openReport(path, entry["size"]) as fh:
+            self.seekLine(fh, entry, start)
+
+            for n in range(start, start + count):
+                lines.append([n, decode(fh.readline())])
+
+        return dict(nLines=nLines, start=start, lines=lines)
+
+    def grep(self, task, name, pattern, start=0, limit=100, ignoreCase=False):
+        """Find the lines of a report that match a regular expression.
+
+        Parameters
+        ----------
+        task: string
+            The key of the task.
+        name: string
+            The name of the report.
+        pattern: string
+            The regular expression.
+        start: integer, optional 0
+            The number of the line where the search starts.
+        limit: integer, optional 100
+            The maximum number of lines that are returned.
+        ignoreCase: boolean, optional False
+            Whether the search is case-insensitive.
+            The search is done on the bytes of the report, so only ASCII letters
+            are matched regardless of case.
+
+        Returns
+        -------
+        dict or None
+            With keys `nLines`, `lines`, a list of line number and line, and
+            `next`, the number of the line where a next search should start,
+            or None if the end of the report has been reached.
+            None if there is no such report.
+
+        Raises
+        ------
+        re.error
+            If the pattern is not a valid regular expression.
+        """
+        flags = re.MULTILINE | (re.IGNORECASE if ignoreCase else 0)
+        regex = re.compile(pattern.encode("utf-8"), flags)
+        path = self.path(task, name)
+
+        if path is None:
+            return None
+
+        entry = self.entry(path)
+        nLines = entry["nLines"]
+        lines = []
+        nxt = None
+
+        if entry["size"] == 0 or start >= nLines:
+            return dict(nLines=nLines, lines=lines, next=nxt)
+
+        with self.openReport(path, entry["size"]) as mm:
+            self.seekLine(mm, entry, max(start, 0))
+            pos = mm.tell()
+            line = max(start, 0)
+            size = entry["size"]
+            index = entry["index"]
+            every = self.every
+
+            while pos < size:
+                match = regex.search(mm, pos)
+
+                if match is None:
+                    break
+
+                if len(lines) == limit:
+                    nxt = line
+                    break
+
+                lineStart = mm.rfind(b"\n", pos, match.start()) + 1 or pos
+                lineEnd = mm.find(b"\n", match.start())
+                lineEnd = size if lineEnd == -1 else lineEnd
+
+                # skip the lines between the matches by means of the index, and
+                # count the remaining ones without copying them
+                k = bisect_right(index, lineStart) - 1
+
+                if k * every > line:
+                    line = k * every
+                    pos = index[k]
+
+                while (nl := mm.find(b"\n", pos, lineStart)) != -1:
+                    line += 1
+                    pos = nl + 1
+
+                lines.append([line, decode(mm[lineStart:lineEnd])])
+                pos = lineEnd + 1
+                line += 1
+
+        return dict(nLines=nLines, lines=lines, next=nxt)
+
+    def summary(self, task, name):
+        """Summarize the columns of a CSV or TSV report.
+
+        Parameters
+        ----------
+        task: string
+            The key of the task.
+        name: string
+            The name of the report.
+
+        Returns
+        -------
+        dict or None
+            With keys `nRows` and `columns`, a list with for each column a dict with
+            its `name`, the number of `empty` and `numeric` values, the `min`,
+            `max` and `mean` of the numeric values, the number of `distinct`
+            values (None if there are more than 1000) and the `top` most
+            frequent values with their counts.
+            None if there is no such report, or if it is not CSV or TSV.
+        """
+        if not name.endswith((".csv", ".tsv")):
+            return None
+
+        path = self.path(task, name)
+
+        if path is None:
+            return None
+
+        entry = self.entry(path)
+
+        if entry["summary"] is None:
+            entry["summary"] = self.makeSummary(path, name.endswith(".tsv"))
+
+        return entry["summary"]
+
+    def makeSummary(self, path, tabs):
+        """Summarize the columns of a CSV or TSV file in a single pass.
+
+        The rows are read in batches. The values of a column in a batch are
+        counted in one go, so that the numeric statistics only have to be
+        computed once per distinct value in the batch.
+
+        See `summary()`.
+        """
+        columns = None
+        nRows = 0
+
+        with open(path, newline="", encoding="utf-8", errors="replace") as fh:
+            reader = csv.reader(fh, delimiter="\t" if tabs else ",")
+            header = next(reader, [])
+            columns = [
+                dict(name=name, empty=0, numeric=0, min=None, max=None, total=0)
+                for name in header
+            ]
+            counters = [Counter() for name in header]
+            overflow = [False for name in header]
+
+            for batch in iter(lambda: list(islice(reader, BATCH_SIZE)), []):
+                nRows += len(batch)
+                cells = zip_longest(*batch, fillvalue="")
+
+                for i, (column, values) in enumerate(zip(columns, cells)):
+                    batchCounter = Counter(values)
+                    counter = counters[i]
+
+                    for value, count in batchCounter.items():
+                        value = value.strip()
+
+                        if value == "":
+                            column["empty"] += count
+                            continue
+
+                        try:
+                            number = float(value)
+                        except ValueError:
+                            number = None
+
+                        if number is not None:
+                            column["numeric"] += count
+                            column["total"] += number * count
+
+                            if column["min"] is None or number < column["min"]:
+                                column["min"] = number
+
+                            if column["max"] is None or number > column["max"]:
+                                column["max"] = number
+
+                        if value in counter:
+                            counter[value] += count
+                        elif len(counter) < DISTINCT_LIMIT:
+                            counter[value] = count
+                        else:
+                            overflow[i] = True
+
+        for column, counter, over in zip(columns, counters, overflow):
+            total = column.pop("total")
+            numeric = column["numeric"]
+            column["mean"] = total / numeric if numeric else None
+            column["distinct"] = None if over else len(counter)
+            ranked = sorted(counter.items(), key=lambda x: (-x[1], x[0]))
+            column["top"] = ranked[0:TOP]
+
+        return dict(nRows=nRows, columns=columns)
+
+
+def decode(line):
+    """Turn a line of bytes into a string without line ending."""
+    return line.rstrip(b"\r\n").decode("utf-8", errors="replace")
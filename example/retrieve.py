@@ -0,0 +1,362 @@
+"""Retrieve the input data of corpora from their git backends, in parallel.
+
+Usage on the command line:
+
+    python retrieve.py outDir corpus ... [--paths P ...] [--ref REF] [--depth N]
+        [--filter SPEC] [--workers N] [--url-base URL] [--root DIR]
+
+*   `outDir`: the directory where the result is written, as `result.json`;
+*   `corpus`: a corpus as `backend/org/repo`, e.g. `github/org/repo`, where the
+    backend is one of `helpers.BACKENDS`;
+*   `--paths`: the paths in the repositories that the pipeline uses, e.g.
+    `tei/ metadata/`; only these are checked out (default: everything);
+*   `--ref`: the branch or commit to retrieve (default: `HEAD` of the remote);
+*   `--depth`: the number of commits to fetch (default: 1);
+*   `--filter`: a partial clone filter, e.g. `blob:none`, so that only the
+    files in `--paths` are downloaded, if the server supports it;
+*   `--workers`: the number of corpora that are fetched at the same time
+    (default: 4);
+*   `--url-base`: the base of the remote URLs, instead of the one of the
+    backend; the remote of a corpus is then `URL/org/repo.git`, which may be
+    a local directory with bare repositories;
+*   `--root`: the directory under which the clones are, instead of the home
+    directory, see `helpers.corpusDir()`.
+
+The clones are shallow and sparse: only the last commit(s) are fetched, and only
+the paths that the pipeline uses are checked out. Scans and other large files
+outside those paths are never downloaded, if the server supports filters.
+
+For every corpus the result contains the retrieved commit, and the files under
+the paths that have changed since the last commit that has been built, see
+`markBuilt()`; None if all files should be considered as changed.
+The changed files are informational only: the steps after the retrieval
+determine for themselves what they have to do again, e.g. the conversion from
+the manifest of its input files, see `manifest.py`, and the IIIF step from the
+digests of the scans, see `iiif.py`.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dag import Step
+from helpers import camelToOption, corpusDir
+
+BUILT_FILE = "editem-built"  # in the git directory of a clone: the last built commit
+URL_BASES = {
+    "github": "https://github.com",
+    "gitlab": "https://gitlab.com",
+    "gitlab.huc.knaw.nl": "https://gitlab.huc.knaw.nl",
+    "code.huc.knaw.nl": "https://code.huc.knaw.nl",
+}
+
+
+def say(text):
+    """Write an informational line to stdout immediately."""
+    sys.stdout.write(f"{text}\n")
+    sys.stdout.flush()
+
+
+def git(directory, *args):
+    """Run a git command in a directory.
+
+    Parameters
+    ----------
+    directory: string
+        The working directory of the command.
+    *args: string
+        The git command and its arguments.
+
+    Returns
+    -------
+    string
+        The output of the command.
+
+    Raises
+    ------
+    RuntimeError
+        If the command fails, with the error output of git.
+    """
+    proc = subprocess.run(
+        ["git", "-C", directory, *args], capture_output=True, text=True
+    )
+
+    if proc.returncode:
+        raise RuntimeError(f"git {args[0]}: {proc.stderr.strip()}")
+
+    return proc.stdout
+
+
+def builtCommit(directory):
+    """The last commit of a clone that has been built, None if there is none."""
+    path = f"{directory}/.git/{BUILT_FILE}"
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as fh:
+        return fh.read().strip() or None
+
+
+def markBuilt(directory, commit):
+    """Record that a commit of a clone has been built.
+
+    The next retrieval reports the files that have changed since this commit.
+
+    Parameters
+    ----------
+    directory: string
+        The directory of the clone.
+    commit: string
+        The commit.
+    """
+    path = f"{directory}/.git/{BUILT_FILE}"
+
+    with open(f"{path}.tmp", "w") as fh:
+        fh.write(f"{commit}\n")
+
+    os.replace(f"{path}.tmp", path)
+
+
+def corpusSpec(corpus, urlBase=None, root=None):
+    """Determine the remote and the local directory of a corpus.
+
+    Parameters
+    ----------
+    corpus: string
+        The corpus as `backend/org/repo`.
+    urlBase: string, optional None
+        The base of the remote URL, instead of the one of the backend.
+    root: string, optional None
+        The directory under which the clones are, instead of the home directory.
+
+    Returns
+    -------
+    tuple
+        The remote URL and the directory of the clone.
+    """
+    (backend, org, repo) = corpus.rsplit("/", 2)
+    directory = corpusDir(backend, org, repo)
+
+    if root is not None:
+        directory = f"{root}/{backend}/{org}/{repo}"
+
+    base = URL_BASES[backend] if urlBase is None else urlBase.rstrip("/")
+    return (f"{base}/{org}/{repo}.git", directory)
+
+
+def retrieveOne(url, directory, paths=(), ref="HEAD", depth=1, filter=None):
+    """Bring a shallow, sparse clone of a corpus up to date.
+
+    Parameters
+    ----------
+    url: string
+        The remote.
+    directory: string
+        The directory of the clone; it is created if needed.
+    paths: iterable of string, optional ()
+        The paths that are checked out; all paths if empty.
+    ref: string, optional "HEAD"
+        The branch or commit to retrieve.
+    depth: integer, optional 1
+        The number of commits to fetch.
+    filter: string, optional None
+        A partial clone filter, such as `blob:none`.
+
+    Returns
+    -------
+    dict
+        With `commit`, the retrieved commit, and `changed`, the sorted list of
+        files under the paths that have changed since the last built commit, or
+        None if there is no such commit.
+    """
+    paths = list(paths)
+
+    if not os.path.isdir(f"{directory}/.git"):
+        os.makedirs(directory, exist_ok=True)
+        git(directory, "init", "-q")
+        git(directory, "remote", "add", "origin", url)
+    else:
+        git(directory, "remote", "set-url", "origin", url)
+
+    if paths:
+        git(directory, "sparse-checkout", "set", "--no-cone", *paths)
+    else:
+        git(directory, "sparse-checkout", "disable")
+
+    fetch = ["fetch", "-q", "--no-tags", f"--depth={depth}"]
+
+    if filter is not None:
+        fetch.append(f"--filter={filter}")
+
+    git(directory, *fetch, "origin", ref)
+    commit = git(directory, "rev-parse", "FETCH_HEAD").strip()
+    built = builtCommit(directory)
+    changed = None
+
+    if built is not None:
+        try:
+            changed = sorted(
+                git(
+                    directory,
+                    "diff",
+                    "--name-only",
+                    "--no-renames",
+                    built,
+                    commit,
+                    "--",
+                    *paths,
+                ).splitlines()
+            )
+        except RuntimeError:
+            # the built commit is not in the clone (anymore)
+            changed = None
+
+    git(directory, "checkout", "-q", "--force", "-B", "build", commit)
+    return dict(commit=commit, changed=changed)
+
+
+def retrieveAll(corpora, workers=4, report=say, **kwargs):
+    """Retrieve several corpora in parallel, in a bounded pool of threads.
+
+    Git does the work in subprocesses, so threads suffice.
+    The failure of one corpus does not stop the others.
+
+    Parameters
+    ----------
+    corpora: dict
+        Keyed by corpus name, valued by tuples of remote URL and directory,
+        see `corpusSpec()`.
+    workers: integer, optional 4
+        The maximum number of corpora that are fetched at the same time.
+    report: function, optional say
+        Called with a line of text for every corpus that has been retrieved.
+    **kwargs: any
+        The further arguments of `retrieveOne()`.
+
+    Returns
+    -------
+    dict
+        Keyed by corpus name, valued by the result of `retrieveOne()`, with the
+        directory in `dir` and the number of seconds in `took`, or, if
+        the retrieval has failed, a dict with the message in `error`.
+    """
+    results = {}
+
+    def one(url, directory):
+        start = time.monotonic()
+        result = retrieveOne(url, directory, **kwargs)
+        result["dir"] = directory
+        result["took"] = round(time.monotonic() - start, 3)
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {
+            pool.submit(one, url, directory): corpus
+            for (corpus, (url, directory)) in corpora.items()
+        }
+
+        for future in as_completed(futures):
+            corpus = futures[future]
+
+            try:
+                result = future.result()
+            except Exception as e:
+                results[corpus] = dict(error=str(e))
+                report(f"{corpus}: error: {e}")
+                continue
+
+            results[corpus] = result
+            changed = result["changed"]
+            changedRep = (
+                "all files new" if changed is None else f"{len(changed)} changed files"
+            )
+            report(
+                f"{corpus}: {result['commit'][0:10]}, {changedRep}"
+                f" in {result['took']:.2f}s"
+            )
+
+    return {corpus: results[corpus] for corpus in sorted(results)}
+
+
+def retrieveStep(name, corpora, outDir, paths=(), **kwargs):
+    """A workflow step that retrieves corpora.
+
+    Parameters
+    ----------
+    name: string
+        The name of the step.
+    corpora: iterable of string
+        The corpora, as `backend/org/repo`.
+    outDir: string
+        The directory where the result is written.
+    paths: iterable of string, optional ()
+        The paths that the pipeline uses.
+    **kwargs: any
+        Further arguments for `Step`, such as `deps`, and the options of the
+        command line, such as `depth` and `workers`, by their long names in
+        camel case, e.g. `urlBase` for `--url-base`.
+
+    Returns
+    -------
+    object
+        The `Step`.
+    """
+    command = [sys.executable, "retrieve.py", outDir, *corpora]
+
+    if paths:
+        command.extend(["--paths", *paths])
+
+    for option in ("ref", "depth", "filter", "workers", "urlBase", "root"):
+        value = kwargs.pop(option, None)
+
+        if value is not None:
+            command.extend([f"--{camelToOption(option)}", str(value)])
+
+    return Step(name, command=command, resourceClass="io", **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="retrieve corpora from git")
+    parser.add_argument("outDir")
+    parser.add_argument("corpora", nargs="+")
+    parser.add_argument("--paths", nargs="*", default=[])
+    parser.add_argument("--ref", default="HEAD")
+    parser.add_argument("--depth", type=int, default=1)
+    parser.add_argument("--filter", default=None)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--url-base", default=None)
+    parser.add_argument("--root", default=None)
+    args = parser.parse_args()
+
+    corpora = {
+        corpus: corpusSpec(corpus, urlBase=args.url_base, root=args.root)
+        for corpus in args.corpora
+    }
+    say(f"retrieving {len(corpora)} corpora with {args.workers} workers")
+    results = retrieveAll(
+        corpora,
+        workers=args.workers,
+        paths=args.paths,
+        ref=args.ref,
+        depth=args.depth,
+        filter=args.filter,
+    )
+    os.makedirs(args.outDir, exist_ok=True)
+    path = f"{args.outDir}/result.json"
+
+    with open(f"{path}.tmp", "w") as fh:
+        json.dump(results, fh, ensure_ascii=False)
+
+    os.replace(f"{path}.tmp", path)
+    nErrors = sum(1 for result in results.values() if "error" in result)
+    say(f"retrieved {len(results) - nErrors} corpora, {nErrors} errors")
+    return 1 if nErrors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,67 @@
+from collections import deque
+
+
+class Ring:
+    """Keep the most recent events of a task run in memory.
+
+    Every event of a run has a sequence number, counting from 0.
+    The ring keeps the last `size` events, so that a client that connects or
+    reconnects during or after a run can be sent the events it has missed.
+    Older events are lost from the ring, but they are still in the run log.
+    """
+
+    def __init__(self, run, size):
+        """Create a ring for a run.
+
+        Parameters
+        ----------
+        run: string
+            The id of the run.
+        size: integer
+            The maximum number of events to keep.
+        """
+        self.run = run
+        self.events = deque(maxlen=size)
+        self.n = 0
+
+    def add(self, records):
+        """Give events a sequence number and add them to the ring.
+
+        Parameters
+        ----------
+        records: list of dict
+            The events. They get a key `n` with their sequence number.
+        """
+        n = self.n
+
+        for record in records:
+            record["n"] = n
+            n += 1
+
+        self.events.extend(records)
+        self.n = n
+
+    def first(self):
+        """The sequence number of the oldest event in the ring."""
+        return self.events[0]["n"] if self.events else self.n
+
+    def since(self, n):
+        """The events in the ring after a given sequence number.
+
+        Parameters
+        ----------
+        n: integer
+            The sequence number of the last event that has been seen.
+            Pass -1 to get all events.
+
+        Returns
+        -------
+        list of dict
+        """
+        events = self.events
+        skip = n + 1 - self.first()
+
+        if skip <= 0:
+            return list(events)
+
+        return [events[i] for i in range(skip, len(events))]
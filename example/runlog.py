@@ -0,0 +1,361 @@
+import os
+import gzip
+import json
+import mmap
+import time
+from array import array
+from threading import Lock
+
+
+class RunLog:
+    """Store the events of task runs in append-only log files.
+
+    Every run of a task gets its own log file, in a directory per task:
+
+        *baseDir* `/` *task* `/` *runId* `.log`
+
+    The log file contains one JSON record per line, one for every progress line
+    and every status message that has been emitted during the run.
+    Every record has a sequence number `n` (counting from 0 within the run,
+    assigned by the `Emitter`),
+    the elapsed time `tm`, the event type `ev` (`progress` or `status`) and
+    a `kind`, which is the severity: `info` or `error` for progress lines,
+    and `special` for status messages.
+
+    Next to the log file there is an index file *runId* `.idx`, which contains
+    the byte offset of every `every`-th record, as 8-byte unsigned integers.
+    With the index we can read a range of records, or the tail of the log,
+    without reading the log from the start.
+
+    When a new run of a task begins, the logs of the earlier runs of that task are
+    compressed with gzip, in the background.
+    Reading from compressed logs works in the same way, only slower.
+    """
+
+    def __init__(self, socketio, baseDir, every=1000):
+        """Create a run log store.
+
+        Parameters
+        ----------
+        socketio: object
+            The socketio object corresponding to the Flask app.
+            Used to compress old logs in a background task.
+        baseDir: string
+            The directory under which the logs are stored.
+        every: integer, optional 1000
+            The number of records per index entry.
+        """
+        self.socketio = socketio
+        self.baseDir = baseDir
+        self.every = every
+        self.runs = {}
+        self.logLock = Lock()
+        self.compressLock = Lock()
+
+    def taskDir(self, task):
+        """The directory with the logs of a task."""
+        return f"{self.baseDir}/{task}"
+
+    def begin(self, task):
+        """Start the log of a new run of a task.
+
+        Parameters
+        ----------
+        task: string
+            The key of the task.
+
+        Returns
+        -------
+        string
+            The id of the new run.
+        """
+        taskDir = self.taskDir(task)
+        os.makedirs(taskDir, exist_ok=True)
+        now = time.time()
+        runId = time.strftime("%Y%m%d-%H%M%S", time.localtime(now))
+        runId += f"-{int(now * 1000) % 1000:>03d}"
+
+        with self.logLock:
+            self.close(task)
+            self.runs[task] = dict(
+                runId=runId,
+                fh=open(f"{taskDir}/{runId}.log", "ab"),
+                idx=open(f"{taskDir}/{runId}.idx", "ab"),
+                offset=0,
+            )
+
+        self.socketio.start_background_task(self.compress, task, runId)
+        return runId
+
+    def end(self, task):
+        """End the log of the current run of a task.
+
+        Parameters
+        ----------
+        task: string
+            The key of the task.
+        """
+        with self.logLock:
+            self.close(task)
+
+    def close(self, task):
+        """Close the files of the current run of a task, if any.
+
+        The caller should hold the log lock.
+        """
+        run = self.runs.pop(task, None)
+
+        if run is not None:
+            run["fh"].close()
+            run["idx"].close()
+
+    def write(self, task, records):
+        """Append records to the log of the current run of a task.
+
+        Nothing is written if the task has no current run.
+
+        Parameters
+        ----------
+        task: string
+            The key of the task.
+        records: list of dict
+            The records to write. They have a sequence number `n`, and these
+            numbers are consecutive, from 0 within the run.
+        """
+        every = self.every
+
+        with self.logLock:
+            run = self.runs.get(task, None)
+
+            if run is None:
+                return
+
+            offset = run["offset"]
+            chunks = []
+            offsets = array("Q")
+
+            for record in records:
+                if record["n"] % every == 0:
+                    offsets.append(offset)
+
+                line = json.dumps(record, ensure_ascii=False)
+                chunk = f"{line}\n".encode("utf8")
+                chunks.append(chunk)
+                offset += len(chunk)
+
+            run["fh"].write(b"".join(chunks))
+            run["fh"].flush()
+
+            if offsets:
+                run["idx"].write(offsets.tobytes())
+                run["idx"].flush()
+
+            run["offset"] = offset
+
+    def compress(self, task, current):
+        """Compress the logs of a task, except the one of the current run.
+
+        Parameters
+        ----------
+        task: string
+            The key of the task.
+        current: string
+            The id of the current run.
+        """
+        taskDir = self.taskDir(task)
+
+        with self.compressLock:
+            for runId in self.listRuns(task):
+                path = f"{taskDir}/{runId}.log"
+
+                if runId == current or not os.path.exists(path):
+                    continue
+
+                with open(path, "rb") as fh, gzip.open(f"{path}.gz.tmp", "wb") as gh:
+                    while True:
+                        data = fh.read(1048576)
+
+                        if not data:
+                            break
+
+                        gh.write(data)
+
+                os.replace(f"{path}.gz.tmp", f"{path}.gz")
+                os.unlink(path)
+
+    def listRuns(self, task):
+        """The ids of the runs of a task that have a log, oldest first.
+
+        Parameters
+        ----------
+        task: string
+            The key of the task.
+
+        Returns
+        -------
+        list of string
+        """
+        taskDir = self.taskDir(task)
+
+        if not os.path.isdir(taskDir):
+            return []
+
+        return sorted(
+            {
+                name.removesuffix(".gz").removesuffix(".log")
+                for name in os.listdir(taskDir)
+                if name.endswith(".log") or name.endswith(".log.gz")
+            }
+        )
+
+    def read(
+        self, task, run=None, start=None, end=None, tail=None, kinds=None, limit=1000
+    ):
+        """Read records from the log of a run.
+
+        Parameters
+        ----------
+        task: string
+            The key of the task.
+        run: string, optional None
+            The id of the run. If None, the latest run is taken.
+        start: integer, optional None
+            The sequence number of the first record to read.
+        end: integer, optional None
+            The sequence number of the record after the last one to read.
+        tail: integer, optional None
+            If given, `start` is set such that the last `tail` records are read.
+        kinds: set of string, optional None
+            If given, only records of these kinds are delivered.
+        limit: integer, optional 1000
+            The maximum number of records to deliver.
+
+        Returns
+        -------
+        tuple
+            The id of the run and a list of records.
+            The run id is None if there is no log.
+        """
+        runs = self.listRuns(task)
+
+        if run is None:
+            run = runs[-1] if runs else None
+
+        if run is None or run not in runs:
+            return (None, [])
+
+        path = f"{self.taskDir(task)}/{run}"
+        index = self.readIndex(f"{path}.idx")
+        every = self.every
+        records = []
+
+        with self.openLog(path) as fh:
+            if tail is not None:
+                start = max(0, self.count(fh, index) - tail)
+
+            start = start or 0
+            block = min(start // every, len(index) - 1)
+
+            if block >= 0:
+                fh.seek(index[block])
+                skip = start - block * every
+
+                for i in range(skip):
+                    fh.readline()
+
+            n = start
+
+            while len(records) < limit and (end is None or n < end):
+                line = fh.readline()
+
+                if not line.endswith(b"\n"):
+                    # end of log, or a record that is still being written
+                    break
+
+                n += 1
+                record = json.loads(line)
+
+                if kinds is None or record["kind"] in kinds:
+                    records.append(record)
+
+        return (run, records)
+
+    def readIndex(self, path):
+        """Read an index file.
+
+        Parameters
+        ----------
+        path: string
+            The path of the index file.
+
+        Returns
+        -------
+        array
+            The offsets of every `every`-th record.
+        """
+        index = array("Q")
+
+        if os.path.exists(path):
+            with open(path, "rb") as fh:
+                data = fh.read()
+
+            index.frombytes(data[0 : len(data) - len(data) % index.itemsize])
+
+        return index
+
+    def count(self, fh, index):
+        """Count the complete records in a log, using its index.
+
+        Only the records after the last index entry are read.
+
+        Parameters
+        ----------
+        fh: object
+            The opened log.
+        index: array
+            The index of the log.
+
+        Returns
+        -------
+        integer
+        """
+        if not index:
+            return 0
+
+        fh.seek(index[-1])
+        n = (len(index) - 1) * self.every
+
+        for line in iter(fh.readline, b""):
+            if line.endswith(b"\n"):
+                n += 1
+
+        return n
+
+    def openLog(self, path):
+        """Open a log for reading.
+
+        An uncompressed log is memory mapped, so that we can seek in it and
+        read lines from it without loading it in memory.
+        A compressed log is opened through gzip, which supports seeking as well.
+
+        Parameters
+        ----------
+        path: string
+            The path of the log, without extension.
+
+        Returns
+        -------
+        object
+            A file-like object with `seek()` and `readline()`, usable as context
+            manager.
+        """
+        if os.path.exists(f"{path}.log"):
+            with open(f"{path}.log", "rb") as fh:
+                size = os.fstat(fh.fileno()).st_size
+
+                if size > 0:
+                    return mmap.mmap(fh.fileno(), size, access=mmap.ACCESS_READ)
+
+            return open(f"{path}.log", "rb")
+
+        return gzip.open(f"{path}.log.gz", "rb")
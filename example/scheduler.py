@@ -0,0 +1,204 @@
+import heapq
+import itertools
+from threading import Lock
+
+
+class Scheduler:
+    """Admit tasks to run within limits, and queue the others.
+
+    There is a global limit on the number of tasks that run at the same time.
+    Moreover, every task has a resource class, e.g. `cpu` for heavy conversions
+    and `io` for ingests that mostly wait for the network, and every resource
+    class may have its own limit.
+
+    Tasks that cannot start right away are queued, ordered by priority
+    (highest first) and then by arrival (first come first served).
+    When a running task releases its slot, the queue is searched from the front
+    for tasks that fit in the freed resources.
+    So a task of a class that is fully occupied does not block tasks of other
+    classes behind it.
+
+    Tasks of an exempt resource class do not count for the global limit.
+    This is meant for tasks that only coordinate other tasks, such as workflows
+    that run their steps as tasks: if they took global slots, workflows could
+    occupy all slots while their steps wait in the queue.
+
+    Whenever the positions in the queue change, the `onQueue` callback is called
+    for every task whose position has changed.
+    """
+
+    def __init__(self, limit=4, classLimits=None, exempt=("control",), onQueue=None):
+        """Create a scheduler.
+
+        Parameters
+        ----------
+        limit: integer, optional 4
+            The maximum number of tasks that run at the same time.
+        classLimits: dict, optional None
+            The maximum number of tasks per resource class that run at the same
+            time. Classes that are not in this dict only have the global limit.
+        exempt: tuple, optional ("control",)
+            Resource classes that do not count for the global limit.
+        onQueue: function, optional None
+            Called as `onQueue(key, position)` when a task has been queued or
+            has moved in the queue. The first position is 1.
+        """
+        self.limit = limit
+        self.classLimits = classLimits or {}
+        self.exempt = set(exempt)
+        self.onQueue = onQueue
+        self.running = {}
+        self.queue = []
+        self.positions = {}
+        self.counter = itertools.count()
+        self.schedLock = Lock()
+
+    def submit(self, key, start, resourceClass="cpu", priority=0):
+        """Submit a task to be started as soon as the limits permit.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task.
+        start: function
+            Called without arguments when the task is admitted.
+            It should start the task and return quickly.
+            When the task has finished, `release()` must be called.
+        resourceClass: string, optional "cpu"
+            The resource class of the task.
+        priority: integer, optional 0
+            Tasks with a higher priority are admitted first.
+        """
+        with self.schedLock:
+            entry = (-priority, next(self.counter), key, resourceClass, start)
+            heapq.heappush(self.queue, entry)
+            ready = self.admit()
+
+        self.launch(ready)
+
+    def release(self, key):
+        """Give back the slot of a task that has finished.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task.
+        """
+        with self.schedLock:
+            if self.running.pop(key, None) is None:
+                return
+
+            ready = self.admit()
+
+        self.launch(ready)
+
+    def cancel(self, key):
+        """Remove a task from the queue.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task.
+
+        Returns
+        -------
+        boolean
+            Whether the task was in the queue.
+        """
+        with self.schedLock:
+            queue = [entry for entry in self.queue if entry[2] != key]
+            found = len(queue) != len(self.queue)
+
+            if found:
+                heapq.heapify(queue)
+                self.queue = queue
+
+        if found:
+            self.launch([])
+
+        return found
+
+    def fits(self, resourceClass):
+        """Whether a task of a resource class can start now.
+
+        The caller should hold the scheduler lock.
+        """
+        running = self.running
+        exempt = self.exempt
+
+        if resourceClass not in exempt:
+            nGlobal = sum(1 for rc in running.values() if rc not in exempt)
+
+            if nGlobal >= self.limit:
+                return False
+
+        classLimit = self.classLimits.get(resourceClass, None)
+
+        if classLimit is None:
+            return True
+
+        nClass = sum(1 for rc in running.values() if rc == resourceClass)
+        return nClass < classLimit
+
+    def admit(self):
+        """Take the tasks from the queue that can start now.
+
+        The caller should hold the scheduler lock.
+
+        Returns
+        -------
+        list of function
+            The start functions of the admitted tasks.
+        """
+        ready = []
+        waiting = []
+
+        for entry in sorted(self.queue):
+            (negPriority, n, key, resourceClass, start) = entry
+
+            if self.fits(resourceClass):
+                self.running[key] = resourceClass
+                ready.append(start)
+            else:
+                waiting.append(entry)
+
+        if len(waiting) != len(self.queue):
+            heapq.heapify(waiting)
+            self.queue = waiting
+
+        return ready
+
+    def queuePositions(self):
+        """The positions of the queued tasks.
+
+        Returns
+        -------
+        dict
+            Keyed by task, valued by position, starting at 1.
+        """
+        with self.schedLock:
+            return {entry[2]: i + 1 for (i, entry) in enumerate(sorted(self.queue))}
+
+    def launch(self, ready):
+        """Start admitted tasks and report the changed queue positions.
+
+        Parameters
+        ----------
+        ready: list of function
+            The start functions of the admitted tasks.
+        """
+        for start in ready:
+            start()
+
+        positions = self.queuePositions()
+        changed = {
+            key: position
+            for (key, position) in positions.items()
+            if self.positions.get(key, None) != position
+        }
+        self.positions = positions
+        onQueue = self.onQueue
+
+        if onQueue is not None:
+            for key, position in changed.items():
+                onQueue(key, position)
@@ -0,0 +1,348 @@
+"""Run a per-document converter over a corpus in a pool of worker processes.
+
+Usage on the command line:
+
+    python shard.py converter inDir outDir [--ext .xml] [--workers N] [--shards M]
+        [--changes PATH]
+
+*   `converter`: the conversion function, as `module:function`; it is called as
+    `function(path, report)` for every document, where `report(kind, text)`
+    emits a line of output, and it returns a JSON-serializable result;
+*   `inDir`: the directory with the documents;
+*   `outDir`: the directory where the merged result is written, as `result.json`;
+*   `--ext`: only files with this extension are documents (default `.xml`);
+*   `--workers`: the number of worker processes (default: the number of cores
+    that this process may use);
+*   `--shards`: the number of shards (default: 4 per worker);
+*   `--changes`: the changes of the input files since the previous run, as
+    written by `manifest.py`; only the added and changed documents are converted,
+    and merged with the previous result, from which the removed documents are
+    dropped.
+
+The documents are divided over the shards by size, so that the shards have
+about the same amount of work. The division only depends on the names and sizes
+of the documents, and the results are merged in the order of the document names,
+so the merged result does not depend on which worker finishes first.
+
+Every line that a worker writes is tagged with its shard, e.g. `[shard 03/16]`.
+The lines are written with a single `write()` each, so that the lines of
+concurrent workers do not get mixed up in the pipe.
+
+A document that cannot be converted is an error line on stderr, and an entry
+under `errors` in the result, but it does not make the script fail: the other
+documents are converted, and the steps after the conversion, such as the
+report of the errors, still run. The task runner counts the error lines, so
+that the run ends as `success-warnings`. The script only fails if the
+conversion as a whole fails, e.g. if a worker process dies.
+
+The workers are child processes of this script, in its process group.
+When the task runner terminates the process group of this script, the workers
+are terminated as well.
+"""
+
+import os
+import sys
+import json
+import heapq
+import argparse
+import importlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from dag import Step
+
+
+def makeShards(docs, nShards):
+    """Divide documents over shards, such that the shards have similar sizes.
+
+    Documents are taken from large to small, and each goes to the shard with
+    the least work so far.
+
+    Parameters
+    ----------
+    docs: dict
+        Keyed by relative path, valued by size in bytes.
+    nShards: integer
+        The number of shards.
+
+    Returns
+    -------
+    list of list
+        The relative paths of the documents per shard, sorted.
+        Empty shards are left out.
+    """
+    shards = [[] for i in range(nShards)]
+    loads = [(0, i) for i in range(nShards)]
+
+    for relPath in sorted(docs, key=lambda relPath: (-docs[relPath], relPath)):
+        (load, i) = heapq.heappop(loads)
+        shards[i].append(relPath)
+        heapq.heappush(loads, (load + docs[relPath], i))
+
+    return [sorted(shard) for shard in shards if shard]
+
+
+def findDocs(inDir, ext):
+    """Find the documents below a directory.
+
+    Parameters
+    ----------
+    inDir: string
+        The directory.
+    ext: string
+        The extension of the documents.
+
+    Returns
+    -------
+    dict
+        Keyed by relative path, valued by size in bytes.
+    """
+    docs = {}
+
+    for path, dirs, files in os.walk(inDir):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+
+        for name in files:
+            if name.endswith(ext):
+                fullPath = f"{path}/{name}"
+                docs[os.path.relpath(fullPath, inDir)] = os.path.getsize(fullPath)
+
+    return docs
+
+
+def previousResult(outDir, converter, changesPath):
+    """The result of the previous run, if it can be the basis of an incremental run.
+
+    Parameters
+    ----------
+    outDir: string
+        The directory where the merged result is written.
+    converter: string
+        The converter, as `module:function`.
+    changesPath: string
+        The changes of the input files, see `manifest.Manifest.diff()`.
+
+    Returns
+    -------
+    tuple or None
+        The changes and the previous result, None if either is missing, or if the
+        previous result has been made by another converter.
+    """
+    path = f"{outDir}/result.json"
+
+    if not os.path.exists(changesPath) or not os.path.exists(path):
+        return None
+
+    with open(changesPath) as fh:
+        changes = json.load(fh)
+
+    with open(path) as fh:
+        previous = json.load(fh)
+
+    if previous.get("converter", None) != converter:
+        return None
+
+    return (changes, previous)
+
+
+def say(text):
+    """Write an informational line to stdout immediately."""
+    sys.stdout.write(f"{text}\n")
+    sys.stdout.flush()
+
+
+def getConverter(spec):
+    """Import a converter function from its `module:function` spec."""
+    (moduleName, functionName) = spec.split(":", 1)
+    return getattr(importlib.import_module(moduleName), functionName)
+
+
+def runShard(spec, inDir, tag, relPaths):
+    """Run the converter over the documents of one shard.
+
+    This runs in a worker process.
+
+    Parameters
+    ----------
+    spec: string
+        The converter, as `module:function`.
+    inDir: string
+        The directory with the documents.
+    tag: string
+        The tag of the shard, which is prefixed to every output line.
+    relPaths: list of string
+        The documents of the shard.
+
+    Returns
+    -------
+    tuple
+        The results, keyed by document, and the errors, keyed by document.
+    """
+    converter = getConverter(spec)
+    results = {}
+    errors = {}
+
+    def report(kind, text):
+        fd = 2 if kind == "error" else 1
+        os.write(fd, f"{tag} {text}\n".encode("utf-8"))
+
+    for relPath in relPaths:
+        try:
+            results[relPath] = converter(f"{inDir}/{relPath}", report)
+        except Exception as e:
+            errors[relPath] = str(e)
+            report("error", f"{relPath}: {e}")
+
+    report("info", f"done: {len(results)} documents, {len(errors)} errors")
+    return (results, errors)
+
+
+def shardedStep(
+    name,
+    converter,
+    inDir,
+    outDir,
+    ext=".xml",
+    workers=None,
+    shards=None,
+    changes=None,
+    **kwargs,
+):
+    """A workflow step that runs a per-document converter in a process pool.
+
+    Parameters
+    ----------
+    name: string
+        The name of the step.
+    converter: string
+        The converter, as `module:function`.
+    inDir: string
+        The directory with the documents.
+    outDir: string
+        The directory where the merged result is written.
+    ext: string, optional ".xml"
+        The extension of the documents.
+    workers: integer, optional None
+        The number of worker processes, by default the number of cores.
+    shards: integer, optional None
+        The number of shards, by default 4 per worker.
+    changes: string, optional None
+        The changes of the input files, see `manifest.py`, if the step should
+        only convert what has changed.
+    **kwargs: any
+        Further arguments for `Step`, such as `deps`.
+        By default, the input directory is the input of the step, and the output
+        directory its output, so that the step can be cached.
+        An incremental step builds on its previous output, so it declares no
+        outputs by default, and is not cached.
+
+    Returns
+    -------
+    object
+        The `Step`.
+    """
+    command = [sys.executable, "shard.py", converter, inDir, outDir, "--ext", ext]
+    kwargs.setdefault("inputs", (inDir,))
+    kwargs.setdefault("outputs", (outDir,) if changes is None else ())
+    # the result does not depend on the directories, nor on the number of workers
+    kwargs.setdefault("params", dict(converter=converter, ext=ext))
+
+    if workers is not None:
+        command.extend(["--workers", str(workers)])
+
+    if shards is not None:
+        command.extend(["--shards", str(shards)])
+
+    if changes is not None:
+        command.extend(["--changes", changes])
+
+    return Step(name, command=command, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="convert documents in parallel")
+    parser.add_argument("converter")
+    parser.add_argument("inDir")
+    parser.add_argument("outDir")
+    parser.add_argument("--ext", default=".xml")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--shards", type=int, default=None)
+    parser.add_argument("--changes", default=None)
+    args = parser.parse_args()
+
+    getConverter(args.converter)
+    allDocs = findDocs(args.inDir, args.ext)
+    previous = (
+        None
+        if args.changes is None
+        else previousResult(args.outDir, args.converter, args.changes)
+    )
+    results = {}
+    errors = {}
+
+    if previous is None:
+        docs = allDocs
+    else:
+        (changes, previousMerged) = previous
+        redo = set(changes["added"]) | set(changes["changed"])
+
+        # documents that have gone, are dropped from the previous result
+        for kind, kept in (("results", results), ("errors", errors)):
+            for relPath, value in previousMerged[kind].items():
+                if relPath in allDocs and relPath not in redo:
+                    kept[relPath] = value
+
+        docs = {
+            relPath: size
+            for (relPath, size) in allDocs.items()
+            if relPath not in results and relPath not in errors
+        }
+        say(
+            f"{len(allDocs) - len(docs)} documents unchanged,"
+            f" {len(changes['removed'])} files removed"
+        )
+
+    workers = args.workers or len(os.sched_getaffinity(0))
+    nShards = max(1, min(args.shards or 4 * workers, len(docs)))
+    shards = makeShards(docs, nShards)
+    nShards = len(shards)
+    width = len(str(nShards))
+    tags = [f"[shard {i + 1:0{width}}/{nShards}]" for i in range(nShards)]
+
+    say(f"{len(docs)} documents in {nShards} shards over {workers} workers")
+    shardResults = [None] * nShards
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(runShard, args.converter, args.inDir, tags[i], shard): i
+            for (i, shard) in enumerate(shards)
+        }
+
+        for future in as_completed(futures):
+            i = futures[future]
+            shardResults[i] = future.result()
+
+    for shardResult, shardErrors in shardResults:
+        results.update(shardResult)
+        errors.update(shardErrors)
+
+    merged = dict(
+        converter=args.converter,
+        results={relPath: results[relPath] for relPath in sorted(results)},
+        errors={relPath: errors[relPath] for relPath in sorted(errors)},
+    )
+    os.makedirs(args.outDir, exist_ok=True)
+    path = f"{args.outDir}/result.json"
+
+    with open(f"{path}.tmp", "w") as fh:
+        json.dump(merged, fh, ensure_ascii=False)
+
+    os.replace(f"{path}.tmp", path)
+    say(
+        f"merged {len(docs)} converted with {len(allDocs) - len(docs)} unchanged"
+        f" documents, {len(errors)} errors, into {path}"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,217 @@
+"""A local stand-in for the TextRepo and AnnoRepo servers, to test ingests against.
+
+Usage on the command line:
+
+    python standin.py [--port 8090] [--fail F] [--delay S]
+
+*   `--port`: the port to listen on (default 8090);
+*   `--fail`: the fraction of upload requests that fail with
+    `503 Service Unavailable` before they are processed, so that the retries of
+    the ingest client are exercised (default 0);
+*   `--delay`: the number of seconds that every request takes, as if the server
+    were remote and busy (default 0).
+
+It implements the endpoints that `ingest.py` uses, and keeps everything in
+memory:
+
+*   TextRepo: `POST /task/import/documents/{externalId}/{typeName}`, with the
+    contents of a file as multipart form data;
+*   AnnoRepo: `GET /w3c/{container}/` and `POST /w3c/` with a `Slug` header, to
+    find and create a container, and `POST /w3c/{container}/annotations-batch`
+    with a list of annotations;
+*   `GET /`: the numbers of documents, containers, annotations and requests.
+
+Connections are kept alive, as with the real servers.
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+from threading import Lock
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Store:
+    """The in-memory contents of the stand-in server."""
+
+    def __init__(self, fail=0, delay=0):
+        self.fail = fail
+        self.delay = delay
+        self.lock = Lock()
+        self.documents = {}
+        self.containers = {}
+        self.requests = 0
+        self.failures = 0
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                documents=len(self.documents),
+                containers=len(self.containers),
+                annotations=sum(len(c) for c in self.containers.values()),
+                requests=self.requests,
+                failures=self.failures,
+            )
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Handle the requests of the ingest client."""
+
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, which would wait for delayed acks
+    disable_nagle_algorithm = True
+    store = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, data=None, headers={}):
+        body = b"" if data is None else json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+
+        for name, value in headers.items():
+            self.send_header(name, value)
+
+        self.end_headers()
+        self.wfile.write(body)
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def busy(self):
+        """Count the request, wait, and fail it now and then, as configured."""
+        store = self.store
+
+        with store.lock:
+            store.requests += 1
+
+        if store.delay:
+            time.sleep(store.delay)
+
+        if self.command == "POST" and random.random() < store.fail:
+            with store.lock:
+                store.failures += 1
+
+            self.body()
+            self.reply(503, dict(message="try again"), {"Retry-After": "0"})
+            return True
+
+        return False
+
+    def do_GET(self):
+        if self.busy():
+            return
+
+        store = self.store
+        parts = self.path.strip("/").split("/")
+
+        if self.path == "/":
+            self.reply(200, store.stats())
+        elif len(parts) == 2 and parts[0] == "w3c":
+            with store.lock:
+                container = store.containers.get(parts[1], None)
+
+            if container is None:
+                self.reply(404, dict(message=f"no container {parts[1]}"))
+            else:
+                self.reply(200, dict(id=parts[1], total=len(container)))
+        else:
+            self.reply(404, dict(message=f"no such path {self.path}"))
+
+    def do_POST(self):
+        if self.busy():
+            return
+
+        store = self.store
+        parts = self.path.split("?", 1)[0].strip("/").split("/")
+
+        if parts == ["w3c"]:
+            self.body()
+            name = self.headers.get("Slug", None)
+
+            with store.lock:
+                if name in store.containers:
+                    self.reply(409, dict(message=f"container {name} exists"))
+                    return
+
+                store.containers[name] = []
+
+            self.reply(201, dict(id=name), {"Location": f"/w3c/{name}/"})
+        elif len(parts) == 3 and parts[0] == "w3c" and parts[2] == "annotations-batch":
+            annotations = json.loads(self.body())
+
+            with store.lock:
+                container = store.containers.get(parts[1], None)
+
+                if container is not None:
+                    first = len(container)
+                    container.extend(annotations)
+
+            if container is None:
+                self.reply(404, dict(message=f"no container {parts[1]}"))
+                return
+
+            self.reply(
+                200,
+                [
+                    dict(containerName=parts[1], annotationName=f"{first + i}")
+                    for i in range(len(annotations))
+                ],
+            )
+        elif len(parts) == 5 and parts[0:3] == ["task", "import", "documents"]:
+            (externalId, typeName) = parts[3:5]
+            head = f"Content-Type: {self.headers.get('Content-Type', '')}\r\n\r\n"
+            message = BytesParser(policy=HTTP).parsebytes(
+                head.encode("utf-8") + self.body()
+            )
+            contents = None
+
+            for part in message.iter_parts():
+                if part.get_param("name", header="content-disposition") == "contents":
+                    contents = part.get_payload(decode=True)
+
+            if contents is None:
+                self.reply(400, dict(message="no contents"))
+                return
+
+            with store.lock:
+                store.documents[(externalId, typeName)] = contents
+                n = len(store.documents)
+
+            self.reply(
+                201, dict(documentId=f"{n}", fileId=f"{n}", versionId=f"{n}")
+            )
+        else:
+            self.body()
+            self.reply(404, dict(message=f"no such path {self.path}"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="stand-in for TextRepo, AnnoRepo")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--fail", type=float, default=0)
+    parser.add_argument("--delay", type=float, default=0)
+    args = parser.parse_args()
+
+    Handler.store = Store(fail=args.fail, delay=args.delay)
+    server = ThreadingHTTPServer(("localhost", args.port), Handler)
+    server.daemon_threads = True
+    sys.stdout.write(f"stand-in server on http://localhost:{args.port}\n")
+    sys.stdout.flush()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
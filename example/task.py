@@ -1,11 +1,23 @@
-import signal
 import sys
-import select
-import os
+import time
 from subprocess import Popen, PIPE
 from threading import Lock, Event
 
-from helpers import Timestamp
+from helpers import Timestamp, console
+from emitter import Emitter
+from reactor import Reactor
+from runlog import RunLog
+from scheduler import Scheduler
+from usage import Usage
+from registry import Registry, workerId
+from history import History
+from classify import Classifier, DEFAULT_RULES
+from wire import Wire
+from cache import StepCache
+from dag import Dag
+from preview import previewSteps
+
+QUEUED = "queued"
 
 
 class Task:
@@ -16,28 +28,172 @@ class Task:
     Care is taken that tasks can be started in the background,
     can be killed, and that the output and return status of tasks is communicated
     via web sockets.
+
+    The server may run in several worker processes, possibly on several machines.
+    Then they share a `SqliteRegistry`, which holds which worker runs which task:
+    a task can only be started if no worker runs it, and a task that runs in
+    another worker is stopped by setting its stop flag in the registry.
+    Every worker looks at the registry regularly, see `runSync()`: it renews the
+    leases of its tasks, stops the tasks that have been flagged, and emits the
+    Socket.IO messages of the other workers to its own clients.
+    The concurrency limits of the scheduler hold per worker.
     """
 
-    def __init__(self, socketio):
+    def __init__(
+        self,
+        socketio,
+        batchWindow=0.25,
+        batchBudget=65536,
+        logDir="logs",
+        ringSize=10000,
+        concurrency=4,
+        classLimits=None,
+        resourceClasses=None,
+        corpus=None,
+        registry=None,
+        lease=30.0,
+        syncInterval=0.2,
+        messageAge=300.0,
+        historyPath="state/history.db",
+        etaInterval=5.0,
+        rules=DEFAULT_RULES,
+        killGrace=5.0,
+        cacheDir="state/cache",
+        cacheBudget=1 << 30,
+    ):
         """Create a task object.
 
         Parameters
         ----------
         socketio: object
             The socketio object corresponding to the Flask app.
+        batchWindow: float, optional 0.25
+            The time window in seconds during which progress lines are collected
+            before they are emitted as one batch. See `Emitter`.
+        batchBudget: integer, optional 65536
+            The size in characters at which a batch of progress lines is emitted
+            without waiting for the end of the time window.
+        logDir: string, optional "logs"
+            The directory where the logs of the task runs are stored.
+            See `RunLog`.
+        ringSize: integer, optional 10000
+            The number of recent events per task that are kept in memory, to be
+            replayed to clients that connect during or after a run.
+            See `Ring`.
+        concurrency: integer, optional 4
+            The maximum number of tasks that run at the same time.
+            Tasks that are started beyond this limit, wait in a queue.
+            See `Scheduler`.
+        classLimits: dict, optional None
+            The maximum number of tasks per resource class that run at the same
+            time.
+        resourceClasses: dict, optional None
+            The resource class of each task, keyed by task key.
+            Tasks that are not in this dict have resource class `cpu`.
+        corpus: string, optional None
+            The corpus whose tasks are run. The events of a task are sent to a
+            room per corpus and task, see `Emitter.room()`.
+        registry: object, optional None
+            The registry of running tasks, see `Registry`.
+            If None, an in-memory registry is used, for a single worker.
+        lease: float, optional 30.0
+            The number of seconds that the ownership of a task holds after the
+            last renewal. If a worker dies, its tasks can be started by other
+            workers after this time.
+        syncInterval: float, optional 0.2
+            The number of seconds between the looks at a shared registry.
+        messageAge: float, optional 300.0
+            The number of seconds that published messages are kept in a shared
+            registry.
+        historyPath: string, optional "state/history.db"
+            The path of the database with the history of the runs, see `History`.
+            If None, no history is kept, and no progress is estimated.
+        etaInterval: float, optional 5.0
+            The number of seconds between the estimates of the progress of the
+            running tasks that are emitted.
+        rules: iterable of tuple, optional DEFAULT_RULES
+            The rules by which the output lines of the tasks of the corpus are
+            classified, see `Classifier`. If None, lines from stdout are `info`
+            and lines from stderr `error`.
+        killGrace: float, optional 5.0
+            The number of seconds that the processes of a stopped task get to end
+            after the termination signal, before they are killed.
+        cacheDir: string, optional "state/cache"
+            The directory of the store of the outputs of workflow steps, see
+            `StepCache`. If None, steps are not cached.
+        cacheBudget: integer, optional 1 GiB
+            The maximum number of bytes in the store of step outputs.
         """
         self.socketio = socketio
+        self.corpus = corpus
+        self.history = None if historyPath is None else History(historyPath)
+        self.cache = None if cacheDir is None else StepCache(cacheDir, cacheBudget)
+        self.etaInterval = etaInterval
+        self.estimator = None
+        self.registry = Registry() if registry is None else registry
+        self.worker = workerId()
+        self.lease = lease
+        self.syncInterval = syncInterval
+        self.messageAge = messageAge
+        self.runLog = RunLog(socketio, logDir)
+        self.wire = Wire(socketio, corpus=corpus)
+        self.emitter = Emitter(
+            socketio,
+            window=batchWindow,
+            budget=batchBudget,
+            log=self.runLog,
+            ringSize=ringSize,
+            corpus=corpus,
+            publish=self.publish if self.registry.shared else None,
+            classifier=None if rules is None else Classifier(rules),
+            wire=self.wire,
+        )
+        self.killGrace = killGrace
+        self.reactor = self.makeReactor(socketio, killGrace)
+        self.scheduler = Scheduler(
+            limit=concurrency, classLimits=classLimits, onQueue=self.reportQueue
+        )
+        self.resourceClasses = resourceClasses or {}
+        self.usage = Usage(socketio)
         self.threads = {}
         self.stopEvents = {}
+        self.stopTimes = {}
+        self.stopHooks = {}
+        self.followUps = {}
         self.threadLock = Lock()
 
-    def start(self, key, task, *args, **kwargs):
-        """Start a task in a new thread.
+        if self.registry.shared:
+            socketio.start_background_task(self.runSync)
+
+    def makeReactor(self, socketio, killGrace):
+        """Make the reactor that runs the subprocesses of tasks, see `Reactor`.
+
+        Parameters
+        ----------
+        socketio: object
+            The socketio object corresponding to the Flask app.
+        killGrace: float
+            The number of seconds between terminating and killing a subprocess.
+
+        Returns
+        -------
+        object
+        """
+        return Reactor(socketio, grace=killGrace)
+
+    def start(self, key, task, *args, priority=0, resourceClass=None, **kwargs):
+        """Start a task in a new thread, as soon as the scheduler admits it.
 
         Each task has a key, and the thread for this task is
         stored under that key.
         A task can only start if there is no active thread under
-        that key.
+        that key, in this worker or in any other worker, according to the
+        registry.
+
+        The task is submitted to the scheduler, which starts it right away
+        if the concurrency limits permit, and queues it otherwise.
+        While the task is queued, its thread is marked as `queued`.
+        The slot of the task is given back to the scheduler by `clear()`.
 
         Each task also has a thread event under its key, which
         will be used to signal to the task that it should stop.
@@ -56,22 +212,107 @@ class Task:
             `subprocess`
         *args, **kwargs: any
             Additional arguments to pass to the task function.
+        priority: integer, optional 0
+            Queued tasks with a higher priority are started first.
+        resourceClass: string, optional None
+            The resource class of the task. By default it is looked up in the
+            resource classes that have been passed when creating this object.
+
+        Returns
+        -------
+        boolean
+            Whether the task has been started; False if it is already running.
         """
-        socketio = self.socketio
         threads = self.threads
         stopEvents = self.stopEvents
         threadLock = self.threadLock
 
+        if self.isLocal(key):
+            return False
+
+        # the claim may wait for the registry, so it is made outside the lock
+        if not self.registry.claim(key, self.worker, self.lease):
+            return False
+
         with threadLock:
-            threads[key] = socketio.start_background_task(task, *args, **kwargs)
+            if self.isLocal(key):
+                # another start of this task in this worker came first;
+                # the claim is held by this worker, so that run keeps it and
+                # releases it when it is cleared
+                return False
+
+            threads[key] = QUEUED
             stopEvents[key] = Event()
 
+        def launch():
+            with threadLock:
+                if threads.get(key, None) is not QUEUED:
+                    # the task has been cleared while it was waiting
+                    return
+
+                threads[key] = self.spawn(task, *args, **kwargs)
+
+        if resourceClass is None:
+            resourceClass = self.resourceClasses.get(key, "cpu")
+
+        self.scheduler.submit(
+            key, launch, resourceClass=resourceClass, priority=priority
+        )
+        return True
+
+    def spawn(self, task, *args, **kwargs):
+        """Run a task function in the background.
+
+        Parameters
+        ----------
+        task: function
+            The task function.
+        *args, **kwargs: any
+            The arguments for the task function.
+
+        Returns
+        -------
+        object
+            The thread in which the task runs.
+        """
+        return self.socketio.start_background_task(task, *args, **kwargs)
+
+    def reportQueue(self, key, position):
+        """Emit the position of a queued task.
+
+        Parameters
+        ----------
+        key: string
+            The key associated with a task.
+        position: integer
+            The position in the queue, starting at 1.
+        """
+        self.emitter.notify(
+            key,
+            stat="queued",
+            msg=f"waiting in queue at position {position}",
+            position=position,
+        )
+
     def stop(self, key):
         """Signal to a task that it should stop.
 
         This happens by setting the stop event associated with the task.
         The task function should check this event regularly and stop voluntarily
-        when it is set.
+        when it is set; if it waits, it should wait on the event, see `sleep()`.
+        If the task runs a subprocess that is watched by the reactor, the process
+        group of that subprocess is terminated right away, and killed if it has
+        not gone after `killGrace` seconds.
+        The time of the first stop signal is kept, so that the final status can
+        tell how long it took until the task was gone.
+        If the task is still waiting in the queue, it is taken out of the queue.
+        Finally, the functions that have been registered with `onStop()` for the
+        task are called.
+
+        A follow-up run that has been requested for the task, is dropped.
+
+        If the task runs in another worker, its stop flag is set in the registry,
+        and that worker will stop it.
 
         Parameters
         ----------
@@ -80,8 +321,53 @@ class Task:
         """
         stopEvents = self.stopEvents
 
-        if not self.isIdle(key):
-            stopEvents[key].set()
+        if not self.isLocal(key):
+            self.registry.requestStop(key)
+            return
+
+        with self.threadLock:
+            stopEvent = stopEvents.get(key, None)
+            self.followUps.pop(key, None)
+
+        if stopEvent is None:
+            # the task has been cleared in the meantime
+            return
+
+        self.stopTimes.setdefault(key, time.monotonic())
+        stopEvent.set()
+
+        if self.scheduler.cancel(key):
+            self.emitter.notify(key, stat="interrupt", msg="removed from queue")
+            self.clear(key)
+        else:
+            self.terminate(key)
+
+        for hook in self.stopHooks.pop(key, []):
+            hook()
+
+    def terminate(self, key):
+        """Terminate the process group of the subprocess of a task, if any.
+
+        Parameters
+        ----------
+        key: string
+            The key associated with a task.
+        """
+        self.reactor.terminate(key)
+
+    def onStop(self, key, hook):
+        """Register a function to be called when a task is stopped.
+
+        The registration ends when the task has finished.
+
+        Parameters
+        ----------
+        key: string
+            The key associated with a task.
+        hook: function
+            Called without arguments.
+        """
+        self.stopHooks.setdefault(key, []).append(hook)
 
     def isStopped(self, key):
         """Check whether the stop signal has been issued for a task.
@@ -94,14 +380,32 @@ class Task:
         Returns
         -------
         boolean
-            Whether a running task has its stop event set.
+            Whether a task that runs in this worker has its stop event set.
             False if the task is not running (anymore).
         """
         stopEvents = self.stopEvents
-        return not self.isIdle(key) and stopEvents[key].is_set()
+        stopEvent = stopEvents.get(key, None)
+        return stopEvent is not None and stopEvent.is_set()
+
+    def sleep(self, key, seconds):
+        """Sleep, but wake up as soon as the task is stopped.
+
+        Parameters
+        ----------
+        key: string
+            The key associated with a task.
+        seconds: float
+            The number of seconds to sleep.
+        """
+        stopEvent = self.stopEvents.get(key, None)
+
+        if stopEvent is None:
+            self.socketio.sleep(seconds)
+        else:
+            stopEvent.wait(seconds)
 
     def clear(self, key):
-        """Remove the thread and stop event of a task.
+        """Remove the thread and stop event of a task, and release its slot.
 
         Parameters
         ----------
@@ -110,8 +414,16 @@ class Task:
         """
         threads = self.threads
         stopEvents = self.stopEvents
-        threads[key] = None
-        stopEvents[key] = None
+
+        with self.threadLock:
+            threads[key] = None
+            stopEvents[key] = None
+
+        self.stopTimes.pop(key, None)
+        self.stopHooks.pop(key, None)
+        self.usage.pop(key)
+        self.registry.release(key, self.worker)
+        self.scheduler.release(key)
 
     def isIdle(self, key):
         """Check whether a task is running.
@@ -124,20 +436,184 @@ class Task:
         Returns
         -------
         boolean
-            True if there is no active thread for the task
+            True if there is no active thread for the task, in this worker or in
+            any other worker.
+        """
+        return not self.isLocal(key) and self.registry.owner(key) is None
+
+    def isLocal(self, key):
+        """Check whether a task runs, or waits in the queue, in this worker.
+
+        Parameters
+        ----------
+        key: string
+            The key associated with a task.
         """
-        return self.threads.get(key, None) is None
+        return self.threads.get(key, None) is not None
+
+    def startTask(self, key, priority=0, trigger="user"):
+        return self.start(key, self.doTask, key, trigger=trigger, priority=priority)
+
+    def requestRun(self, key, priority=0, trigger="user"):
+        """Start a task, or run it once more after its current run.
+
+        If the task is running in this worker, or waiting in the queue, the
+        request is remembered as a follow-up run, which starts as soon as the
+        current run has finished. All requests that come in during a run are
+        merged into that single follow-up; the trigger of the latest one is kept.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task.
+        priority: integer, optional 0
+            The priority of the run in the queue.
+        trigger: string, optional "user"
+            What has requested the run.
+
+        Returns
+        -------
+        string or None
+            `start-issued` if the task has been started, `start-coalesced` if
+            a follow-up run is pending, None if the task runs in another worker.
+        """
+        while True:
+            if self.startTask(key, priority=priority, trigger=trigger):
+                return "start-issued"
+
+            with self.threadLock:
+                if self.isLocal(key):
+                    self.followUps[key] = (priority, trigger)
+                    return "start-coalesced"
+
+            if not self.isIdle(key):
+                return None
 
-    def startTask(self, key):
-        self.start(key, self.doTask, key)
+            # the run has just finished, so we try to start it again
 
-    def doTask(self, task):
+    def begin(self, task, TM, trigger="user"):
+        """Start a new run of a task: its events, its history and its status.
+
+        Parameters
+        ----------
+        task: string
+            The key of the task.
+        TM: object
+            The `Timestamp` that records the start of the run.
+        trigger: string, optional "user"
+            What has started the run.
+        """
+        run = self.emitter.begin(task)
+
+        if self.history is not None:
+            self.history.begin(task, self.corpus, run, trigger)
+            self.startEstimator()
+
+        self.emitter.status(
+            task, tm=TM.offset(), stat="start", trigger=trigger, **self.estimate(task)
+        )
+
+    def estimate(self, key):
+        """Estimate the progress of the run of a task, see `History.estimate()`.
+
+        Returns
+        -------
+        dict
+            With keys `pct` and `eta`, or empty if nothing can be estimated.
+        """
+        return {} if self.history is None else self.history.estimate(key)
+
+    def startEstimator(self):
+        """Start the background task that emits the estimated progress of runs.
+
+        The estimator is started once, at the first run.
+        """
+        if self.estimator is not None:
+            return
+
+        with self.threadLock:
+            if self.estimator is None:
+                self.estimator = self.socketio.start_background_task(
+                    self.runEstimator
+                )
+
+    def runEstimator(self):
+        """Emit the estimated progress of the running tasks, forever.
+
+        The estimates are emitted as status messages with `stat="eta"`, which are
+        not part of the runs, see `Emitter.notify()`.
+        """
+        socketio = self.socketio
+
+        while True:
+            socketio.sleep(self.etaInterval)
+
+            for key in self.history.running():
+                estimate = self.estimate(key)
+
+                if estimate:
+                    self.emitter.notify(key, stat="eta", **estimate)
+
+    def publish(self, event, data, room):
+        """Pass an event that this worker emits on to the other workers."""
+        self.registry.publish(self.worker, event, data, room)
+
+    def runSync(self):
+        """Keep this worker in sync with the shared registry, forever.
+
+        Every sync interval:
+
+        *   the leases of the tasks of this worker are renewed, when a third of
+            the lease time has passed;
+        *   the tasks of this worker that have been flagged by other workers,
+            are stopped;
+        *   the messages that other workers have published, are emitted to the
+            clients of this worker, and kept for replay;
+        *   once per lease time, old messages are removed.
+        """
+        socketio = self.socketio
+        registry = self.registry
+        worker = self.worker
+        emitter = self.emitter
+        (last, messages) = registry.fetch(worker, None)
+        renewed = 0
+        pruned = 0
+
+        while True:
+            socketio.sleep(self.syncInterval)
+            now = time.monotonic()
+
+            try:
+                if now - renewed >= self.lease / 3:
+                    registry.renew(worker, self.lease)
+                    renewed = now
+
+                for key in registry.stopRequests(worker):
+                    if self.isLocal(key) and not self.isStopped(key):
+                        self.stop(key)
+
+                (last, messages) = registry.fetch(worker, last)
+
+                for event, data, room in messages:
+                    emitter.mirror(event, data)
+                    emitter.deliver(event, data, room)
+
+                if now - pruned >= self.lease:
+                    registry.prune(self.messageAge)
+                    pruned = now
+
+            except Exception as e:
+                sys.stderr.write(f"sync with registry failed: {e}\n")
+
+    def doTask(self, task, trigger="user"):
         """Function to implement tasks.
 
-        There are two tasks:
+        There are three tasks:
 
         *   `task='function'`: run a python function, programmed inside here.
         *   `task='script'`: run a python script via the shell (script.py)
+        *   `task='preview'`: run the steps of the preview workflow, in parallel
+            where their dependencies permit, see `Dag` and `previewSteps()`.
 
         Tasks will run asynchronically.
 
@@ -145,13 +621,32 @@ class Task:
         completion.  It will also emit an error message if it does not complete
         successfully.
 
+        All progress and status messages are also written to the log of the run,
+        see `RunLog`.
+        The run is recorded in the history, which is used to estimate its
+        progress, see `History`. The status messages carry that estimate
+        in `pct` and `eta`.
+        The final status of a workflow tells how many of its steps have been
+        restored from the cache, in `cache`, see `Dag.cacheStats()`.
+
         Progress messages come in two kinds: `info` and `error`.
+        They are not emitted one by one, but collected in batches by the
+        `Emitter`, per task and kind. The status messages are emitted immediately,
+        after flushing the pending progress messages of the task.
 
         When the task is a script, its stdout and stderr are catched in real time and
         emitted as progress messages of kinds `info` and `error` respectively.
-
-        In each iteration of the loop that emits the progress messages, the stop
-        event will be examined. If it is set, execution of the task will be ended.
+        The script task does not keep a thread busy: once the subprocess is
+        started, its pipes and its exit are handed over to the `Reactor`, which
+        watches the subprocesses of all script tasks in a single thread.
+        When the subprocess ends, the reactor calls back, and the final status
+        is emitted from there.
+
+        The function task examines the stop event in each iteration of its loop,
+        and sleeps on that event, so that it wakes up as soon as it is set.
+        If it is set, execution of the task will be ended.
+        The script task is stopped directly by `stop()`, which asks the reactor
+        to terminate the subprocess.
 
         !!! caution "async mode"
             Choosing `eventlet` as async mode leads to problems.
@@ -168,6 +663,9 @@ class Task:
 
             However, the problem disappears by choosing `threading` as async mode.
 
+            Use `benchemit.py` to measure the latency and throughput of the
+            emitted output in the various async modes.
+
         !!! note "child processes"
             The script that is executed in the script task, in turn starts another
             python script, clock.py, which is a never ending script that writes
@@ -186,134 +684,220 @@ class Task:
         Parameters
         ----------
         task: string
-            Either `function` or `script`.
+            Either `function`, `script` or `preview`.
             This selects which task will be executed.
+        trigger: string, optional "user"
+            What has started the task. It is recorded in the history.
         """
-        socketio = self.socketio
         TM = Timestamp()
-        socketio.emit("status", dict(tm=TM.elapsed(), task=task, stat="start"))
-        interrupted = False
-
-        def flush(toEnd=False):
-            """Read stderr and stdout of a process in parallel without blocking.
-
-            Parameters
-            ----------
-            toEnd: boolean, optional False
-                If True, the complete remainders on stderr and stdout is read.
-                Meant for when the process has stopped.
-                If False, at most a single line of stderr and/or stdout will be read.
-            """
-            # trick: use select to wait for stdout and stderr in parallel
-            readyStreams = select.select([proc.stdout, proc.stderr], [], [], 0.5)[0]
-
-            for stream in readyStreams:
-                kind = "info" if stream is proc.stdout else "error"
-                text = stream.read() if toEnd else stream.readline()
-
-                if not text:
-                    continue
-
-                # text = text.rstrip("\n")
-
-                socketio.emit(
-                    "progress",
-                    dict(
-                        tm=TM.elapsed(),
-                        task=task,
-                        kind=kind,
-                        text=text,
-                    ),
-                )
+        data = {}
 
         try:
+            # inside the try: if the log or the history fail, the task must end
+            self.begin(task, TM, trigger=trigger)
+
             if task == "function":
+                self.usage.beginThread(task)
+
+                try:
+                    (stat, msg) = self.doFunction(task, TM)
+                finally:
+                    self.usage.endThread(task)
+
+            elif task == "script":
+                self.doScript(task, TM)
+                # the final status is emitted when the reactor reports the exit
+                return
 
-                # start function code
+            elif task == "preview":
+                dag = Dag(self, task, previewSteps())
+                (stat, msg) = dag.run()
+                data = dag.cacheStats()
 
-                errorSteps = {2, 4}
-                longSteps = {8: 5, 9: 8}
+        except Exception as e:
+            stat = "failure"
+            msg = f"exception script {str(e)}"
 
-                for i in range(1, 11):
-                    if self.isStopped(task):
-                        # here is the check on the kill signal
-                        interrupted = True
-                        break
+        self.finish(task, TM, stat, msg, **data)
 
-                    kind = "error" if i in errorSteps else "info"
-                    interval = longSteps.get(i, 1)
-                    socketio.emit(
-                        "progress",
-                        dict(
-                            tm=TM.elapsed(),
-                            task=task,
-                            kind=kind,
-                            text=f"function step {i}",
-                        ),
-                    )
-                    socketio.sleep(interval)
+    def doFunction(self, task, TM):
+        """Run the function task.
 
-                stat = "success"
-                msg = "ok"
+        Parameters
+        ----------
+        task: string
+            The key of the task.
+        TM: object
+            The `Timestamp` that records the start of the task.
 
-                # end function code
+        Returns
+        -------
+        tuple
+            The status and message with which the task ended.
+        """
+        emitter = self.emitter
 
-            elif task == "script":
+        errorSteps = {2, 4}
+        longSteps = {8: 5, 9: 8}
 
-                # start wrapper to run a script in a subprocess
+        for i in range(1, 11):
+            if self.isStopped(task):
+                # here is the check on the kill signal
+                return ("interrupt", "interrupted by user")
 
-                proc = Popen(
-                    [sys.executable, "script.py"],
-                    shell=False,
-                    start_new_session=True,
-                    text=True,
-                    bufsize=None,
-                    stdout=PIPE,
-                    stderr=PIPE,
-                )
+            kind = "error" if i in errorSteps else "info"
+            interval = longSteps.get(i, 1)
+            emitter.progress(task, kind, TM.offset(), f"function step {i}")
+            self.sleep(task, interval)
 
-                while True:
-                    flush()
-                    if self.isStopped(task):
-                        # here is the check on the kill signal
-                        interrupted = True
-                        # we terminate all child processes to
-                        # note that proc.kill() would kill the toplevel process only
-                        pgid = os.getpgid(proc.pid)
-                        os.killpg(pgid, signal.SIGTERM)
-                        # we wait for the termination of all processes in the group
-                        # use the following command to see whether the clock and script
-                        # process has disappeared
-                        # ps -A | grep -i python
-                        result = os.waitid(
-                            os.P_PGID, pgid, os.WEXITED or os.WSTOPPED or os.WCONTINUED
-                        )
-                        sys.stdout.write(f"TERMINATED PROCESS: {result=}\n")
-                        sys.stdout.flush()
-                        proc.wait()
-                        break
-
-                    returnCode = proc.poll()
-
-                    if returnCode is not None:
-                        # script has ended, return code is known
-                        break
-
-                flush(toEnd=True)
-                stat = "success" if returnCode == 0 else "failure"
-                msg = f"exit with {returnCode}" if returnCode else ""
+        return ("success", "ok")
+
+    def doScript(self, task, TM):
+        """Start the script task and hand it over to the reactor.
+
+        Parameters
+        ----------
+        task: string
+            The key of the task.
+        TM: object
+            The `Timestamp` that records the start of the task.
+        """
+        emitter = self.emitter
+
+        def onLines(kind, lines):
+            emitter.progressLines(task, kind, TM.offset(), lines)
+
+        def onDone(stat, msg):
+            self.finish(task, TM, stat, msg)
 
-                # end wrapper
+        self.runScript(task, [sys.executable, "script.py"], onLines, onDone)
 
-            if interrupted:
+    def runScript(self, key, command, onLines, onDone):
+        """Start a subprocess for a task and hand it over to the reactor.
+
+        The subprocess gets its own process group, so that it can be terminated
+        together with all processes it spawns.
+        The resources used by the process group are measured, see `Usage`;
+        the result can be taken with `self.usage.pop(key)` after `onDone`
+        has been called.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task.
+        command: list
+            The command and its arguments.
+        onLines: function
+            Called as `onLines(kind, lines)` with output of the subprocess,
+            see `Reactor.watch()`.
+        onDone: function
+            Called as `onDone(stat, msg)` when the subprocess has ended,
+            with the status and message with which the task ended.
+        """
+        proc = Popen(
+            command,
+            shell=False,
+            start_new_session=True,
+            bufsize=0,
+            stdout=PIPE,
+            stderr=PIPE,
+        )
+        self.usage.watch(key, proc.pid)
+
+        def onExit(returnCode, rusage):
+            try:
+                self.usage.end(key, rusage)
+            except Exception as e:
+                # the task must end, even if its usage cannot be measured
+                console(f"usage: error at the end of {key}: {str(e)}")
+
+            if self.isStopped(key):
+                sys.stdout.write(f"TERMINATED PROCESS: {proc.pid=} {returnCode=}\n")
+                sys.stdout.flush()
                 stat = "interrupt"
                 msg = "interrupted by user"
+            else:
+                stat = "success" if returnCode == 0 else "failure"
+                msg = f"exit with {returnCode}" if returnCode else ""
 
-        except Exception as e:
-            stat = "failure"
-            msg = f"exception script {str(e)}"
+            onDone(stat, msg)
+
+        self.reactor.watch(key, proc, onLines, onExit)
+
+        if self.isStopped(key):
+            # the kill signal came in while we were starting the process
+            self.terminate(key)
+
+    def finish(self, task, TM, stat, msg, **data):
+        """Emit the final status of a task and remove its thread and stop event.
+
+        The final status includes the resources that the task has used, if they
+        have been measured, in the field `usage`. See `Usage`.
+        It also includes the number of output lines per severity in `counts`,
+        and per classification rule in `rules`.
+        If the task has been stopped, `killLatency` holds the number of seconds
+        between the stop signal and the end of the task, when its processes have
+        gone and its resources are freed.
+        A task that has succeeded, but has produced warnings or errors, ends with
+        status `success-warnings`.
+        The end of the run is recorded in the history.
+        If a follow-up run has been requested in the meantime, it is started.
 
+        Parameters
+        ----------
+        task: string
+            The key of the task.
+        TM: object
+            The `Timestamp` that records the start of the task.
+        stat: string
+            The final status of the task.
+        msg: string
+            An additional message.
+        **data: any
+            Additional fields for the final status message.
+        """
         # emit a status message that the task has finished
-        socketio.emit("status", dict(tm=TM.elapsed(), task=task, stat=stat, msg=msg))
-        # removed the thread and stop event of this task
-        self.clear(task)
+        usage = self.usage.pop(task)
+
+        if usage is not None:
+            data["usage"] = usage
+
+        stopTime = self.stopTimes.get(task, None)
+
+        if stopTime is not None:
+            data["killLatency"] = round(time.monotonic() - stopTime, 3)
+
+        (counts, rules) = self.emitter.tally(task)
+        nWarning = counts.get("warning", 0)
+        nError = counts.get("error", 0)
+
+        if stat == "success" and (nWarning or nError):
+            stat = "success-warnings"
+            msg = f"{nWarning} warnings, {nError} errors"
+
+        try:
+            self.emitter.status(
+                task,
+                tm=TM.offset(),
+                stat=stat,
+                msg=msg,
+                counts=counts,
+                rules=rules,
+                **data,
+            )
+
+            if self.history is not None:
+                self.history.end(task, stat, msg, counts)
+
+            self.emitter.end(task)
+        finally:
+            # removed the thread and stop event of this task, also if the log or
+            # the history have failed
+            self.clear(task)
+
+        with self.threadLock:
+            followUp = self.followUps.pop(task, None)
+
+        if followUp is not None:
+            (priority, trigger) = followUp
+            self.startTask(task, priority=priority, trigger=trigger)
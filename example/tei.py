@@ -0,0 +1,149 @@
+"""A stand-in for the TEI => TF conversion of a corpus of letters.
+
+The real conversion is done by text-fabric. Here we do a similar kind of
+work per document: parse the XML, walk over all elements and count words,
+so that the effect of running the conversion in parallel can be observed.
+"""
+
+import os
+import random
+import xml.etree.ElementTree as ET
+
+WORDS = (
+    "brief aan den heer mijn waarde vriend ik heb uw schrijven ontvangen "
+    "en met veel genoegen gelezen de zaak waarover gij schrijft"
+).split()
+
+
+def makeLetters(outDir, n, seed=1, broken=0):
+    """Generate a corpus of synthetic TEI letters, if it is not there already.
+
+    Parameters
+    ----------
+    outDir: string
+        The directory where the letters are written.
+    n: integer
+        The number of letters.
+    seed: integer, optional 1
+        The seed of the random generator, so that the corpus is always the same.
+    broken: float, optional 0
+        The fraction of letters that are not well-formed XML.
+
+    Returns
+    -------
+    integer
+        The number of letters that have been written.
+    """
+    R = random.Random(seed)
+    nWritten = 0
+
+    for i in range(1, n + 1):
+        path = f"{outDir}/{i // 100:03d}/letter{i:05d}.xml"
+        paras = []
+
+        for p in range(R.randint(2, 40)):
+            words = " ".join(R.choice(WORDS) for w in range(R.randint(20, 120)))
+            paras.append(f"<p n='{p + 1}'>{words}</p>")
+
+        end = "" if R.random() < broken else "</TEI>"
+        body = "\n".join(paras)
+
+        if os.path.exists(path):
+            continue
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, "w") as fh:
+            fh.write(
+                f"<TEI><teiHeader><title>Letter {i}</title></teiHeader>"
+                f"<text><body>{body}</body></text>{end}"
+            )
+
+        nWritten += 1
+
+    return nWritten
+
+
+def convert(path, report):
+    """Convert one letter.
+
+    Parameters
+    ----------
+    path: string
+        The path of the letter.
+    report: function
+        Called as `report(kind, text)` to emit an output line.
+
+    Returns
+    -------
+    dict
+        The number of elements, words and distinct words in the letter.
+    """
+    root = ET.parse(path).getroot()
+    nElements = 0
+    words = {}
+
+    for elem in root.iter():
+        nElements += 1
+
+        for word in (elem.text or "").split() + (elem.tail or "").split():
+            words[word] = words.get(word, 0) + 1
+
+    nWords = sum(words.values())
+
+    if nWords == 0:
+        report("error", f"{os.path.basename(path)}: no text")
+
+    return dict(elements=nElements, words=nWords, distinct=len(words))
+
+
+def watm(path, report):
+    """Derive the segmented text and the annotations of one letter.
+
+    This is a stand-in for the export of a corpus to WATM: the text is cut into
+    words, and every paragraph, and the letter itself, become web annotations
+    that target a range of words.
+
+    Parameters
+    ----------
+    path: string
+        The path of the letter.
+    report: function
+        Called as `report(kind, text)` to emit an output line.
+
+    Returns
+    -------
+    dict
+        The id of the letter, its segments, and its annotations.
+    """
+    letter = os.path.splitext(os.path.basename(path))[0]
+    root = ET.parse(path).getroot()
+    segments = []
+    annotations = []
+
+    def annotate(body, start):
+        annotations.append(
+            dict(
+                type="Annotation",
+                body=body,
+                target=dict(
+                    source=letter,
+                    selector=dict(
+                        type="TextAnchorSelector", start=start, end=len(segments) - 1
+                    ),
+                ),
+            )
+        )
+
+    for elem in root.iter("p"):
+        start = len(segments)
+        segments.extend((elem.text or "").split())
+        annotate(dict(type="tei:P", n=elem.get("n", None)), start)
+
+    title = root.findtext("teiHeader/title")
+    annotate(dict(type="tei:Letter", title=title), 0)
+
+    if not segments:
+        report("error", f"{letter}: no text")
+
+    return dict(id=letter, segments=segments, annotations=annotations)
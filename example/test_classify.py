@@ -0,0 +1,58 @@
+from classify import Classifier
+from emitter import Emitter
+
+
+class FakeSocketio:
+    """Collect emitted events instead of sending them."""
+
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event, data, to=None):
+        self.events.append((event, data, to))
+
+    def start_background_task(self, target, *args, **kwargs):
+        return None
+
+
+def test_tagged_lines_are_classified_by_their_text():
+    classifier = Classifier()
+    (groups, hits) = classifier.classify(
+        "error",
+        [
+            "[convert] INFO:root:starting",
+            "[convert] [shard 01/16] Traceback (most recent call last):",
+            "[convert] something went wrong",
+        ],
+    )
+
+    assert groups == dict(
+        info=["[convert] INFO:root:starting"],
+        error=[
+            "[convert] [shard 01/16] Traceback (most recent call last):",
+            "[convert] something went wrong",
+        ],
+    )
+    assert hits == dict(info=1, traceback=1)
+
+    (groups, hits) = classifier.classify("info", ["[convert] warning: x", "[a]b"])
+
+    assert groups == dict(warning=["[convert] warning: x"], info=["[a]b"])
+    assert hits == dict(warning=1)
+
+
+def test_step_output_is_tallied_by_its_text():
+    emitter = Emitter(FakeSocketio(), window=0, classifier=Classifier())
+    emitter.begin("preview")
+    emitter.progressLines(
+        "preview",
+        "error",
+        1.0,
+        ["[convert] INFO:root:starting", "[convert] DEBUG:root:shard 1"],
+    )
+    emitter.progressLines("preview", "info", 2.0, ["[convert] done"])
+
+    (tally, ruleTally) = emitter.tally("preview")
+
+    assert tally == dict(info=3)
+    assert ruleTally == dict(info=2)
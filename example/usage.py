@@ -0,0 +1,346 @@
+import os
+import resource
+from threading import Lock
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+FIELDS = ("cpuUser", "cpuSys", "peakRss", "readBytes", "writeBytes")
+
+
+def fromRusage(ru, rss=True):
+    """Turn a `resource` usage structure into a usage dict.
+
+    Parameters
+    ----------
+    ru: object
+        The result of `resource.getrusage()` or `os.wait4()`.
+    rss: boolean, optional True
+        Whether the maximum resident set size of the structure is meaningful.
+        For threads it is not: it is the maximum of the whole process.
+
+    Returns
+    -------
+    dict
+        With the keys in `FIELDS`. Memory and I/O are in bytes, CPU in seconds.
+    """
+    return dict(
+        cpuUser=ru.ru_utime,
+        cpuSys=ru.ru_stime,
+        peakRss=ru.ru_maxrss * 1024 if rss else None,
+        readBytes=ru.ru_inblock * 512,
+        writeBytes=ru.ru_oublock * 512,
+    )
+
+
+def combine(usage, other, how):
+    """Combine two usage dicts, field by field.
+
+    Parameters
+    ----------
+    usage, other: dict
+        The usage dicts; fields may be None.
+    how: function
+        The combining function for fields that are present in both dicts,
+        e.g. `max` or `sum`.
+
+    Returns
+    -------
+    dict
+    """
+    result = {}
+
+    for field in FIELDS:
+        values = [
+            x for x in (usage.get(field, None), other.get(field, None)) if x is not None
+        ]
+        result[field] = how(values) if values else None
+
+    return result
+
+
+def readProc(pid):
+    """Read the counters of a process from /proc.
+
+    Parameters
+    ----------
+    pid: string
+        The process id.
+
+    Returns
+    -------
+    tuple or None
+        The process group and a usage dict with the CPU times, the current
+        resident set size, and the bytes read from and written to storage.
+        None if the process has gone.
+    """
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as fh:
+            stat = fh.read()
+    except OSError:
+        return None
+
+    # the command name may contain spaces and parentheses, the fields after it not
+    fields = stat[stat.rfind(b")") + 2 :].split()
+    readBytes = None
+    writeBytes = None
+
+    try:
+        with open(f"/proc/{pid}/io", "rb") as fh:
+            for line in fh:
+                (name, value) = line.split(b":")
+
+                if name == b"read_bytes":
+                    readBytes = int(value)
+                elif name == b"write_bytes":
+                    writeBytes = int(value)
+    except OSError:
+        pass
+
+    usage = dict(
+        cpuUser=int(fields[11]) / CLOCK_TICKS,
+        cpuSys=int(fields[12]) / CLOCK_TICKS,
+        peakRss=int(fields[21]) * PAGE_SIZE,
+        readBytes=readBytes,
+        writeBytes=writeBytes,
+    )
+    return (int(fields[2]), usage)
+
+
+class Usage:
+    """Account the CPU time, peak memory and I/O of tasks.
+
+    A script task runs in its own process group, which contains the script
+    and all processes that it spawns, including grandchildren.
+    The resources of the group are measured in two ways:
+
+    *   every `interval` seconds, the processes of all watched groups are found in
+        `/proc`, and their counters are read; the latest counters of every
+        process are kept, also after it has ended;
+        the sum of the resident set sizes of the processes at the moment of
+        a sample, is a sample of the memory use of the group;
+    *   when the script itself has ended, `os.wait4()` gives its resource usage,
+        which includes the usage of the descendants that it has waited for.
+
+    Both are lower bounds of the real use: sampling misses what happens between
+    the last sample and the end of a process; `wait4()` misses descendants that
+    have not been waited for, such as orphaned helpers.
+    So we take the maximum of both, per field.
+
+    A function task runs in a thread of the server; its resources are measured
+    with `resource.getrusage(RUSAGE_THREAD)` at its start and end.
+    Peak memory cannot be attributed to a thread, so it is not reported.
+
+    The resulting usage is a dict with the fields in `FIELDS`:
+    `cpuUser` and `cpuSys` in seconds, `peakRss`, `readBytes`, `writeBytes` in
+    bytes.
+    """
+
+    def __init__(self, socketio, interval=1.0):
+        """Create the accounting.
+
+        Parameters
+        ----------
+        socketio: object
+            The socketio object corresponding to the Flask app.
+            Used to run the sampler as a background task.
+        interval: float, optional 1.0
+            The number of seconds between samples of the process groups.
+        """
+        self.socketio = socketio
+        self.interval = interval
+        self.groups = {}
+        self.threads = {}
+        self.results = {}
+        self.usageLock = Lock()
+        self.sampler = None
+
+    def watch(self, key, pgid):
+        """Start measuring the processes of a process group.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task.
+        pgid: integer
+            The id of the process group.
+        """
+        with self.usageLock:
+            self.groups[key] = dict(pgid=pgid, procs={}, peakRss=0)
+
+            if self.sampler is None:
+                self.sampler = self.socketio.start_background_task(self.runSampler)
+
+    def end(self, key, rusage=None):
+        """Stop measuring a process group, and compute its usage.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task.
+        rusage: object, optional None
+            The resource usage of the leader of the group, as given by `wait4()`.
+        """
+        self.sample(keys={key})
+
+        with self.usageLock:
+            group = self.groups.pop(key, None)
+
+            if group is not None:
+                procs = list(group["procs"].values())
+
+        if group is None:
+            return
+
+        sampled = dict(peakRss=group["peakRss"])
+
+        for usage in procs:
+            sampled = combine(sampled, dict(usage, peakRss=None), sum)
+
+        if rusage is not None:
+            sampled = combine(sampled, fromRusage(rusage), max)
+
+        self.add(key, sampled)
+
+    def beginThread(self, key):
+        """Start measuring the current thread. Call this in the thread of a task.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task.
+        """
+        ru = resource.getrusage(resource.RUSAGE_THREAD)
+        self.threads[key] = fromRusage(ru, rss=False)
+
+    def endThread(self, key):
+        """Stop measuring the current thread, and compute its usage.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task.
+        """
+        start = self.threads.pop(key, None)
+
+        if start is None:
+            return
+
+        ru = resource.getrusage(resource.RUSAGE_THREAD)
+        end = fromRusage(ru, rss=False)
+        self.add(
+            key,
+            {
+                field: None if end[field] is None else end[field] - start[field]
+                for field in FIELDS
+            },
+        )
+
+    def add(self, key, usage):
+        """Add usage to the result of a task.
+
+        CPU times and I/O are added up, for peak memory the maximum is taken.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task.
+        usage: dict or None
+            The usage to add.
+        """
+        if usage is None:
+            return
+
+        with self.usageLock:
+            result = self.results.get(key, None)
+
+            if result is None:
+                self.results[key] = dict(usage)
+            else:
+                peakRss = combine(result, usage, max)["peakRss"]
+                self.results[key] = combine(result, usage, sum) | dict(
+                    peakRss=peakRss
+                )
+
+    def pop(self, key):
+        """Take the usage of a task, rounded for reporting.
+
+        Parameters
+        ----------
+        key: string
+            The key of the task.
+
+        Returns
+        -------
+        dict or None
+            None if no usage has been measured for the task.
+        """
+        with self.usageLock:
+            result = self.results.pop(key, None)
+
+        if result is None:
+            return None
+
+        return {
+            field: None if value is None else round(value, 3)
+            for (field, value) in result.items()
+        }
+
+    def sample(self, keys=None):
+        """Read the counters of the processes of the watched groups.
+
+        Parameters
+        ----------
+        keys: set, optional None
+            If given, only the groups of these tasks are sampled.
+        """
+        with self.usageLock:
+            groups = {
+                group["pgid"]: group
+                for (key, group) in self.groups.items()
+                if keys is None or key in keys
+            }
+
+        if not groups:
+            return
+
+        rss = {pgid: 0 for pgid in groups}
+
+        for pid in os.listdir("/proc"):
+            if not pid.isdecimal():
+                continue
+
+            info = readProc(pid)
+
+            if info is None:
+                continue
+
+            (pgid, usage) = info
+            group = groups.get(pgid, None)
+
+            if group is None:
+                continue
+
+            rss[pgid] += usage["peakRss"]
+
+            # end() may read the processes of the group at the same time
+            with self.usageLock:
+                procs = group["procs"]
+                old = procs.get(pid, None)
+
+                if old is not None:
+                    # an unreadable io file should not erase the earlier counts
+                    usage = combine(usage, old, max)
+
+                procs[pid] = usage
+
+        with self.usageLock:
+            for pgid, group in groups.items():
+                group["peakRss"] = max(group["peakRss"], rss[pgid])
+
+    def runSampler(self):
+        """Sample the watched groups, forever, once every interval."""
+        socketio = self.socketio
+
+        while True:
+            socketio.sleep(self.interval)
+            self.sample()
@@ -0,0 +1,341 @@
+import os
+import time
+import ctypes
+import ctypes.util
+import select
+import struct
+
+from helpers import console
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+)
+EVENT_HEADER = struct.Struct("iIII")
+TEMP_SUFFIXES = ("~", ".swp", ".swx", ".tmp")
+
+
+def ignored(name):
+    """Whether a file or directory is not worth watching.
+
+    Parameters
+    ----------
+    name: string
+        The name of the file or directory, without its directory.
+
+    Returns
+    -------
+    boolean
+        True for hidden names and for the temporary files of editors.
+    """
+    return name.startswith((".", "#")) or name.endswith(TEMP_SUFFIXES)
+
+
+def inotify():
+    """Get the inotify functions of the C library, if the platform has them.
+
+    Returns
+    -------
+    object or None
+        The C library, None if it has no inotify.
+    """
+    name = ctypes.util.find_library("c")
+
+    if name is None:
+        return None
+
+    try:
+        libc = ctypes.CDLL(name, use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        libc.inotify_rm_watch
+    except (OSError, AttributeError):
+        return None
+
+    libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+    return libc
+
+
+class Watcher:
+    """Watch a directory tree and report bursts of changes as one.
+
+    Editors save files in bursts: several files, and several writes per file,
+    and often a temporary file that is renamed. Instead of reacting to every
+    change, the watcher waits until the tree has been quiet for `debounce`
+    seconds, and then reports all paths that have changed in the burst at once.
+    A burst that goes on and on is reported after `maxDelay` seconds anyway.
+
+    On Linux, the changes come from inotify, via the C library, so the watcher
+    thread sleeps until something happens. Inotify does not watch subdirectories
+    by itself, so every directory in the tree gets a watch of its own, also the
+    directories that are created later.
+    Elsewhere the watcher falls back to comparing the modification times and
+    sizes of the files every `pollInterval` seconds.
+
+    Files and directories whose names start with a dot are ignored, such as the
+    `.git` directory, and so are the temporary files of editors, see `ignored()`.
+    Changes to them do not count as activity, so they do not prolong a burst.
+    """
+
+    def __init__(
+        self, socketio, path, onChange, debounce=2.0, maxDelay=30.0, pollInterval=2.0
+    ):
+        """Create a watcher.
+
+        Parameters
+        ----------
+        socketio: object
+            The socketio object corresponding to the Flask app.
+            Used to start the watcher thread as a background task.
+        path: string
+            The directory to watch.
+        onChange: function
+            Called as `onChange(paths)` after a burst of changes, with the set of
+            changed paths, relative to the watched directory.
+            The path `.` means that changes may have been missed.
+        debounce: float, optional 2.0
+            The number of quiet seconds that end a burst.
+        maxDelay: float, optional 30.0
+            The maximum number of seconds between the first change of a burst
+            and its report.
+        pollInterval: float, optional 2.0
+            The number of seconds between looks at the tree, if there is no
+            inotify.
+        """
+        self.socketio = socketio
+        self.path = path.rstrip("/") or "/"
+        self.onChange = onChange
+        self.debounce = debounce
+        self.maxDelay = maxDelay
+        self.pollInterval = pollInterval
+        self.thread = None
+
+    def start(self):
+        """Start watching in a background thread."""
+        if self.thread is None:
+            self.thread = self.socketio.start_background_task(self.run)
+
+    def run(self):
+        """The loop of the watcher thread."""
+        os.makedirs(self.path, exist_ok=True)
+        libc = inotify()
+
+        if libc is None:
+            self.poll()
+            return
+
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+
+        if fd < 0:
+            console(f"watch: no inotify: {os.strerror(ctypes.get_errno())}")
+            self.poll()
+            return
+
+        self.listen(libc, fd)
+
+    def listen(self, libc, fd):
+        """Collect changes from inotify and report them in bursts.
+
+        Parameters
+        ----------
+        libc: object
+            The C library.
+        fd: integer
+            The inotify file descriptor.
+        """
+        dirs = {}
+        changed = set()
+
+        def addTree(top, new):
+            # files that have been created in a new directory before it got its
+            # watch, will not have events, so we count them as changed
+            for root, subDirs, files in os.walk(top):
+                subDirs[:] = [d for d in subDirs if not ignored(d)]
+                wd = libc.inotify_add_watch(fd, os.fsencode(root), WATCH_MASK)
+
+                if wd >= 0:
+                    dirs[wd] = root
+
+                if new:
+                    changed.update(
+                        os.path.relpath(f"{root}/{name}", self.path)
+                        for name in files
+                        if not ignored(name)
+                    )
+
+        def dropTree(top):
+            # a directory that has been moved keeps its watches, under its old
+            # path; if it stays in the tree, it is added again under its new path
+            below = f"{top}/"
+            gone = [
+                wd
+                for (wd, root) in dirs.items()
+                if root == top or root.startswith(below)
+            ]
+
+            for wd in gone:
+                del dirs[wd]
+                libc.inotify_rm_watch(fd, wd)
+
+        addTree(self.path, False)
+        first = None
+        last = None
+
+        while True:
+            if first is None:
+                timeout = None
+            else:
+                now = time.monotonic()
+                timeout = max(
+                    0, min(last + self.debounce, first + self.maxDelay) - now
+                )
+
+            (readable, w, x) = select.select([fd], [], [], timeout)
+
+            if not readable:
+                self.report(set(changed))
+                changed.clear()
+                first = None
+                continue
+
+            try:
+                data = os.read(fd, 65536)
+            except BlockingIOError:
+                continue
+
+            offset = 0
+            busy = False
+
+            while offset < len(data):
+                (wd, mask, cookie, size) = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset : offset + size].rstrip(b"\0"))
+                offset += size
+
+                if wd < 0:
+                    # the event queue has overflowed: anything may have changed
+                    changed.add(".")
+                    busy = True
+                    continue
+
+                root = dirs.get(wd, None)
+
+                if root is None or ignored(name):
+                    continue
+
+                if mask & IN_DELETE_SELF:
+                    del dirs[wd]
+                    continue
+
+                path = f"{root}/{name}" if name else root
+
+                if mask & IN_ISDIR:
+                    if mask & IN_MOVED_FROM:
+                        dropTree(path)
+                    elif mask & (IN_CREATE | IN_MOVED_TO):
+                        addTree(path, True)
+
+                changed.add(os.path.relpath(path, self.path))
+                busy = True
+
+            if busy:
+                last = time.monotonic()
+
+                if first is None:
+                    first = last
+
+    def poll(self):
+        """Collect changes by comparing snapshots of the tree, and report them."""
+        socketio = self.socketio
+        before = self.snapshot()
+        changed = set()
+        first = None
+        last = None
+
+        while True:
+            socketio.sleep(self.pollInterval)
+            after = self.snapshot()
+            now = time.monotonic()
+            new = {
+                path
+                for path in before.keys() | after.keys()
+                if before.get(path, None) != after.get(path, None)
+            }
+            before = after
+
+            if new:
+                changed |= new
+                last = now
+
+                if first is None:
+                    first = now
+
+            if first is not None and (
+                now >= last + self.debounce or now >= first + self.maxDelay
+            ):
+                self.report(changed)
+                changed = set()
+                first = None
+
+    def snapshot(self):
+        """The modification times and sizes of the files in the tree.
+
+        Returns
+        -------
+        dict
+            Keyed by path relative to the watched directory.
+        """
+        top = self.path
+        result = {}
+
+        for root, subDirs, files in os.walk(top):
+            subDirs[:] = [d for d in subDirs if not ignored(d)]
+
+            for name in files:
+                if ignored(name):
+                    continue
+
+                path = f"{root}/{name}"
+
+                try:
+                    info = os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+                result[os.path.relpath(path, top)] = (info.st_mtime_ns, info.st_size)
+
+        return result
+
+    def report(self, changed):
+        """Pass a burst of changes on, but do not let errors stop the watcher.
+
+        Parameters
+        ----------
+        changed: set
+            The changed paths.
+        """
+        if not changed:
+            return
+
+        try:
+            self.onChange(changed)
+        except Exception as e:
+            console(f"watch: error in change handler: {str(e)}")
@@ -0,0 +1,156 @@
+/* decoding of the compact encoding of events, see wire.py
+ *
+ * The server sends progress and status events as MessagePack in binary frames
+ * if we ask for it. Task and kind are ids in a dictionary that the server sends
+ * in wire-dict events; elapsed times are in hundredths of a second.
+ */
+
+const unpack = buffer => {
+  /* a MessagePack decoder for the types that the server sends
+   */
+  const view = new DataView(buffer)
+  const bytes = new Uint8Array(buffer)
+  const utf8 = new TextDecoder()
+  let pos = 0
+
+  const str = n => {
+    const value = utf8.decode(bytes.subarray(pos, pos + n))
+    pos += n
+    return value
+  }
+  const bin = n => {
+    const value = buffer.slice(pos, pos + n)
+    pos += n
+    return value
+  }
+  const arr = n => {
+    const value = new Array(n)
+    for (let i = 0; i < n; i++) {
+      value[i] = next()
+    }
+    return value
+  }
+  const map = n => {
+    const value = {}
+    for (let i = 0; i < n; i++) {
+      const k = next()
+      value[k] = next()
+    }
+    return value
+  }
+  const num = (size, read) => {
+    const value = read(pos)
+    pos += size
+    return value
+  }
+
+  const next = () => {
+    const b = bytes[pos++]
+    if (b < 0x80) {
+      return b
+    }
+    if (b < 0x90) {
+      return map(b & 0x0f)
+    }
+    if (b < 0xa0) {
+      return arr(b & 0x0f)
+    }
+    if (b < 0xc0) {
+      return str(b & 0x1f)
+    }
+    if (b >= 0xe0) {
+      return b - 0x100
+    }
+    switch (b) {
+      case 0xc0:
+        return null
+      case 0xc2:
+        return false
+      case 0xc3:
+        return true
+      case 0xc4:
+        return bin(num(1, p => view.getUint8(p)))
+      case 0xc5:
+        return bin(num(2, p => view.getUint16(p)))
+      case 0xc6:
+        return bin(num(4, p => view.getUint32(p)))
+      case 0xca:
+        return num(4, p => view.getFloat32(p))
+      case 0xcb:
+        return num(8, p => view.getFloat64(p))
+      case 0xcc:
+        return num(1, p => view.getUint8(p))
+      case 0xcd:
+        return num(2, p => view.getUint16(p))
+      case 0xce:
+        return num(4, p => view.getUint32(p))
+      case 0xcf:
+        return num(8, p => Number(view.getBigUint64(p)))
+      case 0xd0:
+        return num(1, p => view.getInt8(p))
+      case 0xd1:
+        return num(2, p => view.getInt16(p))
+      case 0xd2:
+        return num(4, p => view.getInt32(p))
+      case 0xd3:
+        return num(8, p => Number(view.getBigInt64(p)))
+      case 0xd9:
+        return str(num(1, p => view.getUint8(p)))
+      case 0xda:
+        return str(num(2, p => view.getUint16(p)))
+      case 0xdb:
+        return str(num(4, p => view.getUint32(p)))
+      case 0xdc:
+        return arr(num(2, p => view.getUint16(p)))
+      case 0xdd:
+        return arr(num(4, p => view.getUint32(p)))
+      case 0xde:
+        return map(num(2, p => view.getUint16(p)))
+      case 0xdf:
+        return map(num(4, p => view.getUint32(p)))
+    }
+    throw new Error(`msgpack: unsupported type 0x${b.toString(16)}`)
+  }
+
+  return next()
+}
+
+const tmRep = t => {
+  /* format an elapsed time in seconds as the server does, see helpers.Timestamp;
+   * the logs of older runs may contain times that are already formatted
+   */
+  if (t == null || typeof t == "string") {
+    return t
+  }
+  if (t < 10) {
+    return `${t.toFixed(2)}s`.padStart(6)
+  }
+  return `${String(Math.round(t)).padStart(2)}s   `
+}
+
+const seconds = t => (t == null ? t : t / 100)
+
+let wireNames = []
+
+const setWireNames = names => {
+  wireNames = names
+}
+
+const decodeProgress = data => {
+  /* turn a compact progress event into the event that JSON clients get
+   */
+  const [task, run, kind, lines] = unpack(data)
+  return {
+    task: wireNames[task],
+    run,
+    kind: wireNames[kind],
+    lines: lines.map(([n, t, text]) => [n, seconds(t), text]),
+  }
+}
+
+const decodeStatus = data => {
+  /* turn a compact status event into the event that JSON clients get
+   */
+  const [task, run, n, t, fields] = unpack(data)
+  return { ...fields, task: wireNames[task], run, n, tm: seconds(t) }
+}
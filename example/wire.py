@@ -0,0 +1,230 @@
+from threading import Lock
+from collections import Counter
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+WIRE = "msgpack"  # the name under which clients ask for the compact encoding
+
+
+def centis(tm):
+    """Turn an elapsed time in seconds into an integer.
+
+    Parameters
+    ----------
+    tm: float or None
+        E.g. `3.21`, see `Timestamp.offset()`.
+
+    Returns
+    -------
+    integer or None
+        The time in hundredths of a second, e.g. `321`.
+    """
+    return None if tm is None else round(tm * 100)
+
+
+class Wire:
+    """Encode progress and status events compactly for the clients that ask for it.
+
+    The events of the emitter are dicts, sent as JSON, in which every batch of
+    progress lines repeats the task and kind, and every line its elapsed time
+    as a number of seconds.
+
+    Clients may ask for a compact encoding instead, by passing `wire="msgpack"`
+    in their connection data. They then receive the `progress` and `status`
+    events as MessagePack, in binary Socket.IO frames:
+
+        progress: [task, run, kind, [[n, t, text], ...]]
+        status: [task, run, n, t, fields]
+
+    where
+
+    *   `task` and `kind` are small integers, ids in a dictionary of names,
+        which is sent to the client in a `wire-dict` event, as a list of names,
+        when it connects and whenever a name is added;
+    *   `t` is the elapsed time in hundredths of a second;
+    *   `fields` are the other fields of the status, such as `stat` and `msg`.
+
+    The dictionary is shared by all sessions, so that an event for a room needs
+    to be encoded only once, whatever encoding its members have asked for.
+    Compact clients join a room of their own next to every room of a task, see
+    `room()`, so that every client gets each event once, in its own encoding.
+    The wire counts the clients of both kinds in every room, see `enter()`, so
+    that an event is not encoded and sent in an encoding that nobody in the room
+    wants, see `audience()`.
+
+    The compact encoding needs the `msgpack` package. Without it, all clients get
+    JSON.
+    """
+
+    def __init__(self, socketio, corpus=None):
+        """Create a wire.
+
+        Parameters
+        ----------
+        socketio: object
+            The socketio object corresponding to the Flask app.
+        corpus: string, optional None
+            The corpus, which is part of the name of the dictionary room.
+        """
+        self.socketio = socketio
+        self.available = msgpack is not None
+        self.dictRoom = "wire" if corpus is None else f"{corpus}:wire"
+        self.names = []
+        self.ids = {}
+        self.idLock = Lock()
+        self.sessions = set()
+        self.roomLock = Lock()
+        self.members = Counter()
+        self.memberships = {}
+
+    def wants(self, auth):
+        """Whether a client asks for the compact encoding, and we can provide it.
+
+        Parameters
+        ----------
+        auth: dict or None
+            The connection data of the client.
+        """
+        return self.available and (auth or {}).get("wire", None) == WIRE
+
+    def room(self, room):
+        """The room for compact clients that goes with the room of a task."""
+        return f"{room}#{WIRE}"
+
+    def join(self, sid):
+        """Register a compact client, and send it the dictionary.
+
+        The client should also be entered into `dictRoom`, so that it gets
+        the additions to the dictionary.
+
+        Parameters
+        ----------
+        sid: string
+            The session id of the client.
+        """
+        with self.idLock:
+            self.sessions.add(sid)
+            self.socketio.emit("wire-dict", list(self.names), to=sid)
+
+    def enter(self, sid, room, compact):
+        """Count a client as a member of the room of a task.
+
+        Parameters
+        ----------
+        sid: string
+            The session id of the client.
+        room: string
+            The room of the task.
+        compact: boolean
+            Whether the client gets the compact encoding.
+
+        Returns
+        -------
+        string
+            The room that the client should join: the compact room that goes with
+            the room of the task, or that room itself.
+        """
+        target = self.room(room) if compact else room
+
+        with self.roomLock:
+            self.members[target] += 1
+            self.memberships.setdefault(sid, []).append(target)
+
+        return target
+
+    def leave(self, sid):
+        """Forget a client and its rooms when it disconnects."""
+        self.sessions.discard(sid)
+
+        with self.roomLock:
+            for target in self.memberships.pop(sid, []):
+                self.members[target] -= 1
+
+                if self.members[target] <= 0:
+                    del self.members[target]
+
+    def audience(self, room):
+        """Which encodings the clients in the room of a task want.
+
+        Parameters
+        ----------
+        room: string
+            The room of the task.
+
+        Returns
+        -------
+        tuple
+            Whether there are JSON clients, and whether there are compact clients.
+        """
+        members = self.members
+        return (members.get(room, 0) > 0, members.get(self.room(room), 0) > 0)
+
+    def active(self):
+        """Whether there are compact clients, so that events must be encoded."""
+        return bool(self.sessions)
+
+    def id(self, name):
+        """The id of a task or kind in the dictionary.
+
+        New names are added, and the dictionary is sent to the compact clients
+        before the id can be used in an event.
+        """
+        ids = self.ids
+        i = ids.get(name, None)
+
+        if i is not None:
+            return i
+
+        with self.idLock:
+            i = ids.get(name, None)
+
+            if i is None:
+                i = len(self.names)
+                self.names.append(name)
+                ids[name] = i
+                self.socketio.emit("wire-dict", list(self.names), to=self.dictRoom)
+
+        return i
+
+    def encode(self, event, data):
+        """Encode an event for compact clients.
+
+        Parameters
+        ----------
+        event: string
+            The name of the event: `progress` or `status`.
+        data: dict
+            The payload, as it is sent to JSON clients.
+
+        Returns
+        -------
+        bytes or None
+            None if the event has no compact encoding.
+        """
+        task = self.id(data["task"])
+
+        if event == "progress":
+            message = [
+                task,
+                data["run"],
+                self.id(data["kind"]),
+                [[n, centis(tm), text] for (n, tm, text) in data["lines"]],
+            ]
+        elif event == "status":
+            fields = {
+                k: v for (k, v) in data.items() if k not in {"task", "run", "n", "tm"}
+            }
+            message = [
+                task,
+                data["run"],
+                data["n"],
+                centis(data.get("tm", None)),
+                fields,
+            ]
+        else:
+            return None
+
+        return msgpack.packb(message, use_bin_type=True)
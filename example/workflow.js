@@ -1,8 +1,9 @@
 /*eslint-env jquery*/
-/* global io */
+/* global io, setWireNames, decodeProgress, decodeStatus */
 
 const PORT = 5050
-const tasks = ["function", "script"]
+const WIRE = "msgpack" // the compact encoding of events, null for JSON, see wire.js
+const tasks = ["function", "script", "preview"]
 
 /* time recording
  */
@@ -16,7 +17,7 @@ const elapsed = task => {
 }
 
 /* references to progress and status elements
- * separate areas side by side  for the two tasks
+ * separate areas side by side  for the tasks
  */
 const progressElem = {}
 const statusElem = {}
@@ -28,22 +29,83 @@ const setupElements = () => {
   }
 }
 
+const usageRep = usage => {
+  /* a short representation of the resources that a task has used
+   */
+  if (!usage) {
+    return ""
+  }
+  const { cpuUser, cpuSys, peakRss, readBytes, writeBytes } = usage
+  const mb = x => (x == null ? "?" : `${(x / 1048576).toFixed(1)}MB`)
+  const cpu = (cpuUser || 0) + (cpuSys || 0)
+  return ` [cpu ${cpu.toFixed(2)}s, mem ${mb(peakRss)}, read ${mb(readBytes)}, write ${mb(
+    writeBytes
+  )}]`
+}
+
+const etaRep = (pct, eta) => {
+  /* a short representation of the estimated progress of a run
+   */
+  if (pct == null) {
+    return ""
+  }
+  const left = eta < 60 ? `${eta}s` : `${Math.floor(eta / 60)}m ${eta % 60}s`
+  return ` [${pct}% done, about ${left} left]`
+}
+
+const cacheRep = cache => {
+  /* a short representation of the use of the step cache by a run or a step
+   */
+  if (cache == null) {
+    return ""
+  }
+  if (typeof cache == "string") {
+    return cache == "hit" ? " [from cache]" : ""
+  }
+  const { hits, misses } = cache
+  return ` [cache: ${hits} restored, ${misses} run]`
+}
+
 const setStatus = arg => {
   /* apply a status update to the interface
    * A status comes in as the payload of either a message over the websocket
    * or the response to an ajax call
    */
-  const { tm, ctm, task, stat, msg } = arg
+  const { tm, ctm, task, stat, msg, usage, pct, eta, killLatency, cache } = arg
   const tmRep = `server ${tm} client ${ctm}`
+  const uRep = usageRep(usage) + cacheRep(cache)
+  const eRep = etaRep(pct, eta)
   const pElem = progressElem[task]
   const sElem = statusElem[task]
-  if (stat == "start-issued") {
+  if (!sElem) {
+    /* e.g. the steps of a workflow, which report under the workflow itself
+     */
+    return
+  }
+  if (stat.startsWith("step-")) {
+    const { step, took } = arg
+    const state = stat.slice(5)
+    const tookRep = took ? ` in ${took}` : ""
+    const cls = state == "success" ? "good" : state == "start" ? "info" : "warning"
+    pElem.append(
+      `<div class="msg ${cls}">[${step}] ${state}${tookRep} ${msg}${uRep}</div>`
+    )
+    if (eRep) {
+      sElem.html(`«${task}» running${eRep}`).attr("class", "")
+    }
+  } else if (stat == "start-issued") {
     sElem.html(`«${task}» command issued`).attr("class", "")
+  } else if (stat == "start-coalesced") {
+    sElem.html(`«${task}» will run again after the current run`).attr("class", "")
   } else if (stat == "start-prevented") {
     sElem.html(`«${task}» command already running`).attr("class", "")
+  } else if (stat == "queued") {
+    sElem.html(`«${task}» ${msg}`).attr("class", "warning")
   } else if (stat == "start") {
     pElem.html("")
-    sElem.html(`«${task}» command started`).attr("class", "")
+    sElem.html(`«${task}» command started${eRep}`).attr("class", "")
+  } else if (stat == "eta") {
+    sElem.html(`«${task}» running${eRep}`).attr("class", "")
   } else if (stat == "kill-issued") {
     sElem.html(`«${task}» kill signalled`).attr("class", "warning")
   } else if (stat == "kill") {
@@ -51,11 +113,18 @@ const setStatus = arg => {
   } else if (stat == "kill-prevented") {
     sElem.html(`«${task}» command was not running`).attr("class", "")
   } else if (stat == "success") {
-    sElem.html(`${tmRep}: «${task}» status OK`).attr("class", "good")
+    sElem.html(`${tmRep}: «${task}» status OK${uRep}`).attr("class", "good")
+  } else if (stat == "success-warnings") {
+    sElem
+      .html(`${tmRep}: «${task}» status OK with warnings (${msg})${uRep}`)
+      .attr("class", "warning")
   } else if (stat == "failure") {
-    sElem.html(`${tmRep}: «${task}» status Error (${msg})`).attr("class", "error")
+    sElem.html(`${tmRep}: «${task}» status Error (${msg})${uRep}`).attr("class", "error")
   } else if (stat == "interrupt") {
-    sElem.html(`${tmRep}: «${task}» status Interrupt (${msg})`).attr("class", "warning")
+    const kRep = killLatency == null ? "" : `; gone after ${killLatency}s`
+    sElem
+      .html(`${tmRep}: «${task}» status Interrupt (${msg}${kRep})${uRep}`)
+      .attr("class", "warning")
   }
 }
 
@@ -110,35 +179,120 @@ const setupButtons = () => {
   }
 }
 
+/* replay bookkeeping:
+ * for each task the run id and sequence number of the last event we have seen
+ * When we (re)connect, we pass this to the server,
+ * which then sends us the events we have missed
+ */
+const seen = {}
+
+const isNew = (task, run, n) => {
+  /* check whether an event is new, and if so, mark it as seen
+   * an event of another run than the one we have seen, starts afresh
+   */
+  const [seenRun, seenN] = seen[task] || [null, -1]
+  if (run == seenRun && n <= seenN) {
+    return false
+  }
+  seen[task] = [run, run == seenRun ? Math.max(n, seenN) : n]
+  return true
+}
+
+const showLines = (task, kind, lines) => {
+  /* render progress lines [[n, tm, text], ...] with a single DOM update
+   */
+  const ctm = elapsed(task)
+  const kindRep = kind.slice(0, 3)
+  const msgReps = lines.map(
+    ([, tm, text]) => `server ${tmRep(tm)}, client ${ctm}: «${task}» [${kindRep}] ${text}`
+  )
+  if (msgReps.length == 0) {
+    return
+  }
+  ;(kind == "error" ? console.warn : console.log)(msgReps.join("\n"))
+  progressElem[task].append(
+    msgReps.map(msgRep => `<div class="msg ${kind}">${msgRep}</div>`).join("")
+  )
+}
+
+const showStatus = (task, t, stat, msg, extra) => {
+  const ctm = elapsed(task)
+  const tm = tmRep(t)
+  const msgRep = msg ? `(${msg})` : ""
+  const statRep = `server ${tm}, client ${ctm}: «${task}» status ${stat} (${msgRep})`
+  console.log(statRep)
+  setStatus({ ...extra, tm, ctm, task, stat, msg })
+}
+
 const setupSocket = () => {
   /* websocket processing:
    * initiate the connection
    * process messages
    */
-  const socket = io.connect(`http://localhost:${PORT}`)
+  const socket = io.connect(`http://localhost:${PORT}`, {
+    auth: cb => {
+      cb({ seen, tasks, wire: WIRE })
+    },
+  })
 
   socket.on("after connect", msg => {
     console.log("After connect", msg)
   })
 
+  socket.on("wire-dict", names => {
+    /* the names of tasks and kinds in compactly encoded events
+     */
+    setWireNames(names)
+  })
+
   socket.on("progress", msg => {
-    const { tm, task, kind, text } = msg
-    const ctm = elapsed(task)
-    const msgRep = `server ${tm}, client ${ctm}: «${task}» [${kind.slice(
-      0,
-      3
-    )}] ${text}`
-    ;(kind == "error" ? console.warn : console.log)(msgRep)
-    progressElem[task].append(`<div class="msg ${kind}">${msgRep}</div>`)
+    /* progress lines arrive in batches per task and kind:
+     * { task, run, kind, lines: [[n, tm, text], ...] }
+     * Lines that we have already seen in a replay are skipped.
+     */
+    const { task, run, kind, lines } =
+      msg instanceof ArrayBuffer ? decodeProgress(msg) : msg
+    showLines(
+      task,
+      kind,
+      lines.filter(([n]) => isNew(task, run, n))
+    )
+  })
+
+  socket.on("status", data => {
+    const message = data instanceof ArrayBuffer ? decodeStatus(data) : data
+    const { tm, task, run, n, stat, msg } = message
+    if (n != null && !isNew(task, run, n)) {
+      return
+    }
+    showStatus(task, tm, stat, msg, message)
   })
 
-  socket.on("status", message => {
-    const { tm, task, stat, msg } = message
-    const ctm = elapsed(task)
-    const msgRep = msg ? `(${msg})` : ""
-    const statRep = `server ${tm}, client ${ctm}: «${task}» status ${stat} (${msgRep})`
-    console.log(statRep)
-    setStatus({ tm, ctm, task, stat, msg })
+  socket.on("replay", message => {
+    /* the events of the latest run of a task that we have missed
+     * { task, run, skipped, records: [{ n, tm, ev, kind, ... }, ...] }
+     */
+    const { task, run, skipped, records } = message
+    const [seenRun] = seen[task] || [null]
+    if (run != seenRun) {
+      progressElem[task].html("")
+    }
+    if (skipped) {
+      progressElem[task].append(
+        `<div class="msg warning">… ${skipped} earlier messages not shown</div>`
+      )
+    }
+    for (const record of records) {
+      const { n, tm, ev, kind, text, stat, msg } = record
+      if (!isNew(task, run, n)) {
+        continue
+      }
+      if (ev == "progress") {
+        showLines(task, kind, [[n, tm, text]])
+      } else {
+        showStatus(task, tm, stat, msg, record)
+      }
+    }
   })
 }
 
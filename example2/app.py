@@ -1,8 +1,12 @@
 import os
 import sys
 from threading import Lock
-from flask import Flask, render_template, send_file
-from flask_socketio import SocketIO, emit
+from flask import Flask, render_template
+from flask_socketio import SocketIO, emit, join_room
+
+# the asset server is shared with the main example
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../example"))
+from assets import Assets
 
 PORT = 5050
 
@@ -16,25 +20,34 @@ def console(msg):
 app = Flask(__name__)
 socketio = SocketIO(app, logger=True, engineio_logger=True)
 console(f"{socketio.async_mode=}")
+assets = Assets(".")
 thread = {}
 threadLock = Lock()
 
 
+def room(pid):
+    """The room of the clients that show a project.
+
+    Events about a project are only sent to this room, not to all clients.
+    """
+    return f"project:{pid}"
+
+
 def runWorkflow(pid):
     """Example of how to send server generated events to clients."""
-    socketio.emit("status", dict(pid=pid, stat="start-inner"))
+    socketio.emit("status", dict(pid=pid, stat="start-inner"), to=room(pid))
 
     try:
         for i in range(10):
             socketio.sleep(1)
-            socketio.emit("progress", dict(pid=pid, step=i))
+            socketio.emit("progress", dict(pid=pid, step=i), to=room(pid))
         stat = "success-inner"
         msg = ""
     except Exception as e:
         msg = str(e)
         stat = "failure-inner"
 
-    socketio.emit("status", dict(pid=pid, stat=stat, msg=msg))
+    socketio.emit("status", dict(pid=pid, stat=stat, msg=msg), to=room(pid))
     thread[pid] = None
 
 
@@ -75,25 +88,39 @@ def killit(projectId):
         thread[projectId].g.kill()
         thread[projectId] = None
         stat = "kill-outer"
-        socketio.emit("status", dict(pid=projectId, stat="kill-inner"))
+        socketio.emit(
+            "status", dict(pid=projectId, stat="kill-inner"), to=room(projectId)
+        )
 
     return dict(pid=projectId, stat=stat)
 
 
 @app.route("/<path:path>")
 def staticFile(path):
-    if os.path.exists(path):
-        console(f"Serving file: {path}")
-        return send_file(path)
+    response = assets.serve(path)
+
+    if response is not None:
+        console(f"Serving file: {path} ({response.status_code})")
+        return response
 
     console(f"File not found: {path}")
-    return "xxx"
+    return "xxx", 404
 
 
 @socketio.on("connect")
-def test_connect():
+def test_connect(auth=None):
+    """Subscribe a client to the project that it shows.
+
+    The client passes the id of its project in its `auth` data, under
+    `projectId`.
+    """
     emit("after connect", {"data": "Ready to run"})
 
+    projectId = (auth or {}).get("projectId", None)
+
+    if projectId is not None:
+        join_room(room(projectId))
+
 
 if __name__ == "__main__":
     socketio.run(app, port=PORT, debug=True)
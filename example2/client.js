@@ -152,7 +152,7 @@ $(document).ready(() => {
     })
   }
 
-  const socket = io.connect(`http://localhost:${PORT}`)
+  const socket = io.connect(`http://localhost:${PORT}`, { auth: { projectId } })
 
   socket.on("after connect", msg => {
     console.log("After connect", msg)
@@ -5,9 +5,13 @@ import fcntl
 import errno
 from subprocess import Popen, PIPE, STDOUT
 from threading import Lock
-from flask import Flask, render_template, send_file
+from flask import Flask, render_template
 from flask_socketio import SocketIO, emit
 
+# the asset server is shared with the main example
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../example"))
+from assets import Assets
+
 PORT = 5050
 
 # ASYNC_MODE = "eventlet"  # does not work well when running scripts
@@ -47,6 +51,7 @@ class Timestamp:
 # Creating a flask app and using it to instantiate a socket object
 app = Flask(__name__)
 socketio = SocketIO(app, logger=True, engineio_logger=True, async_mode=ASYNC_MODE)
+assets = Assets(".")
 thread = {}
 threadLock = Lock()
 
@@ -228,11 +233,13 @@ def run(what, thr, que):
 
 @app.route("/<path:path>")
 def staticFile(path):
-    if os.path.exists(path):
-        return send_file(path)
+    response = assets.serve(path)
+
+    if response is not None:
+        return response
 
     console(f"File not found: {path}")
-    return "xxx"
+    return "xxx", 404
 
 
 @socketio.on("connect")